@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Weighted one-way frequencies of the harmonized sc_ variables for ACS and CHIS.
+
+Produces the same table as the SAS OnDemand step of "Step 2_Compare ACS vs CHIS.ipynb"
+(proc surveyfreq + proc report: Variable, Category, Raw Frequency, Population, Percent),
+computed locally with DataToolBox.survey_freq. The categories are labeled with the SAS formats of
+the sc_ variables in "Data/Output Data/FORMAT", as the SAS step did.
+"""
+
+# import packages
+import glob
+import os
+import pandas as pd
+from data_toolbox import DataToolBox
+from sas_formats import load_formats
+
+
+output_folder = 'Data/Output Data'
+format_folder = os.path.join(output_folder, 'FORMAT')
+
+
+# the Step 1 export formats Step 2 reads: CSV, compressed as export_data can write it, and Parquet
+EXPORT_SUFFIXES = (['.csv'] + ['.csv' + suffix for suffix, _ in DataToolBox.CSV_COMPRESSORS.values()]
+                   + ['.parquet'])
+
+
+def latest_export(file_name):
+    """
+    Return the most recent export of Step 1, e.g. acs_for_model_20240607_2907.csv
+    (or .csv.gz/.csv.bz2/.csv.xz/.parquet when Step 1 exports compressed CSV or Parquet).
+    """
+    patterns = [f"{file_name}_*{suffix}" for suffix in EXPORT_SUFFIXES]
+    paths = [path for pattern in patterns for path in glob.glob(os.path.join(output_folder, pattern))]
+    if not paths:
+        raise FileNotFoundError(f"No {' or '.join(patterns)} in '{output_folder}'; run Step 1 first.")
+    return max(paths, key=os.path.getmtime)
+
+
+def read_export(file_path):
+    """
+    Read an export of Step 1 in any of the formats latest_export finds (pandas infers the compression
+    of a CSV from its suffix).
+    """
+    if file_path.endswith('.parquet'):
+        return pd.read_parquet(file_path)
+    return pd.read_csv(file_path)
+
+
+def write_freq_report(freq, file_path, title):
+    """
+    Write a survey_freq table to Excel with a title row, like the proc report output.
+    """
+    with pd.ExcelWriter(file_path) as writer:
+        pd.DataFrame([[title]]).to_excel(writer, sheet_name='freq', index=False, header=False)
+        freq.to_excel(writer, sheet_name='freq', index=False, startrow=2, float_format='%.2f')
+    print(f"Frequency report has been saved to {file_path}")
+
+
+# =============================================================================
+# SAS formats of the sc_ variables, compiled once and cached
+# =============================================================================
+sc_formats = load_formats('sc_formats', os.path.join(format_folder, 'PROC FORMAT.sas.txt'),
+                          os.path.join(format_folder, 'FORMAT.sas.txt'))
+
+
+# =============================================================================
+# ACS
+#     weight: PWGTP
+#     sc_age_cont is continuous and left out, as in the SAS step
+# =============================================================================
+acs = DataToolBox(read_export(latest_export('acs_for_model')), formats=sc_formats)
+acs.data_desc()
+acs.optimize_dtypes()
+
+acs_freq = acs.survey_freq('PWGTP', prefixes=['sc_'], exclude=['sc_age_cont'])
+write_freq_report(acs_freq, os.path.join(output_folder, 'acs_freq.xlsx'), "ACS Weighted Frequency")
+
+
+# =============================================================================
+# CHIS
+#     weight: RAKEDW0
+# =============================================================================
+chis = DataToolBox(read_export(latest_export('chis_dummy_for_model')), formats=sc_formats)
+chis.data_desc()
+chis.optimize_dtypes()
+
+chis_freq = chis.survey_freq('RAKEDW0', prefixes=['sc_'], exclude=['sc_age_cont'])
+write_freq_report(chis_freq, os.path.join(output_folder, 'chis_freq.xlsx'), "CHIS Weighted Frequency")
+
+
+# =============================================================================
+# ACS vs CHIS
+#     weighted percentages side by side, differences (CHIS - ACS, percentage points) and per
+#     variable a Rao-Scott chi-square test of equal distributions with effect sizes;
+#     design effects from the replicate weights (ACS: SDR, CHIS: jackknife)
+# =============================================================================
+comparison, tests = acs.compare_freq(chis, 'PWGTP', 'RAKEDW0', prefixes=['sc_'], exclude=['sc_age_cont'],
+                                     method='sdr', other_method='jk2')
+
+comparison_path = os.path.join(output_folder, 'acs_vs_chis.xlsx')
+with pd.ExcelWriter(comparison_path) as writer:
+    tests.to_excel(writer, sheet_name='tests', index=False)
+    comparison.to_excel(writer, sheet_name='distributions', index=False, float_format='%.2f')
+print(f"Comparison report has been saved to {comparison_path}")
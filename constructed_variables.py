@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Recode specification of the harmonized sc_* variables shared by ACS and CHIS.
+
+This mirrors "Documentation/Constructed Variable Database for Modeling Data.md".
+Each variable maps a dataset name ('acs' or 'chis') to one of
+
+    {'copy': <source column>}
+        the value is copied from the source column,
+    {'source': <source column>, 'mapping': {code: value}, 'default': -1}
+        the arguments of DataToolBox.data_map: codes are looked up in the mapping, or
+    {'conditions': [...], 'choices': [...], 'default': -1}
+        the arguments of DataToolBox.data_construct: the first true condition
+        picks its choice (a value or a column name), otherwise the default.
+
+DataToolBox.apply_recodes builds every variable of a dataset in one pass. To add
+a variable, add one entry below.
+"""
+
+from data_loader import expression_columns
+
+
+RECODES = {
+    # =========================================================================
+    # GENDER
+    #     chis: SRSEX
+    #     acs: SEX
+    # =========================================================================
+    'sc_sex': {
+        'acs': {'conditions': ['SEX == 1', 'SEX == 2'], 'choices': [1, 2]},
+        'chis': {'conditions': ['SRSEX == 1', 'SRSEX == 2'], 'choices': [1, 2]},
+    },
+
+    # =========================================================================
+    # AGE - Continuous
+    #     chis: srage
+    #     acs: agep
+    # =========================================================================
+    'sc_age_cont': {
+        'acs': {'conditions': ['AGEP <=99'], 'choices': ['AGEP']},
+        'chis': {'conditions': ['SRAGE < 99', 'SRAGE >= 99'], 'choices': ['SRAGE', 99]},
+    },
+
+    # =========================================================================
+    # AGE - Categories
+    #     chis: srage
+    #     acs: agep
+    # =========================================================================
+    'sc_age_cat': {
+        'acs': {'conditions': ['AGEP < 18', 'AGEP >= 18 & AGEP < 25', 'AGEP >= 25 & AGEP < 35',
+                               'AGEP >= 35 & AGEP < 45', 'AGEP >= 45 & AGEP < 55',
+                               'AGEP >= 55 & AGEP <= 64', 'AGEP >= 65'],
+                'choices': list(range(7))},
+        'chis': {'conditions': ['SRAGE < 18', 'SRAGE >= 18 & SRAGE < 25', 'SRAGE >= 25 & SRAGE < 35',
+                                'SRAGE >= 35 & SRAGE < 45', 'SRAGE >= 45 & SRAGE < 55',
+                                'SRAGE >= 55 & SRAGE <= 64', 'SRAGE >= 65'],
+                 'choices': list(range(7))},
+    },
+
+    # =========================================================================
+    # HISPANIC - IS HISPANIC
+    #     chis: srh
+    #     acs: hisp
+    # =========================================================================
+    'sc_hisp': {
+        'acs': {'conditions': ['HISP == 1', 'HISP != 1'], 'choices': [2, 1]},
+        'chis': {'conditions': ['SRH == 1', 'SRH != 1'], 'choices': [1, 2]},
+    },
+
+    # =========================================================================
+    # RACE/ETHNICITY
+    #     chis: OMBSRREO
+    #     acs: rac1p
+    # =========================================================================
+    'sc_race_ethi': {
+        'acs': {'conditions': ['HISP != 1', 'RAC1P == 1', 'RAC1P == 2',
+                               'RAC1P == 3 | RAC1P == 4 |RAC1P == 5',
+                               'RAC1P == 6', 'RAC1P == 7', 'RAC1P == 8 | RAC1P == 9'],
+                'choices': [1, 2, 3, 4, 5, 6, 7]},
+        'chis': {'copy': 'OMBSRREO'},
+    },
+
+    # =========================================================================
+    # CITIZENSHIP
+    #     chis: CITIZEN2
+    #     acs: CIT
+    # =========================================================================
+    'sc_cit': {
+        'acs': {'conditions': ['CIT == 1|CIT == 2|CIT==3', 'CIT ==4', 'CIT==5'], 'choices': [1, 2, 3]},
+        'chis': {'copy': 'CITIZEN2'},
+    },
+
+    # =========================================================================
+    # EDUCATION
+    #     chis: sreduc
+    #     acs: SCHL
+    # =========================================================================
+    'sc_edu': {
+        'acs': {'conditions': ['SCHL >= 1 & SCHL <= 15', 'SCHL >= 16 & SCHL <= 17',
+                               'SCHL >= 18 & SCHL <= 20', 'SCHL >= 21'],
+                'choices': [1, 2, 3, 4]},
+        'chis': {'copy': 'SREDUC'},
+    },
+
+    # =========================================================================
+    # INSURED
+    #     chis: INS
+    #     acs: HICOV
+    # =========================================================================
+    'sc_ins': {
+        'acs': {'copy': 'HICOV'},
+        'chis': {'copy': 'INS'},
+    },
+
+    # =========================================================================
+    # EMPLOYED
+    #     chis: WRKST
+    #     acs: ESR
+    # =========================================================================
+    'sc_emp': {
+        'acs': {'conditions': ['ESR == 1|ESR ==4', 'ESR == 2|ESR ==5', 'ESR == 3|ESR ==6'],
+                'choices': [1, 2, 3]},
+        'chis': {'conditions': ['WRKST == 1|WRKST == 2', 'WRKST == 3', 'WRKST == 4|WRKST == 5'],
+                 'choices': [1, 2, 3]},
+    },
+
+    # =========================================================================
+    # HOUSING TENURE
+    #     chis: srtenr
+    #     acs: ten
+    # =========================================================================
+    'sc_housing': {
+        'acs': {'conditions': ['TEN == 1 | TEN == 2', 'TEN == 3 | TEN == 4'], 'choices': [1, 2]},
+        'chis': {'copy': 'SRTENR'},
+    },
+
+    # =========================================================================
+    # POVERTY LEVEL
+    #     chis: povll
+    #     acs: POVPIP
+    # =========================================================================
+    'sc_poverty': {
+        'acs': {'conditions': ['POVPIP <= 99', 'POVPIP >= 100 & POVPIP <= 199',
+                               'POVPIP >= 200 & POVPIP <= 299', 'POVPIP >= 300'],
+                'choices': [1, 2, 3, 4]},
+        'chis': {'copy': 'POVLL'},
+    },
+
+    # =========================================================================
+    # MARITAL STATUS
+    #     chis: AH43
+    #     acs: mar
+    # =========================================================================
+    'sc_marit': {
+        'acs': {'copy': 'MAR'},
+        'chis': {'conditions': ['AH43 == 1', 'AH43 == 3', 'AH43 == 4', 'AH43 == 5', 'AH43 == 2|AH43 == 6'],
+                 'choices': [1, 2, 3, 4, 5]},
+    },
+}
+
+
+def source_columns(recodes, dataset):
+    """
+    Return the source columns a dataset needs to build its recodes, e.g. to choose which columns
+    to read from the raw files. Columns produced by the recodes themselves are not included.
+
+    :param recodes: A recode specification such as RECODES.
+    :param dataset: The dataset name, e.g. 'acs' or 'chis'.
+    :return: A sorted list of column names.
+    """
+    columns = set()
+    for spec in recodes.values():
+        if dataset not in spec:
+            continue
+        rule = spec[dataset]
+        if 'copy' in rule:
+            columns.add(rule['copy'])
+            continue
+        if 'mapping' in rule:
+            columns.add(rule['source'])
+            continue
+        columns.update(expression_columns(rule['conditions']))
+        for choice in list(rule['choices']) + [rule.get('default', -1)]:
+            if isinstance(choice, str):
+                columns.add(choice)
+    return sorted(columns - set(recodes))
@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Loaders for the raw survey files used by the modeling pipeline.
+
+The ACS PUMS person and housing CSVs carry ~280 columns each, of which the
+recodes in Step 1 only use a handful. The functions below read just those
+columns, chunk by chunk, and store them with the smallest integer dtype that
+holds the values. The CHIS .sas7bdat files are read the same way by
+read_sas7bdat. Parsed datasets can be cached on disk in a columnar format
+(see load_cached) so that re-runs skip the CSV and SAS parsing.
+"""
+
+import ast
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# columns that are identifiers and must never be turned into numbers or categories
+KEY_COLUMNS = ['SERIALNO']
+
+
+def read_header(file_path):
+    """
+    Return the column names of a CSV file without reading any rows.
+
+    :param file_path: Path to the CSV file.
+    :return: A list of column names.
+    """
+    return list(pd.read_csv(file_path, nrows=0).columns)
+
+
+def expression_columns(expressions):
+    """
+    Return the names referenced in a list of DataToolBox condition strings (the strings passed to
+    data_exclude and data_construct), e.g. 'AGEP >= 18 & SCHL <= 15' -> {'AGEP', 'SCHL'}.
+
+    :param expressions: A string or a list of strings in pandas query/eval syntax.
+    :return: A set of referenced names.
+    """
+    if isinstance(expressions, str):
+        expressions = [expressions]
+
+    names = set()
+    for expression in expressions:
+        # pandas eval uses & and | for and/or, which are valid Python operators as well
+        tree = ast.parse(expression, mode='eval')
+        names.update(node.id for node in ast.walk(tree) if isinstance(node, ast.Name))
+    return names
+
+
+def required_columns(header, columns=None, prefixes=None, expressions=None):
+    """
+    Work out which columns of a file are needed by the later steps of the pipeline.
+
+    :param header: The column names available in the file (see read_header).
+    :param columns: Optional. Column names used directly (copy_column sources, choice columns, keys).
+    :param prefixes: Optional. Column prefixes kept by select_columns, e.g. 'PWGTP' for all replicate weights.
+    :param expressions: Optional. Condition strings used by data_exclude/data_construct.
+    :return: The needed columns, in file order. Names that are not in the file are ignored so that
+             the same list can be used for the person and the housing file.
+    """
+    wanted = set(columns or [])
+    if expressions:
+        wanted.update(expression_columns(expressions))
+
+    keep = []
+    for col in header:
+        if col in wanted or any(col.startswith(prefix) for prefix in prefixes or []):
+            keep.append(col)
+    return keep
+
+
+def _int_dtype(min_value, max_value, nullable):
+    """
+    Return the smallest integer dtype name that holds [min_value, max_value].
+    """
+    for dtype in ['int8', 'int16', 'int32', 'int64']:
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return dtype.capitalize() if nullable else dtype
+    return 'Int64' if nullable else 'int64'
+
+
+def compact_series(series, nullable=False):
+    """
+    Downcast a numeric Series of whole numbers to the smallest integer dtype that holds its values.
+    Series with missing values become pandas nullable integers; fractional and non-numeric Series
+    are returned unchanged.
+
+    :param series: A pandas Series.
+    :param nullable: Optional. Use a nullable integer dtype even if there are no missing values.
+    :return: The downcast Series.
+    """
+    if not (pd.api.types.is_integer_dtype(series) or pd.api.types.is_float_dtype(series)):
+        return series
+
+    values = series.to_numpy(dtype='float64', na_value=np.nan)
+    missing = np.isnan(values)
+    valid = values[~missing]
+    if valid.size and not np.array_equal(valid, np.floor(valid)):
+        # real fractional values; PUMS has none of these, keep them as they are
+        return series
+
+    if valid.size:
+        dtype = _int_dtype(valid.min(), valid.max(), nullable=nullable or missing.any())
+    else:
+        dtype = 'Int8'
+    return series.astype(dtype)
+
+
+def compact_chunk(chunk, keys=KEY_COLUMNS):
+    """
+    Downcast the numeric columns of a freshly parsed chunk to the smallest integer dtype.
+    Whole-number columns become pandas nullable integers, so that chunks with and without
+    missing values concatenate to the same integer dtype.
+
+    :param chunk: A pandas DataFrame as returned by pd.read_csv.
+    :param keys: Columns that are left untouched.
+    :return: The downcast DataFrame.
+    """
+    for col in chunk.columns:
+        if col not in keys:
+            chunk[col] = compact_series(chunk[col], nullable=True)
+    return chunk
+
+
+def finalize_dtypes(data, keys=KEY_COLUMNS, max_category_share=0.5):
+    """
+    Final pass over a concatenated dataset: nullable integer columns without missing values go back
+    to plain NumPy integers and low-cardinality text columns become categoricals.
+
+    :param data: A pandas DataFrame built from compact_chunk chunks.
+    :param keys: Columns that are left untouched.
+    :param max_category_share: Text columns with fewer unique values than this share of rows are
+                               stored as categoricals.
+    :return: The DataFrame with its final dtypes.
+    """
+    for col in data.columns:
+        if col in keys:
+            continue
+        series = data[col]
+        if pd.api.types.is_extension_array_dtype(series) and pd.api.types.is_integer_dtype(series):
+            if not series.hasnans:
+                data[col] = series.astype(series.dtype.numpy_dtype)
+        elif series.dtype == object:
+            if series.nunique(dropna=True) < max_category_share * max(len(series), 1):
+                data[col] = series.astype('category')
+    return data
+
+
+def group_quarters_flag(data):
+    """
+    Flag group-quarters records from the SERIALNO, whose characters 5-6 are 'GQ' for group quarters
+    and 'HU' for housing units.
+
+    :param data: A pandas DataFrame with a SERIALNO column.
+    :return: An int8 array: 1 for group quarters, 0 for housing units and -1 otherwise.
+    """
+    record_type = data['SERIALNO'].str[4:6]
+    return np.select([record_type == 'GQ', record_type == 'HU'], [1, 0], default=-1).astype('int8')
+
+
+def serialno_key(serialno):
+    """
+    Encode PUMS SERIALNO strings (e.g. '2019HU0001234') as int64 join keys. The year, the record type
+    (HU or GQ) and the sequence number are packed into one integer, so keys are unique whenever the
+    SERIALNOs are.
+
+    :param serialno: A pandas Series of SERIALNO strings.
+    :return: An int64 NumPy array.
+    """
+    year = serialno.str[:4].astype('int64').to_numpy()
+    is_gq = (serialno.str[4:6] == 'GQ').to_numpy().astype('int64')
+    number = serialno.str[6:].astype('int64').to_numpy()
+    return (year * 2 + is_gq) * 10 ** 10 + number
+
+
+def build_join_index(data, columns, key='SERIALNO'):
+    """
+    Build a sorted lookup index of a few columns of the housing file, used by join_index to attach
+    them to person records. Only the listed columns are kept, so the index stays small no matter how
+    wide the housing file is.
+
+    :param data: A pandas DataFrame with one row per key, e.g. the output of read_pums_csv on psam_h06.csv.
+    :param columns: Columns to carry over to the person records, e.g. ['TEN'].
+    :param key: The column identifying a household.
+    :return: A dict with the sorted integer 'keys' and the matching 'columns' arrays.
+    """
+    keys = serialno_key(data[key])
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    if len(keys) > 1 and (keys[1:] == keys[:-1]).any():
+        raise ValueError(f"The join index requires unique values of '{key}'.")
+
+    values = {}
+    for col in columns:
+        series = data[col]
+        if pd.api.types.is_integer_dtype(series) and not pd.api.types.is_extension_array_dtype(series):
+            # nullable, so that persons without a household record get <NA>
+            series = series.astype(series.dtype.name.capitalize())
+        values[col] = series.array.take(order)
+
+    return {'key': key, 'keys': keys, 'columns': values}
+
+
+def join_index(data, index):
+    """
+    Left-join the columns of a build_join_index index onto a chunk of person records, like
+    pd.merge(data, housing, on='SERIALNO', how='left') but with a binary search on integer keys.
+
+    :param data: A pandas DataFrame with the key column.
+    :param index: An index returned by build_join_index.
+    :return: The DataFrame with the index columns added.
+    """
+    keys = index['keys']
+    chunk_keys = serialno_key(data[index['key']])
+
+    if len(keys):
+        positions = np.minimum(np.searchsorted(keys, chunk_keys), len(keys) - 1)
+        positions = np.where(keys[positions] == chunk_keys, positions, -1)
+    else:
+        positions = np.full(len(chunk_keys), -1)
+
+    for col, values in index['columns'].items():
+        data[col] = values.take(positions, allow_fill=True)
+    return data
+
+
+def print_filter(condition, removed, total):
+    """
+    Print the result of an observation filter in the same layout as DataToolBox.data_exclude.
+    """
+    print("---------Obs Filter-----------------")
+    print("applying condition: ", condition)
+    print(removed, "/", total, "cases were removed")
+    print("new obs #: ", total - removed)
+    print("")
+
+
+def _pums_columns(file_path, columns=None, prefixes=None, expressions=None, derived=None, filters=None,
+                  join=None):
+    """
+    Return the header of a PUMS CSV and the columns read_pums_csv reads from it.
+    """
+    header = read_header(file_path)
+    if columns is None and prefixes is None and expressions is None:
+        usecols = header
+    else:
+        filter_columns = expression_columns(filters) - set(derived or {}) if filters else set()
+        join_columns = [join['key']] if join else []
+        usecols = required_columns(header,
+                                   columns=list(columns or []) + join_columns + sorted(filter_columns),
+                                   prefixes=prefixes,
+                                   expressions=expressions)
+    if not usecols:
+        raise ValueError(f"None of the requested columns exist in {file_path}.")
+    return header, usecols
+
+
+def iter_pums_csv(file_path, columns=None, prefixes=None, expressions=None, derived=None, filters=None,
+                  join=None, chunksize=250_000, filter_log=None):
+    """
+    Read ACS PUMS CSVs chunk by chunk, as read_pums_csv does, and yield the chunks one by one instead of
+    concatenating them. Several files (e.g. the national psam_pusa.csv - psam_pusd.csv) are read one
+    after the other, so memory stays bounded by the chunk size however large the files are.
+
+    :param file_path: Path to a PUMS CSV file, or a list of paths.
+    :param columns, prefixes, expressions, derived, filters, join, chunksize: As in read_pums_csv.
+    :param filter_log: Optional. A list that receives one [condition, removed, total] entry per filter,
+                       updated as the chunks are read.
+    :return: A generator of pandas DataFrames with compact (nullable integer) dtypes.
+    """
+    derived = derived or {}
+    filters = filters or []
+    if filter_log is not None:
+        filter_log[:] = [[condition, 0, 0] for condition in filters]
+
+    for path in [file_path] if isinstance(file_path, str) else file_path:
+        _, usecols = _pums_columns(path, columns, prefixes, expressions, derived, filters, join)
+        keys = [col for col in KEY_COLUMNS if col in usecols]
+        reader = pd.read_csv(path,
+                             usecols=usecols,
+                             dtype={col: str for col in keys},
+                             chunksize=chunksize,
+                             low_memory=False)
+
+        for chunk in reader:
+            chunk = compact_chunk(chunk, keys=keys)
+            if join:
+                chunk = join_index(chunk, join)
+            for name, func in derived.items():
+                chunk[name] = func(chunk)
+            for i, condition in enumerate(filters):
+                kept = chunk.query(condition)
+                if filter_log is not None:
+                    filter_log[i][1] += len(chunk) - len(kept)
+                    filter_log[i][2] += len(chunk)
+                chunk = kept
+            yield chunk
+
+
+def read_pums_csv(file_path, columns=None, prefixes=None, expressions=None, derived=None, filters=None,
+                  join=None, chunksize=250_000):
+    """
+    Read an ACS PUMS CSV (person or housing) keeping only the columns the pipeline uses.
+    The file is parsed in chunks and every chunk is downcast before the next one is read,
+    so peak memory stays close to the size of the final, compact dataset.
+
+    Row filters are applied to each chunk as it is read, so rows that would be dropped by
+    DataToolBox.data_exclude are never kept in memory. Like data_exclude, a filter keeps the rows that
+    meet its condition, and the filters are applied in order.
+
+    :param file_path: Path to the PUMS CSV file, e.g. psam_p06.csv, or a list of paths of files with
+                      the same layout (e.g. several states), which are stacked.
+    :param columns: Optional. Column names to read (see required_columns).
+    :param prefixes: Optional. Column prefixes to read, e.g. ['PWGTP'] for the weight and its replicates.
+    :param expressions: Optional. Condition strings whose columns should be read.
+    :param derived: Optional. A dict of new column name -> function(chunk) returning the column values,
+                    e.g. {'INGRPQ': group_quarters_flag}. Derived columns can be used in the filters.
+    :param filters: Optional. A list of condition strings; only rows meeting all of them are kept.
+    :param join: Optional. An index from build_join_index whose columns are joined onto each chunk
+                 (e.g. the housing TEN onto person records) before the derived columns and filters.
+    :param chunksize: Number of rows parsed at a time.
+    :return: A pandas DataFrame with the selected columns and compact dtypes.
+    """
+    first_path = file_path if isinstance(file_path, str) else file_path[0]
+    header, usecols = _pums_columns(first_path, columns, prefixes, expressions, derived, filters, join)
+    keys = [col for col in KEY_COLUMNS if col in usecols]
+
+    filter_log = []
+    chunks = list(iter_pums_csv(file_path, columns=columns, prefixes=prefixes, expressions=expressions,
+                                derived=derived, filters=filters, join=join, chunksize=chunksize,
+                                filter_log=filter_log))
+    data = pd.concat(chunks, ignore_index=True)
+    del chunks
+
+    data = finalize_dtypes(data, keys=keys)
+
+    print("---------Data Import----------------")
+    print("file: ", file_path)
+    print(filter_log[0][2] if filters else len(data), "obs;", len(usecols), "/", len(header), "vars read")
+    print(f"memory: {data.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MB")
+    print("")
+
+    # kept with the data, so that a cached copy can report the same filter results
+    data.attrs['filter_log'] = [tuple(entry) for entry in filter_log]
+    for condition, removed, total in data.attrs['filter_log']:
+        print_filter(condition, removed, total)
+
+    return data
+
+
+def read_sas_header(file_path):
+    """
+    Return the variable names of a SAS .sas7bdat file without reading any rows.
+
+    :param file_path: Path to the .sas7bdat file.
+    :return: A list of variable names.
+    """
+    try:
+        import pyreadstat
+    except ImportError:
+        with pd.read_sas(file_path, format='sas7bdat', iterator=True, encoding='infer') as reader:
+            return list(reader.column_names)
+
+    _, meta = pyreadstat.read_sas7bdat(file_path, metadataonly=True)
+    return list(meta.column_names)
+
+
+def iter_sas7bdat(file_path, columns=None, prefixes=None, expressions=None, chunksize=100_000):
+    """
+    Read a SAS .sas7bdat file (e.g. the CHIS adult file) in chunks of rows, keeping only the
+    requested variables. Pages are decoded in C by pyreadstat, which also skips the variables that
+    are not requested; without pyreadstat, the pandas SAS reader is used and the other variables are
+    dropped chunk by chunk.
+
+    :param file_path: Path to the .sas7bdat file.
+    :param columns: Optional. Variable names to read.
+    :param prefixes: Optional. Variable prefixes to read, e.g. ['RAKEDW'] for the weight and its replicates.
+    :param expressions: Optional. Condition strings whose variables should be read.
+    :param chunksize: Number of rows decoded at a time.
+    :return: A generator of pandas DataFrames with compact dtypes.
+    """
+    header = read_sas_header(file_path)
+    if columns is None and prefixes is None and expressions is None:
+        usecols = header
+    else:
+        usecols = required_columns(header, columns=columns, prefixes=prefixes, expressions=expressions)
+    if not usecols:
+        raise ValueError(f"None of the requested columns exist in {file_path}.")
+
+    try:
+        import pyreadstat
+    except ImportError:
+        pyreadstat = None
+
+    if pyreadstat is not None:
+        chunks = pyreadstat.read_file_in_chunks(pyreadstat.read_sas7bdat, file_path,
+                                                chunksize=chunksize, usecols=usecols)
+        for chunk, _ in chunks:
+            yield compact_chunk(chunk[usecols], keys=[])
+    else:
+        with pd.read_sas(file_path, format='sas7bdat', chunksize=chunksize, encoding='infer') as reader:
+            for chunk in reader:
+                yield compact_chunk(chunk[usecols], keys=[])
+
+
+def read_sas7bdat(file_path, columns=None, prefixes=None, expressions=None, chunksize=100_000):
+    """
+    Read a SAS .sas7bdat file into one DataFrame, keeping only the requested variables.
+    See iter_sas7bdat for reading it chunk by chunk.
+
+    :param file_path: Path to the .sas7bdat file.
+    :param columns: Optional. Variable names to read.
+    :param prefixes: Optional. Variable prefixes to read.
+    :param expressions: Optional. Condition strings whose variables should be read.
+    :param chunksize: Number of rows decoded at a time.
+    :return: A pandas DataFrame with the selected variables and compact dtypes.
+    """
+    chunks = list(iter_sas7bdat(file_path, columns=columns, prefixes=prefixes,
+                                expressions=expressions, chunksize=chunksize))
+    data = pd.concat(chunks, ignore_index=True)
+    del chunks
+
+    data = finalize_dtypes(data, keys=[])
+
+    print("---------Data Import----------------")
+    print("file: ", file_path)
+    print(len(data), "obs;", data.shape[1], "vars read")
+    print(f"memory: {data.memory_usage(deep=True).sum() / 1024 ** 2:.1f} MB")
+    print("")
+    return data
+
+
+def cache_key(sources, params=None):
+    """
+    Build the cache key of a dataset from its source files and the parameters it was read with.
+    A source that is modified, replaced or resized gets a new key.
+
+    :param sources: A list of source file paths.
+    :param params: Optional. A JSON-serializable dict of read parameters (columns, filters, ...).
+    :return: A hex digest string.
+    """
+    state = []
+    for source in sources:
+        stat = os.stat(source)
+        state.append([os.path.abspath(source), stat.st_size, stat.st_mtime_ns])
+    payload = json.dumps({'sources': state, 'params': params or {}}, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def load_cached(name, sources, build, params=None, cache_dir='Data/Cache', format='feather'):
+    """
+    Load a dataset from the on-disk cache, or build it and store it there.
+
+    The cache file is named after the dataset and its cache_key, so it is rebuilt automatically when
+    a source file or a read parameter changes; older files of the same dataset are removed. Feather
+    files are written uncompressed and read back with memory mapping.
+
+    :param name: Name of the dataset, e.g. 'acs_raw'.
+    :param sources: A list of the source file paths the dataset is built from.
+    :param build: A function without arguments that builds the dataset as a pandas DataFrame.
+    :param params: Optional. A JSON-serializable dict of everything else that changes the result,
+                   e.g. the selected columns and filters.
+    :param cache_dir: The directory holding the cache files.
+    :param format: 'feather' or 'parquet'.
+    :return: The pandas DataFrame.
+    """
+    extensions = {'feather': '.feather', 'parquet': '.parquet'}
+    if format not in extensions:
+        raise ValueError("Unsupported cache format specified.")
+
+    # pyarrow is only needed when the cache is used
+    import pyarrow as pa
+    import pyarrow.feather as feather
+    import pyarrow.parquet as parquet
+
+    key = cache_key(sources, params)
+    cache_path = os.path.join(cache_dir, f"{name}_{key}{extensions[format]}")
+
+    print("---------Data Cache-----------------")
+    if os.path.exists(cache_path):
+        if format == 'feather':
+            table = feather.read_table(cache_path, memory_map=True)
+        else:
+            table = parquet.read_table(cache_path, memory_map=True)
+        data = table.to_pandas()
+        attrs = (table.schema.metadata or {}).get(b'data_attrs')
+        if attrs:
+            data.attrs.update(json.loads(attrs))
+        print(f"{name} loaded from {cache_path}")
+        print("")
+        for condition, removed, total in data.attrs.get('filter_log', []):
+            print_filter(condition, removed, total)
+        return data
+
+    print(f"{name} not cached or sources changed; building it")
+    print("")
+    data = build()
+    attrs = dict(data.attrs)
+    data = data.reset_index(drop=True)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_path in glob.glob(os.path.join(cache_dir, f"{name}_{'[0-9a-f]' * 16}{extensions[format]}")):
+        os.remove(old_path)
+
+    # write to a temporary file first, so an interrupted run never leaves a broken cache behind
+    temp_path = cache_path + '.tmp'
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'data_attrs'] = json.dumps(attrs, default=str).encode('utf-8')
+    table = table.replace_schema_metadata(metadata)
+    if format == 'feather':
+        feather.write_feather(table, temp_path, compression='uncompressed')
+    else:
+        parquet.write_table(table, temp_path)
+    os.replace(temp_path, cache_path)
+    print(f"{name} cached to {cache_path}")
+    print("")
+    return data
@@ -0,0 +1,2450 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+DataToolBox: data manipulation and frequency analysis for the ACS and CHIS modeling data.
+
+Used by "Step 1_Produce ACS and SAS Data.py" to build the harmonized sc_* variables and by
+"Step 2_Compare ACS vs CHIS.py" to produce the weighted frequency reports.
+"""
+
+# import packages
+import pandas as pd
+import numpy as np
+from tabulate import tabulate
+import os
+import datetime
+import collections
+import gzip
+import bz2
+import lzma
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import random
+import ast
+import io
+import tokenize
+import re
+import math
+import statistics
+from data_loader import KEY_COLUMNS, compact_series, expression_columns, print_filter
+
+
+# =============================================================================
+# ### Class: DataToolBox
+# 
+# **Inputs:**
+# - `data`: A pandas DataFrame that contains the data to be analyzed and manipulated.
+# - `lazy` (Optional): Whether to record data_exclude, data_construct, data_map, apply_recodes, copy_column, fill_all_nans and select_columns as a plan that runs once, optimized, when the data are needed (see collect).
+# - `formats` (Optional): A `sas_formats.FormatCatalog` of SAS value formats and variable labels (e.g. the CHIS format files), used to label the frequency tables and exports.
+# 
+# **Description:**
+# The `DataToolBox` class provides various methods for data manipulation and analysis, including data exclusion, frequency distributions, data construction, and exporting data to different formats.
+# 
+# **Functions:**
+# 
+# 1. **return_data**
+#    - **Inputs:** None
+#    - **Description:** Returns the current state of the data stored in the toolbox.
+# 
+# 2. **data_desc**
+#    - **Inputs:** None
+#    - **Description:** Prints a description of the current dataset, including the number of observations (rows) and variables (columns).
+# 
+# 3. **data_exclude**
+#    - **Inputs:**
+#      - `condition`: A string representing the condition for filtering the data.
+#    - **Description:** Excludes observations from the data based on a given condition and updates the dataset.
+# 
+# 4. **freq_1way**
+#    - **Inputs:**
+#      - `col_name`: The name of the column for which the frequency distribution is to be calculated.
+#      - `weight_col` (Optional): The name of the column to be used for weighting the frequency and percentages.
+#      - `include_unweighted` (Optional): Whether to include unweighted results alongside weighted results.
+#    - **Description:** Prints the frequency count and percentage distribution of a single column, optionally including weighted results.
+# 
+# 5. **freq_2way**
+#    - **Inputs:**
+#      - `col_name_1`: The name of the first column.
+#      - `col_name_2`: The name of the second column.
+#      - `exclude_equal` (Optional): Whether to exclude rows where values in the first column equal values in the second column.
+#      - `weight_col` (Optional): The name of the column to be used for the weighted counts.
+#    - **Description:** Prints the two-way frequency table of two columns.
+# 
+# 6. **freq_multiway**
+#    - **Inputs:**
+#      - `columns`: A list of column names to be included in the multi-way frequency table.
+#      - `exclude_zeros` (Optional): Whether to exclude rows where the count is zero.
+#      - `exclude_equal` (Optional): Whether to exclude rows where all values in the columns are equal.
+#      - `weight_col` (Optional): The name of the column to be used for the weighted counts.
+#    - **Description:** Prints the multi-way frequency table of multiple columns.
+# 
+# 7. **data_construct**
+#    - **Inputs:**
+#      - `col_name`: Name of the new column to be added.
+#      - `conditions_str`: A list of conditions (as strings) that determine the value to be assigned.
+#      - `choices`: A list of values or column names to be assigned based on the conditions.
+#      - `default` (Optional): The default value or column name to be assigned if none of the conditions are met. Default is -1.
+#    - **Description:** Constructs a new column in the data based on multiple conditions.
+# 
+# 8. **copy_column**
+#    - **Inputs:**
+#      - `source_col`: The name of the source column whose values are to be copied.
+#      - `target_col`: The name of the target column to which the values will be copied.
+#    - **Description:** Copies the values from one column to another, preserving the original column.
+# 
+# 9. **fill_all_nans**
+#    - **Inputs:**
+#      - `fill_value`: The value to use for replacing NaNs across all columns.
+#    - **Description:** Replaces NaN values across all columns of the DataFrame with a specified value.
+# 
+# 10. **select_columns**
+#     - **Inputs:**
+#       - `col_list` (Optional): A list of column names to be retained in the dataset.
+#       - `prefixes` (Optional): A list of common prefixes for column names to be retained.
+#     - **Description:** Selects columns based on a list or common prefixes and updates the dataset.
+# 
+# 11. **export_data**
+#     - **Inputs:**
+#       - `file_name`: Name of the file without the extension.
+#       - `format`: Format of the file to save ('excel', 'csv', 'parquet', 'stata', 'r', 'spss', 'sql').
+#       - `include_freq_report` (Optional): Whether to include a frequency report as a separate file.
+#       - `max_categories` (Optional): Maximum number of categories to include in the frequency reports for each variable.
+#       - `folder_path` (Optional): The directory to save the file.
+#       - `compression` (Optional): 'gzip', 'bz2' or 'xz' for CSV; a Parquet codec (default 'zstd') for Parquet.
+#       - `chunksize` (Optional): The number of rows per block written. Default is 100,000.
+#       - `n_jobs` (Optional): The number of threads converting the Parquet blocks. Default is the number of CPUs.
+#       - `sql_engine` (Optional): 'sqlite' (default) or 'duckdb' for the 'sql' format.
+#       - `freq_report_format` (Optional): 'excel' (default, one sheet per variable, streamed), 'csv' or 'parquet' (one long table).
+#       - `value_labels` (Optional): Whether to write the columns that have a SAS format as their labels (Stata and SPSS keep the codes and get value labels). Needs `formats`.
+#     - **Description:** Exports the data to a specified format and optionally creates a frequency report for each variable. CSV and Parquet are written in blocks (Parquet blocks are converted in parallel) with narrow integer dtypes; float32 columns stay float32 in Parquet and are upcast to float64 (their exact values) for CSV and SQL; 'r' writes .rds (pyreadr), 'spss' .sav (pyreadstat) and 'sql' a SQLite or DuckDB table indexed on the PUMA and sc_ columns. With `formats`, Stata and SPSS files carry the variable labels and the frequency reports a Label column.
+# 
+# 12. **export_freq_1way**
+#     - **Inputs:**
+#       - `col_name`: Column name for frequency calculation.
+#       - `max_categories` (Optional): Maximum number of categories to include.
+#     - **Description:** Generates a DataFrame of frequency counts and percentages for a column, with an optional limit on categories (a partial-sort top-k), specifically designed for exporting data. Columns with a SAS format get a Label column.
+# 
+# 13. **data_map**
+#     - **Inputs:**
+#       - `col_name`: Name of the new column to be added.
+#       - `source_col`: The name of the column holding the codes.
+#       - `mapping`: A dict of source code to new value.
+#       - `default` (Optional): The value assigned to codes that are not in the mapping. Default is -1.
+#     - **Description:** Constructs a new column by mapping the codes of a source column through a lookup array.
+# 
+# 14. **apply_recodes**
+#     - **Inputs:**
+#       - `recodes`: A recode specification, e.g. `constructed_variables.RECODES`.
+#       - `dataset`: The dataset name used in the specification ('acs' or 'chis').
+#     - **Description:** Builds every variable of the recode specification for one dataset in a single pass over the source columns.
+# 
+# 15. **freq_1way_batch**
+#     - **Inputs:**
+#       - `columns`: A list of column names.
+#       - `weight_col` (Optional): The name of the column to be used for weighting the frequency and percentages.
+#       - `include_unweighted` (Optional): Whether to include unweighted results alongside weighted results.
+#     - **Description:** Prints the freq_1way table of several columns, reading the weights once and counting each column with a single np.bincount pass.
+# 
+# 16. **replicate_matrix**
+#     - **Inputs:**
+#       - `weight_col`: The full-sample weight, e.g. 'PWGTP'.
+#       - `replicate_cols` (Optional): The replicate weight columns. By default the columns named `weight_col` followed by a number (RAKEDW1-RAKEDW80 for RAKEDW0).
+#     - **Description:** Returns the full-sample and replicate weights as one contiguous float32 matrix, cached until the data change.
+# 
+# 17. **freq_1way_replicate**
+#     - **Inputs:**
+#       - `columns`: A column name or a list of column names.
+#       - `weight_col`: The full-sample weight, e.g. 'PWGTP'.
+#       - `replicate_cols` (Optional): The replicate weight columns.
+#       - `method` (Optional): The replication method: 'sdr' (ACS successive difference replication, default), 'jk1', 'jk2' (CHIS jackknife) or 'fay'.
+#       - `confidence` (Optional): The confidence level of the MOE and CI. Default is 0.90.
+#       - `display` (Optional): Whether to print a table per column.
+#       - `rho` (Optional): The Fay coefficient used by method 'fay'. Default is 0.5.
+#     - **Description:** Returns (and prints) weighted counts and percentages with replicate-weight SEs, MOEs and CIs, computing all weighted tallies of all columns with stacked matrix products.
+# 
+# 18. **survey_freq**
+#     - **Inputs:**
+#       - `weight_col`: The name of the weight column, e.g. 'PWGTP' or 'RAKEDW0'.
+#       - `columns` (Optional): The variables to tabulate. Default is every column matching `prefixes`.
+#       - `prefixes` (Optional): Column prefixes used when `columns` is not given. Default is ['sc_'].
+#       - `exclude` (Optional): Columns to leave out, e.g. ['sc_age_cont'].
+#       - `labels` (Optional): A dict of column name to {value: label} for the Category column. By default the toolbox's format catalog is used.
+#     - **Description:** Returns the one-way weighted frequency table of many variables (Variable, Category, Raw Frequency, Population, Percent), replacing the SAS proc surveyfreq + proc report step of Step 2.
+# 
+# 19. **compare_freq**
+#     - **Inputs:**
+#       - `other`: The DataToolBox to compare with, e.g. CHIS.
+#       - `weight_col`, `other_weight_col`: The weight columns of the two datasets, e.g. 'PWGTP' and 'RAKEDW0'.
+#       - `columns`, `prefixes`, `exclude` (Optional): The variables to compare, as in survey_freq. Default is the shared sc_ columns.
+#       - `by` (Optional): A column of both datasets to compare within each group, e.g. a PUMA.
+#       - `method`, `other_method` (Optional): The replication methods of the two weights (e.g. 'sdr', 'jk2'). Without, Kish design effects are used.
+#       - `rho` (Optional): The Fay coefficient used by method 'fay'.
+#       - `names` (Optional): The names of the two datasets. Default is ('ACS', 'CHIS').
+#       - `display` (Optional): Whether to print the table of tests.
+#     - **Description:** Returns the side-by-side weighted percentages with their differences, and per variable (and group) a Rao-Scott chi-square test with Cramer's V and the dissimilarity index.
+# 
+# 20. **collect**
+#     - **Inputs:** None
+#     - **Description:** In lazy mode (which also records mark_missing and fill_missing), runs the recorded plan once and returns the data: only the needed source columns are carried, recodes that are never used are skipped, and filters are moved ahead of the recodes and applied together. Reading the data (return_data, export_data, the frequency methods) collects automatically.
+# 
+# 21. **crosstab**
+#     - **Inputs:**
+#       - `columns`: A list of column names.
+#       - `weight_col` (Optional): The name of a weight column for the weighted counts.
+#       - `exclude_zeros` (Optional): Whether to exclude combinations with a count of zero. Default is True.
+#       - `exclude_equal` (Optional): Whether to exclude combinations where all values are equal.
+#     - **Description:** Returns the multi-way frequency table in long format (COUNT and WEIGHTED COUNT), computing only the observed combinations of large tables.
+# 
+# 22. **mark_missing**
+#     - **Inputs:**
+#       - `columns` (Optional): The columns to mark. Default is every numeric column.
+#       - `codes` (Optional): The special-missing codes. Default is the CHIS codes -1, -7, -8 and -9 (`MISSING_CODES`).
+#       - `nan_reason` (Optional): The reason code recorded for NaN values. Default is -9.
+#     - **Description:** Masks the special-missing codes and NaN values of the columns (they become missing in nullable integer columns) and keeps the reason of every masked value. Conditions see masked values as missing: comparisons with a code fail (so they get the default), while `isna()` and `!=` hold. Frequency tables count them as missing.
+# 
+# 23. **fill_missing**
+#     - **Inputs:**
+#       - `fill_value` (Optional): The value for the masked values. Default is each value's reason code.
+#       - `columns` (Optional): The columns to fill. Default is every masked column.
+#     - **Description:** Fills the masked values of the requested columns only, e.g. to write the special-missing codes back before an export.
+# 
+# 24. **missing_summary**
+#     - **Inputs:**
+#       - `columns` (Optional): The columns to report. Default is every masked column.
+#     - **Description:** Returns the number of masked values per column and reason code.
+# 
+# 25. **optimize_dtypes**
+#     - **Inputs:**
+#       - `columns` (Optional): The columns to downcast. Default is every column.
+#       - `max_category_share` (Optional): Text columns with fewer distinct values than this share of rows become categoricals. Default is 0.5.
+#       - `display` (Optional): Whether to print the memory saved.
+#     - **Description:** Downcasts whole-number columns (codes, recodes, integer weights) to the smallest integer dtype, other float columns (weights) to float32 where no value changes, and low-cardinality text columns to categoricals, and returns the bytes saved per column.
+# =============================================================================
+
+    
+
+class DataToolBox:
+    def __init__(self, data, lazy=False, formats=None):
+        """
+        Initialize the DataToolBox with a dataset.
+
+        :param data: A pandas DataFrame that contains the data to be analyzed and manipulated.
+        :param lazy: Optional. If True, data_exclude, data_construct, data_map, apply_recodes, copy_column,
+                     fill_all_nans and select_columns are recorded as a plan instead of run, and the plan
+                     runs once, optimized, when the data are next needed (see collect).
+        :param formats: Optional. A sas_formats.FormatCatalog. Columns with a SAS format get a Label column
+                        in the frequency tables, and can be exported with their labels (see export_data).
+        """
+        self._data = data
+        # whether self._data is a DataFrame the toolbox made itself, so columns can be added in place
+        self._owned = False
+        self.lazy = lazy
+        self._plan = []
+        self.formats = formats
+        # special-missing reasons of the columns marked by mark_missing: column -> Int8 array aligned with
+        # the rows, missing (NA) where the value is valid and the reason code where it is masked
+        self._missing = {}
+        # (condition, removed, total) of every filter applied, e.g. to add up the filters of partitions
+        self.filter_log = []
+
+    @property
+    def data(self):
+        """
+        The current pandas DataFrame. In lazy mode, reading it runs the recorded plan first.
+        """
+        if self._plan:
+            self.collect()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._owned = False
+        self._missing = {}
+
+    def _writable(self):
+        """
+        Return the data for adding or replacing columns (copy on write). A DataFrame the toolbox does not
+        own, such as the one it was given, is first replaced by a shallow copy: the copy shares the
+        existing columns, so nothing is copied, and new columns are only added to the copy. The caller's
+        frame is never changed.
+        """
+        if self._plan:
+            self.collect()
+        if not self._owned:
+            self._data = self._data.copy(deep=False)
+            self._owned = True
+        return self._data
+
+    def return_data(self):
+        """
+        Return the current state of the data stored in the toolbox.
+
+        :return: The current pandas DataFrame stored within the tool.
+        """
+        return self.data
+
+    def data_desc(self):
+        """
+        Print a description of the current dataset including the number of observations (rows) and variables (columns).
+        """
+        temp = self.data.shape
+        print("---------Current Data State----------")
+        print(temp[0], "obs;", temp[1], "vars")
+        print("")
+
+    def data_exclude(self, condition: str):
+        """
+        Exclude observations from the data based on a given condition and updates the dataset.
+
+        :param condition: A string representing the condition to be used for filtering the data.
+                          Observations meeting this condition will be excluded.
+        """
+        if self.lazy:
+            self._plan.append(('filter', condition))
+            return
+
+        # keep the rows with take rather than query, so that the result is a new frame of our own and
+        # later recodes can add columns to it without pandas' chained-assignment checks and copies
+        keep = np.flatnonzero(self._eval_conditions([condition])[0])
+        temp_new_obs = len(keep)
+        temp_old_obs = self.data.shape[0]
+        temp_diff_obs = temp_old_obs - temp_new_obs
+
+        print("---------Obs Filter-----------------")
+        print("applying condition: ", condition)
+        print(temp_diff_obs, "/", temp_old_obs, "cases were removed")
+        print("new obs #: ", temp_new_obs)
+        print("")
+        self.filter_log.append((condition, temp_diff_obs, temp_old_obs))
+
+        if temp_diff_obs:
+            self._data = self._data.take(keep)
+            self._owned = True
+            self._take_missing(keep)
+
+    def _factorize(self, col_name):
+        """
+        Encode a column as integer codes for np.bincount.
+
+        :return: A tuple of the codes (-1 for missing values) and the sorted unique values they refer to.
+        """
+        series = self.data[col_name]
+        if pd.api.types.is_integer_dtype(series) and series.notna().any():
+            # small integer codes are their own index, no hashing needed; missing (masked) values of
+            # nullable columns are given the code low - 1, so they come out as -1 and are skipped
+            low, high = int(series.min()), int(series.max())
+            if high - low <= self.LOOKUP_MAX_RANGE:
+                if pd.api.types.is_extension_array_dtype(series):
+                    codes = series.to_numpy(dtype=np.intp, na_value=low - 1)
+                else:
+                    codes = series.to_numpy().astype(np.intp)
+                codes -= low
+                return codes, pd.Index(np.arange(low, high + 1), dtype=series.dtype)
+        codes, uniques = pd.factorize(series, sort=True)
+        return codes, pd.Index(uniques)
+
+    def _freq_counts(self, col_name, weights=None):
+        """
+        Count every value of a column, and optionally sum the weights, in one np.bincount pass.
+        Like value_counts(dropna=False) and groupby().sum(), only values that occur are returned,
+        missing values are counted in the unweighted counts only.
+
+        :param col_name: The column to tabulate.
+        :param weights: Optional. A NumPy array of weights aligned with the data.
+        :return: A tuple of the unweighted counts and the weighted counts (None without weights),
+                 as Series indexed by the sorted values.
+        """
+        codes, uniques = self._factorize(col_name)
+        valid = codes >= 0
+        all_valid = valid.all()
+        valid_codes = codes if all_valid else codes[valid]
+
+        counts = np.bincount(valid_codes, minlength=len(uniques))
+        observed = counts > 0
+        index = uniques[observed].rename(col_name)
+        unweighted = pd.Series(counts[observed], index=index, name='count')
+
+        weighted = None
+        if weights is not None:
+            sums = np.bincount(valid_codes, weights=weights if all_valid else weights[valid],
+                               minlength=len(uniques))[observed]
+            if weights.dtype.kind in 'iub':
+                # sums of integer weights are exact in float64; keep them as integers like groupby().sum()
+                sums = np.rint(sums).astype('int64')
+            weighted = pd.Series(sums, index=index)
+
+        missing = len(codes) - len(valid_codes)
+        if missing:
+            unweighted = pd.concat([unweighted, pd.Series([missing], index=pd.Index([np.nan], name=col_name),
+                                                          name='count')])
+        return unweighted, weighted
+
+    def _freq_counts_batch(self, columns, max_cells=2**22):
+        """
+        Count every value of several columns with one np.bincount: the codes of the columns are shifted into
+        consecutive ranges, each starting with a slot for the column's missing values, and counted together.
+        Columns are batched so that at most max_cells codes are stacked at a time.
+
+        :param columns: A list of column names.
+        :return: A dict of column name -> unweighted counts, as returned by _freq_counts.
+        """
+        results = {}
+        n_rows = len(self.data)
+        per_batch = max(1, max_cells // max(n_rows, 1))
+        for start in range(0, len(columns), per_batch):
+            batch = columns[start:start + per_batch]
+            stacked = np.empty(n_rows * len(batch), dtype=np.intp)
+            layout = []
+            offset = 0
+            for i, col_name in enumerate(batch):
+                codes, uniques = self._factorize(col_name)
+                # slot offset holds the missing values (code -1), offset + 1 + code the values
+                np.add(codes, offset + 1, out=stacked[i * n_rows:(i + 1) * n_rows], casting='unsafe')
+                layout.append((col_name, uniques, offset))
+                offset += len(uniques) + 1
+            totals = np.bincount(stacked, minlength=offset)
+
+            for col_name, uniques, offset in layout:
+                counts = totals[offset + 1:offset + 1 + len(uniques)]
+                observed = counts > 0
+                unweighted = pd.Series(counts[observed], index=uniques[observed].rename(col_name), name='count')
+                missing = totals[offset]
+                if missing:
+                    unweighted = pd.concat([unweighted, pd.Series([missing], name='count',
+                                                                  index=pd.Index([np.nan], name=col_name))])
+                results[col_name] = unweighted
+        return results
+
+    def _freq_1way_table(self, col_name, weights=None, include_unweighted=False):
+        """
+        Build the table printed by freq_1way.
+
+        :return: A tuple of the frequency DataFrame and its title.
+        """
+        counts, weighted_counts = self._freq_counts(col_name, weights)
+        return self._freq_table(col_name, counts, weighted_counts if weights is not None else None,
+                                include_unweighted)
+
+    def _freq_table(self, col_name, counts, weighted_counts=None, include_unweighted=False):
+        """
+        Build the freq_1way table from the counts of _freq_counts (or counts added up over partitions).
+
+        :return: A tuple of the frequency DataFrame and its title.
+        """
+        if weighted_counts is not None:
+            # Weighted frequency and percentage
+            weighted_percentages = (weighted_counts / weighted_counts.sum()) * 100
+            weighted_df = pd.DataFrame({
+                'Weighted Counts': weighted_counts,
+                'Weighted Percentage': weighted_percentages
+            })
+
+            # Unweighted frequency and percentage
+            if include_unweighted:
+                percentages = (counts / counts.sum()) * 100
+                unweighted_df = pd.DataFrame({
+                    'Unweighted Counts': counts,
+                    'Unweighted Percentage': percentages
+                })
+                frequency_df = pd.concat([unweighted_df, weighted_df], axis=1)
+                title = f"Frequency Distribution for {col_name} (Weighted and Unweighted)"
+            else:
+                frequency_df = weighted_df
+                title = f"Frequency Distribution for {col_name} (Weighted)"
+        else:
+            # Unweighted frequency and percentage
+            percentages = (counts / counts.sum()) * 100
+            frequency_df = pd.DataFrame({
+                'Counts': counts,
+                'Percentage': percentages
+            })
+            title = f"Frequency Distribution for {col_name} (Unweighted)"
+
+        # Filter out rows with zero counts and reset the index
+        frequency_df = frequency_df[(frequency_df > 0).any(axis=1)].reset_index()
+        labels = self._value_labels(col_name, frequency_df.iloc[:, 0])
+        if labels is not None:
+            frequency_df.insert(1, 'Label', labels)
+        return frequency_df, title
+
+    def _value_labels(self, col_name, values):
+        """
+        Return the SAS format labels of the values of a column (see sas_formats.FormatCatalog.value_labels),
+        or None if there is no format catalog or the column has no format.
+        """
+        if self.formats is None:
+            return None
+        return self.formats.value_labels(col_name, list(values))
+
+    @staticmethod
+    def _print_freq_table(frequency_df, title):
+        """
+        Print a frequency table using tabulate for better formatting.
+        """
+        pd.set_option('display.float_format', '{:.0f}'.format)
+        print("---------", title, "----------")
+        print(
+            tabulate(frequency_df,
+                     headers='keys',
+                     tablefmt='grid',
+                     showindex=False))
+        print("")
+        pd.reset_option('display.float_format')
+
+    def freq_1way(self, col_name, weight_col=None, include_unweighted=False):
+        """
+        Print the frequency count and percentage distribution of a single column, sorted by index,
+        and display it in a formatted table with borders. Rows with a count of zero are not shown.
+        If a weight column is specified, it calculates weighted frequency and percentages.
+
+        :param col_name: The name of the column for which the frequency distribution is to be calculated.
+        :param weight_col: Optional. The name of the column to be used for weighting the frequency and percentages.
+        :param include_unweighted: Optional. Whether to include unweighted results alongside weighted results.
+        """
+        self.freq_1way_batch([col_name], weight_col=weight_col, include_unweighted=include_unweighted)
+
+    def freq_1way_batch(self, columns, weight_col=None, include_unweighted=False):
+        """
+        Print the freq_1way table of several columns. The weight column is read once and the
+        weighted and unweighted counts of each column come from a single np.bincount pass.
+
+        :param columns: A list of column names.
+        :param weight_col: Optional. The name of the column to be used for weighting the frequency and percentages.
+        :param include_unweighted: Optional. Whether to include unweighted results alongside weighted results.
+        """
+        weights = None
+        if weight_col:
+            weights = self._weights(weight_col)
+            if weights is None:
+                return
+
+        for col_name in columns:
+            frequency_df, title = self._freq_1way_table(col_name, weights, include_unweighted)
+            self._print_freq_table(frequency_df, title)
+
+    def _replicate_columns(self, weight_col, replicate_cols=None):
+        """
+        Return the full-sample weight followed by its replicate weights, e.g. PWGTP, PWGTP1, ..., PWGTP80.
+        By default the replicates are the columns named weight_col followed by a number; a full-sample
+        weight numbered 0 such as the CHIS RAKEDW0 is followed by RAKEDW1, ..., RAKEDW80.
+        """
+        if replicate_cols is None:
+            stem = weight_col[:-1] if re.search(r'\D0$', weight_col) else weight_col
+            pattern = re.compile(re.escape(stem) + r'(\d+)$')
+            numbered = [(int(match.group(1)), col) for col in self.data.columns
+                        for match in [pattern.match(col)] if match and col != weight_col]
+            replicate_cols = [col for _, col in sorted(numbered)]
+        if not replicate_cols:
+            raise ValueError(f"No replicate weights found for '{weight_col}'.")
+        return [weight_col] + list(replicate_cols)
+
+    def replicate_matrix(self, weight_col, replicate_cols=None):
+        """
+        Return the full-sample and replicate weights as one contiguous float32 matrix (rows x 1+R).
+        The matrix is kept until the data or the weight columns change, so that all frequency tables
+        share it.
+
+        :param weight_col: The full-sample weight, e.g. 'PWGTP'.
+        :param replicate_cols: Optional. The replicate weight columns; by default weight_col followed by a number.
+        :return: A float32 NumPy array whose column 0 is the full-sample weight.
+        """
+        columns = self._replicate_columns(weight_col, replicate_cols)
+        key = (tuple(columns), id(self.data), len(self.data))
+        cached = getattr(self, '_replicate_cache', None)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        matrix = np.empty((len(self.data), len(columns)), dtype='float32')
+        for i, col in enumerate(columns):
+            matrix[:, i] = self._column_values(col)
+        self._replicate_cache = (key, matrix)
+        return matrix
+
+    # variance factor of each replication method, applied to the sum of squared replicate deviations
+    # sdr: successive difference replication used by the ACS, 4 / R
+    # jk1: delete-one-group jackknife, (R - 1) / R
+    # jk2: jackknife with a coefficient of 1 per replicate, the CHIS RAKEDW1-RAKEDW80 setting
+    #      (SAS: varmethod=jackknife, repweights ... / jkcoefs=1)
+    # fay: Fay's balanced repeated replication with perturbation rho, 1 / (R * (1 - rho)^2)
+    REPLICATE_METHODS = {
+        'sdr': lambda n_replicates, rho: 4.0 / n_replicates,
+        'jk1': lambda n_replicates, rho: (n_replicates - 1) / n_replicates,
+        'jk2': lambda n_replicates, rho: 1.0,
+        'fay': lambda n_replicates, rho: 1.0 / (n_replicates * (1 - rho) ** 2),
+    }
+
+    def _factorize_by(self, col_name, by):
+        """
+        Encode the (group, value) pairs of a grouping column and a column as integer codes, group-major,
+        so that the values of one group have consecutive codes.
+
+        :return: A tuple of the codes (-1 where either value is missing) and the MultiIndex of the
+                 (group, value) pairs they refer to.
+        """
+        codes, uniques = self._factorize(col_name)
+        group_codes, groups = pd.factorize(self.data[by], sort=True)
+        missing = (codes < 0) | (group_codes < 0)
+        codes = group_codes.astype(np.intp) * len(uniques) + codes
+        codes[missing] = -1
+        return codes, pd.MultiIndex.from_product([groups, uniques], names=[by, col_name])
+
+    def _replicate_totals(self, columns, matrix, max_cells=2**22, by=None):
+        """
+        Sum every column of the weight matrix by the values of several columns with one matrix product
+        per chunk of rows: the indicator matrices of all columns are stacked, so one product gives the
+        1+R weighted totals of every value of every column. Chunks are sized so that the stacked
+        indicator matrix holds at most max_cells entries.
+
+        :param by: Optional. A grouping column; the totals are then computed by (group, value).
+        :return: A list with, per column, a tuple of the observed values (as an Index, or a MultiIndex of
+                 (group, value) with by), their unweighted counts and the (values x 1+R) float64 matrix
+                 of weighted totals. Missing values are left out.
+        """
+        encoded = []
+        offset = 0
+        for col_name in columns:
+            codes, uniques = self._factorize(col_name) if by is None else self._factorize_by(col_name, by)
+            counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+            observed = counts > 0
+            # renumber the observed values offset..offset+k-1, so the stacked indicator has no empty rows
+            new_codes = np.cumsum(observed) - 1 + offset
+            k = int(observed.sum())
+            encoded.append((codes, new_codes, uniques[observed], counts[observed], offset, k))
+            offset += k
+
+        totals = np.zeros((offset, matrix.shape[1]), dtype='float64')
+        chunksize = max(1024, max_cells // max(offset, 1))
+        for start in range(0, len(matrix), chunksize):
+            stop = min(start + chunksize, len(matrix))
+            # the weights are stored as float32 but summed in float64, so the totals are exact for
+            # integer weights and match freq_1way
+            indicator = np.zeros((offset, stop - start), dtype='float64')
+            for codes, new_codes, _, _, _, _ in encoded:
+                chunk_codes = codes[start:stop]
+                rows = np.nonzero(chunk_codes >= 0)[0]
+                indicator[new_codes[chunk_codes[rows]], rows] = 1
+            totals += indicator @ matrix[start:stop].astype('float64')
+        return [(values, counts, totals[offset:offset + k])
+                for _, _, values, counts, offset, k in encoded]
+
+    def freq_1way_replicate(self, columns, weight_col, replicate_cols=None, method='sdr', confidence=0.90,
+                            display=True, rho=0.5):
+        """
+        Weighted frequencies with replicate-weight standard errors, margins of error and confidence
+        intervals for the counts and the percentages. All 1+R weighted tallies of all columns come from
+        stacked matrix products with the float32 replicate matrix (see replicate_matrix), summed in float64.
+
+        Var = factor * sum over replicates of (estimate_r - estimate)^2, with factor 4/R for the ACS
+        successive difference replicates ('sdr'), (R-1)/R for 'jk1', 1 for 'jk2' (CHIS RAKEDW1-RAKEDW80)
+        and 1/(R(1-rho)^2) for 'fay'. MOE = z * SE, where z matches the confidence level
+        (1.645 for the Census Bureau's 90%).
+
+        :param columns: A column name or a list of column names.
+        :param weight_col: The full-sample weight, e.g. 'PWGTP'.
+        :param replicate_cols: Optional. The replicate weight columns; by default weight_col followed by a number.
+        :param method: Optional. The replication method, one of REPLICATE_METHODS. Default is 'sdr'.
+        :param confidence: Optional. The confidence level of the MOE and CI. Default is 0.90.
+        :param display: Optional. Whether to print a table per column.
+        :param rho: Optional. The Fay coefficient used by method 'fay'. Default is 0.5.
+        :return: A long DataFrame with one row per column and value.
+        """
+        if method not in self.REPLICATE_METHODS:
+            raise ValueError(f"Unsupported replication method '{method}'.")
+        if isinstance(columns, str):
+            columns = [columns]
+
+        matrix = self.replicate_matrix(weight_col, replicate_cols)
+        factor = self.REPLICATE_METHODS[method](matrix.shape[1] - 1, rho)
+        z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+
+        tables = []
+        for col_name, (values, counts, totals) in zip(columns, self._replicate_totals(columns, matrix)):
+            percents = totals / totals.sum(axis=0) * 100
+
+            count_se = np.sqrt(factor * ((totals[:, 1:] - totals[:, [0]]) ** 2).sum(axis=1))
+            percent_se = np.sqrt(factor * ((percents[:, 1:] - percents[:, [0]]) ** 2).sum(axis=1))
+            table = pd.DataFrame({
+                'Variable': col_name,
+                # object dtype keeps each variable's own values when the tables are concatenated
+                'Category': values.astype(object),
+                'Unweighted Counts': counts,
+                'Weighted Counts': totals[:, 0],
+                'SE': count_se,
+                'MOE': z * count_se,
+                'CI Lower': totals[:, 0] - z * count_se,
+                'CI Upper': totals[:, 0] + z * count_se,
+                'Weighted Percentage': percents[:, 0],
+                'Percentage SE': percent_se,
+                'Percentage MOE': z * percent_se,
+            })
+            tables.append(table)
+
+            if display:
+                title = (f"Replicate-Weight Estimates for {col_name} "
+                         f"({method.upper()}, {confidence:.0%} CI)")
+                self._print_freq_table(table.drop(columns='Variable').rename(columns={'Category': col_name}),
+                                       title)
+
+        return pd.concat(tables, ignore_index=True)
+
+    def survey_freq(self, weight_col, columns=None, prefixes=None, exclude=None, labels=None):
+        """
+        One-way weighted frequency tables of many variables in the layout of the SAS proc surveyfreq +
+        proc report step used to compare ACS and CHIS (Variable, Category, Raw Frequency, Population,
+        Percent). As in proc surveyfreq, missing values are left out, and the Total row of a variable
+        comes before its categories. Each variable is tabulated with one np.bincount pass.
+
+        :param weight_col: The name of the weight column, e.g. 'PWGTP' or 'RAKEDW0'.
+        :param columns: Optional. The variables to tabulate. Default is every column matching the prefixes.
+        :param prefixes: Optional. Column prefixes used when columns is not given. Default is ['sc_'].
+        :param exclude: Optional. Columns to leave out, e.g. ['sc_age_cont'].
+        :param labels: Optional. A dict of column name -> {value: label} used for the Category column,
+                       like the SAS formats; values without a label are shown as they are. Columns that
+                       are not in the dict are labeled with the toolbox's format catalog, if any.
+        :return: A DataFrame with one row per variable and category, sorted by variable and value.
+        """
+        if weight_col not in self.data.columns:
+            raise ValueError(f"The weight column '{weight_col}' does not exist.")
+        if columns is None:
+            prefixes = prefixes or ['sc_']
+            columns = [col for col in self.data.columns if any(col.startswith(prefix) for prefix in prefixes)]
+        columns = sorted(col for col in columns if col not in (exclude or []) and col != weight_col)
+
+        weights = self._column_values(weight_col)
+        labels = labels or {}
+
+        def category(col_name, value):
+            if value in labels.get(col_name, {}):
+                return labels[col_name][value]
+            if isinstance(value, (float, np.floating)) and float(value).is_integer():
+                return str(int(value))
+            return str(value)
+
+        tables = []
+        for col_name in columns:
+            counts, weighted_counts = self._freq_counts(col_name, weights)
+            # proc surveyfreq leaves missing values out of the table
+            counts = counts[counts.index.notna()]
+            population = weighted_counts.to_numpy(dtype='float64')
+            total = population.sum()
+            categories = None if col_name in labels else self._value_labels(col_name, counts.index)
+            if categories is None:
+                categories = [category(col_name, value) for value in counts.index]
+
+            table = pd.DataFrame({
+                'Variable': col_name,
+                'Category': ['Total'] + categories,
+                'Raw Frequency': np.concatenate([[counts.sum()], counts.to_numpy()]),
+                'Population': np.concatenate([[total], population]),
+                'Percent': np.concatenate([[100.0], population / total * 100 if total else population * np.nan]),
+            })
+            tables.append(table)
+
+        if not tables:
+            return pd.DataFrame(columns=['Variable', 'Category', 'Raw Frequency', 'Population', 'Percent'])
+        return pd.concat(tables, ignore_index=True)
+
+    @staticmethod
+    def _chi2_sf(statistic, df):
+        """
+        Upper tail probability of the chi-square distribution, element-wise on arrays: the regularized
+        upper incomplete gamma function Q(df/2, statistic/2), by its series below a+1 and its continued
+        fraction above (Numerical Recipes, gammq).
+        """
+        statistic, df = np.broadcast_arrays(np.asarray(statistic, dtype='float64'),
+                                            np.asarray(df, dtype='float64'))
+        a, x = df / 2, statistic / 2
+        result = np.full(a.shape, np.nan)
+        valid = (a > 0) & (x >= 0) & np.isfinite(x)
+        result[valid & (x == 0)] = 1.0
+        log_gamma = np.zeros(a.shape)
+        log_gamma[valid] = [math.lgamma(value) for value in a[valid]]
+
+        series = valid & (x > 0) & (x < a + 1)
+        if series.any():
+            sa, sx = a[series], x[series]
+            term = 1 / sa
+            total = term.copy()
+            ap = sa.copy()
+            for _ in range(1000):
+                ap += 1
+                term *= sx / ap
+                total += term
+                if (np.abs(term) < np.abs(total) * 1e-15).all():
+                    break
+            result[series] = 1 - total * np.exp(-sx + sa * np.log(sx) - log_gamma[series])
+
+        fraction = valid & (x >= a + 1)
+        if fraction.any():
+            fa, fx = a[fraction], x[fraction]
+            tiny = 1e-300
+            b = fx + 1 - fa
+            c = np.full(fa.shape, 1 / tiny)
+            d = 1 / b
+            h = d.copy()
+            for i in range(1, 1000):
+                an = -i * (i - fa)
+                b += 2
+                d = an * d + b
+                d[np.abs(d) < tiny] = tiny
+                c = b + an / c
+                c[np.abs(c) < tiny] = tiny
+                d = 1 / d
+                delta = d * c
+                h *= delta
+                if (np.abs(delta - 1) < 1e-15).all():
+                    break
+            result[fraction] = np.exp(-fx + fa * np.log(fx) - log_gamma[fraction]) * h
+        return np.clip(result, 0, 1)
+
+    def _cell_proportions(self, columns, weight_col, by=None, method=None, rho=0.5):
+        """
+        Weighted proportions of every value of several columns (within every group of by), with their
+        variances and design effects, for compare_freq. With a replication method the variance comes
+        from the replicate weights; without, from Kish's design effect 1 + CV^2 of the weights.
+
+        :return: A long DataFrame with Variable, the by column, Category, n, Weighted Counts,
+                 Proportion, Variance and Deff.
+        """
+        if method is None:
+            weights = self._column_values(weight_col).astype('float32')
+            # the totals of w and w^2 give Kish's design effect n * sum(w^2) / sum(w)^2
+            matrix = np.column_stack([weights, weights * weights])
+        else:
+            if method not in self.REPLICATE_METHODS:
+                raise ValueError(f"Unsupported replication method '{method}'.")
+            matrix = self.replicate_matrix(weight_col)
+        results = self._replicate_totals(columns, matrix, by=by)
+
+        variables = np.repeat(np.array(columns, dtype=object), [len(counts) for _, counts, _ in results])
+        counts = np.concatenate([counts for _, counts, _ in results])
+        totals = np.concatenate([totals for _, _, totals in results])
+        if by is None:
+            groups = np.zeros(len(counts), dtype=np.intp)
+        else:
+            groups = np.concatenate([values.codes[0] for values, _, _ in results])
+        categories = np.concatenate([np.asarray(values if by is None else values.get_level_values(1), dtype=object)
+                                     for values, _, _ in results]) if results else np.array([], dtype=object)
+
+        # cells of one variable and group are consecutive: sum them with reduceat over the segments
+        new_segment = np.ones(len(counts), dtype=bool)
+        new_segment[1:] = (variables[1:] != variables[:-1]) | (groups[1:] != groups[:-1])
+        starts = np.flatnonzero(new_segment)
+        segment = np.cumsum(new_segment) - 1
+        segment_totals = np.add.reduceat(totals, starts, axis=0)[segment]
+        segment_counts = np.add.reduceat(counts, starts)[segment]
+
+        proportions = totals[:, 0] / segment_totals[:, 0]
+        binomial = proportions * (1 - proportions) / segment_counts
+        if method is None:
+            deff = segment_counts * segment_totals[:, 1] / segment_totals[:, 0] ** 2
+            variance = deff * binomial
+        else:
+            factor = self.REPLICATE_METHODS[method](matrix.shape[1] - 1, rho)
+            replicate_proportions = totals[:, 1:] / segment_totals[:, 1:]
+            variance = factor * ((replicate_proportions - proportions[:, None]) ** 2).sum(axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                deff = np.where(binomial > 0, variance / binomial, 1.0)
+
+        cells = pd.DataFrame({'Variable': variables, 'Category': categories, 'n': counts,
+                              'Weighted Counts': totals[:, 0], 'Proportion': proportions,
+                              'Variance': variance, 'Deff': deff})
+        if by is not None:
+            group_values = [values.levels[0] for values, _, _ in results]
+            cells.insert(1, by, group_values[0][groups] if group_values else [])
+        return cells
+
+    def compare_freq(self, other, weight_col, other_weight_col, columns=None, prefixes=None, exclude=None,
+                     by=None, method=None, other_method=None, rho=0.5, names=('ACS', 'CHIS'), display=True):
+        """
+        Compare the weighted distributions of the variables shared with another DataToolBox, e.g. the
+        harmonized sc_ variables of ACS and CHIS: side-by-side weighted percentages, their difference,
+        and per variable (and group of by) a design-adjusted chi-square test of homogeneity with effect
+        sizes. The weighted tallies of all variables of a dataset come from stacked matrix products
+        (see _replicate_totals), and the tests of all variables and groups are computed at once on the
+        long cell table.
+
+        The test is the first-order Rao-Scott correction of the Pearson chi-square of the 2 x k table
+        of weighted proportions: X2_RS = X2 / mean deff, with the mean generalized design effect of two
+        independent samples, sum over cells of (1 - p) * (n_b * deff_a + n_a * deff_b) / (n_a + n_b),
+        divided by k - 1. Cell design effects come from the replicate weights when a replication method
+        is given (e.g. 'sdr' for PWGTP, 'jk2' for RAKEDW0), otherwise from Kish's 1 + CV^2 of the weights.
+        Effect sizes are Cramer's V of the unadjusted table and the dissimilarity index
+        (half the sum of the absolute percentage differences).
+
+        :param other: The DataToolBox to compare with.
+        :param weight_col: The weight column of this dataset, e.g. 'PWGTP'.
+        :param other_weight_col: The weight column of the other dataset, e.g. 'RAKEDW0'.
+        :param columns: Optional. The variables to compare. Default is every column matching the prefixes
+                        in both datasets.
+        :param prefixes: Optional. Column prefixes used when columns is not given. Default is ['sc_'].
+        :param exclude: Optional. Columns to leave out, e.g. ['sc_age_cont'].
+        :param by: Optional. A column of both datasets (e.g. a PUMA or region) to compare within each group.
+        :param method: Optional. The replication method of this dataset's weights, one of REPLICATE_METHODS.
+        :param other_method: Optional. The replication method of the other dataset's weights.
+        :param rho: Optional. The Fay coefficient used by method 'fay'. Default is 0.5.
+        :param names: Optional. The names of the two datasets used in the column headers.
+        :param display: Optional. Whether to print the table of tests.
+        :return: A tuple of two DataFrames: the cells (one row per variable, group and category) and
+                 the tests (one row per variable and group).
+        """
+        for toolbox, col in ((self, weight_col), (other, other_weight_col)):
+            if col not in toolbox.data.columns:
+                raise ValueError(f"The weight column '{col}' does not exist.")
+        if columns is None:
+            prefixes = prefixes or ['sc_']
+            columns = [col for col in self.data.columns if col in other.data.columns
+                       and any(col.startswith(prefix) for prefix in prefixes)]
+        columns = sorted(col for col in columns if col not in (exclude or [])
+                         and col not in (weight_col, other_weight_col, by))
+        name_a, name_b = names
+        keys = ['Variable'] + ([by] if by else []) + ['Category']
+
+        cells_a = self._cell_proportions(columns, weight_col, by=by, method=method, rho=rho)
+        cells_b = other._cell_proportions(columns, other_weight_col, by=by, method=other_method, rho=rho)
+        cells = cells_a.merge(cells_b, on=keys, how='outer', suffixes=('_a', '_b'), sort=True)
+        for col in ['n', 'Weighted Counts', 'Proportion', 'Variance']:
+            cells[[col + '_a', col + '_b']] = cells[[col + '_a', col + '_b']].fillna(0)
+        # a category missing from one sample carries no design effect information
+        cells[['Deff_a', 'Deff_b']] = cells[['Deff_a', 'Deff_b']].fillna(1.0)
+
+        segments = cells.groupby(keys[:-1], sort=False)
+        n_a = segments['n_a'].transform('sum').to_numpy(dtype='float64')
+        n_b = segments['n_b'].transform('sum').to_numpy(dtype='float64')
+        p_a = cells['Proportion_a'].to_numpy()
+        p_b = cells['Proportion_b'].to_numpy()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pooled = (n_a * p_a + n_b * p_b) / (n_a + n_b)
+            observed = pooled > 0
+            cells['_pearson'] = np.where(observed, (n_a * (p_a - pooled) ** 2 + n_b * (p_b - pooled) ** 2)
+                                         / pooled, 0.0)
+            cells['_deff'] = np.where(observed, (1 - pooled) * (n_b * cells['Deff_a'] + n_a * cells['Deff_b'])
+                                      / (n_a + n_b), 0.0)
+        cells['_observed'] = observed
+        cells['_abs_diff'] = np.abs(p_b - p_a)
+        cells['_n'] = n_a + n_b
+
+        tests = cells.groupby(keys[:-1], sort=False).agg(
+            k=('_observed', 'sum'), pearson=('_pearson', 'sum'), deff=('_deff', 'sum'),
+            dissimilarity=('_abs_diff', 'sum'), n=('_n', 'first'),
+            n_a=('n_a', 'sum'), n_b=('n_b', 'sum')).reset_index()
+        df = tests['k'] - 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            valid = (df > 0) & (tests['n_a'] > 0) & (tests['n_b'] > 0)
+            mean_deff = np.where(valid, tests['deff'] / df, np.nan)
+            pearson = np.where(valid, tests['pearson'], np.nan)
+            rao_scott = pearson / mean_deff
+            tests = tests[keys[:-1]].assign(**{
+                f'{name_a} n': tests['n_a'].astype('int64'),
+                f'{name_b} n': tests['n_b'].astype('int64'),
+                'Categories': tests['k'],
+                'DF': df,
+                'Pearson Chi-Square': pearson,
+                'Mean Deff': mean_deff,
+                'Rao-Scott Chi-Square': rao_scott,
+                'P-Value': self._chi2_sf(rao_scott, df),
+                "Cramer's V": np.sqrt(pearson / tests['n']),
+                'Dissimilarity Index': np.where(valid, tests['dissimilarity'] / 2 * 100, np.nan),
+            })
+
+        se_a = np.sqrt(cells['Variance_a']) * 100
+        se_b = np.sqrt(cells['Variance_b']) * 100
+        cells = cells[keys].assign(**{
+            f'{name_a} n': cells['n_a'].astype('int64'),
+            f'{name_a} Weighted Counts': cells['Weighted Counts_a'],
+            f'{name_a} %': p_a * 100,
+            f'{name_a} SE': se_a,
+            f'{name_b} n': cells['n_b'].astype('int64'),
+            f'{name_b} Weighted Counts': cells['Weighted Counts_b'],
+            f'{name_b} %': p_b * 100,
+            f'{name_b} SE': se_b,
+            'Difference': (p_b - p_a) * 100,
+            'Difference SE': np.sqrt(se_a ** 2 + se_b ** 2),
+        })
+
+        if display:
+            title = f"{name_a} vs {name_b} Weighted Distributions (Rao-Scott Chi-Square)"
+            print("---------", title, "----------")
+            print(tabulate(tests, headers='keys', tablefmt='grid', showindex=False, floatfmt='.4g'))
+            print("")
+        return cells, tests
+
+    # largest number of cells counted with a dense np.bincount; larger tables count only observed cells
+    DENSE_MAX_CELLS = 2 ** 20
+    # largest packed key; beyond it the columns packed so far are replaced by the rank of their key
+    KEY_MAX = 2 ** 62
+
+    def _crosstab_long(self, columns, exclude_zeros=True, exclude_equal=False, weights=None):
+        """
+        Count every combination of the values of several columns and return it in long format, with
+        missing values as a category of their own ('NaN'). Each column is encoded as integer codes of its
+        observed values, with missing values as a sentinel code after them, and the codes are packed into
+        one integer key (mixed radix).
+
+        Small tables are counted with one dense np.bincount over all possible keys. Larger ones (e.g.
+        PUMA x age x race x sex x poverty) are counted over the observed keys only, found with np.unique,
+        so memory grows with the number of non-empty cells rather than the size of the full table. If
+        the packed key would overflow, the columns packed so far are first replaced by the rank of their
+        key among the observed keys. The columns keep their dtypes, except that a column whose missing
+        values appear in the table holds 'NaN'.
+
+        :param columns: A list of column names.
+        :param exclude_zeros: Optional. Whether to leave out combinations with a count of zero. Otherwise,
+                              as in pd.crosstab, the zero cells of the observed combinations of all but
+                              the last column are listed. Tables with zeros are always dense.
+        :param exclude_equal: Optional. Whether to leave out combinations where all values are equal
+                              (missing values count as equal to each other).
+        :param weights: Optional. A NumPy array of weights aligned with the data; adds WEIGHTED COUNT.
+        :return: A DataFrame with the columns, COUNT and optionally WEIGHTED COUNT, sorted by the
+                 columns (missing values last).
+        """
+        key = np.zeros(len(self.data), dtype=np.int64)
+        size = 1
+        # stages of packing: (the observed keys of a finished stage, its radices) and the current radices;
+        # the first radix of a later stage is the rank of the previous stage's key
+        stages = []
+        radices = []
+        levels = []
+        for col in columns:
+            codes, uniques = self._factorize(col)
+            valid = codes >= 0
+            observed = np.bincount(codes[valid], minlength=len(uniques)) > 0
+            k = int(observed.sum())
+            # renumber the observed values 0..k-1 and give missing values the sentinel code k
+            remap = np.cumsum(observed) - 1
+            codes = np.where(valid, remap[np.where(valid, codes, 0)], k)
+            levels.append((uniques[observed], not valid.all()))
+
+            if size * (k + 1) > self.KEY_MAX:
+                observed_keys, key = np.unique(key, return_inverse=True)
+                key = key.astype(np.int64).reshape(-1)
+                stages.append((observed_keys, radices))
+                radices = [len(observed_keys)]
+                size = len(observed_keys)
+            key *= k + 1
+            key += codes
+            size *= k + 1
+            radices.append(k + 1)
+
+        if not exclude_zeros and stages:
+            raise ValueError("Too many combinations to list the cells with a count of zero; use exclude_zeros=True.")
+        if not exclude_zeros or size <= self.DENSE_MAX_CELLS:
+            counts = np.bincount(key, minlength=size)
+            if exclude_zeros:
+                cells = np.flatnonzero(counts)
+            elif len(columns) > 1:
+                # as in pd.crosstab, zeros are listed for the observed combinations of the other columns,
+                # one per value of the last column
+                observed_rows = counts.reshape(-1, radices[-1]).any(axis=1)
+                cells = np.flatnonzero(np.repeat(observed_rows, radices[-1]))
+            else:
+                cells = np.arange(size)
+            cell_counts = counts[cells]
+            if weights is not None:
+                weighted = np.bincount(key, weights=weights, minlength=size)[cells]
+        else:
+            cells, inverse, cell_counts = np.unique(key, return_inverse=True, return_counts=True)
+            if weights is not None:
+                weighted = np.bincount(inverse.reshape(-1), weights=weights, minlength=len(cells))
+
+        # decode the keys back into the codes of each column, last column first
+        all_stages = stages + [(None, radices)]
+        remainder = cells.astype(np.int64)
+        decoded = []
+        for i in range(len(all_stages) - 1, -1, -1):
+            own_radices = all_stages[i][1] if i == 0 else all_stages[i][1][1:]
+            for radix in reversed(own_radices):
+                decoded.append(remainder % radix)
+                remainder = remainder // radix
+            if i > 0:
+                remainder = all_stages[i - 1][0][remainder]
+        decoded.reverse()
+
+        keep = np.ones(len(cells), dtype=bool)
+        for (values, has_missing), codes in zip(levels, decoded):
+            if not has_missing:
+                # the sentinel of a column without missing values is never a real category
+                keep &= codes < len(values)
+
+        if exclude_equal and len(columns) > 1:
+            # map the codes of every column into the codes of the union of their values (missing last),
+            # then compare the columns of codes: a row is all-equal if every column matches the first
+            union = pd.Index(pd.unique(np.concatenate([np.asarray(values, dtype=object) for values, _ in levels])))
+            shared = [np.append(union.get_indexer(np.asarray(values, dtype=object)), len(union))[codes]
+                      for (values, _), codes in zip(levels, decoded)]
+            all_equal = np.ones(len(cells), dtype=bool)
+            for codes in shared[1:]:
+                all_equal &= codes == shared[0]
+            keep &= ~all_equal
+
+        result = {}
+        for col, (values, _), codes in zip(columns, levels, decoded):
+            codes = codes[keep]
+            missing = codes == len(values)
+            if missing.any():
+                column = np.empty(len(codes), dtype=object)
+                column[~missing] = values.take(codes[~missing])
+                column[missing] = 'NaN'
+            else:
+                column = values.take(codes)
+            result[col] = column
+        result['COUNT'] = cell_counts[keep]
+        if weights is not None:
+            sums = weighted[keep]
+            if weights.dtype.kind in 'iub':
+                # sums of integer weights are exact in float64; keep them as integers
+                sums = np.rint(sums).astype('int64')
+            result['WEIGHTED COUNT'] = sums
+        return pd.DataFrame(result)
+
+    def _weights(self, weight_col):
+        """
+        Return a weight column as a NumPy array, or None (after printing an error) if it does not exist.
+        """
+        if weight_col not in self.data.columns:
+            print(f"Error: The weight column '{weight_col}' does not exist.")
+            return None
+        return self._column_values(weight_col)
+
+    def crosstab(self, columns, weight_col=None, exclude_zeros=True, exclude_equal=False):
+        """
+        Return the multi-way frequency table of several columns in long format, unweighted and optionally
+        weighted, without printing it. Only the observed combinations are computed for large tables (see
+        _crosstab_long), so high-cardinality tables such as PUMA x age x race x sex x poverty for
+        small-area checks stay proportional to their non-empty cells.
+
+        :param columns: A list of column names.
+        :param weight_col: Optional. The name of a weight column; adds WEIGHTED COUNT.
+        :param exclude_zeros: Optional. Whether to exclude combinations with a count of zero.
+        :param exclude_equal: Optional. Whether to exclude combinations where all values are equal.
+        :return: A DataFrame with the columns, COUNT and optionally WEIGHTED COUNT, sorted by the columns.
+        """
+        if weight_col is not None and weight_col not in self.data.columns:
+            raise ValueError(f"The weight column '{weight_col}' does not exist.")
+        weights = None if weight_col is None else self._column_values(weight_col)
+        return self._crosstab_long(columns, exclude_zeros=exclude_zeros, exclude_equal=exclude_equal,
+                                   weights=weights)
+
+    def freq_2way(self, col_name_1, col_name_2, exclude_equal=False, weight_col=None):
+        """
+        Print the two-way frequency table of two columns in long format, one row per observed pair of
+        values, with missing values shown as 'NaN'. The table is counted with one np.bincount over a
+        combined integer key (see _crosstab_long); the data are not changed.
+
+        :param col_name_1: The name of the first column.
+        :param col_name_2: The name of the second column.
+        :param exclude_equal: Optional. Whether to leave out rows where the two values are equal.
+        :param weight_col: Optional. The name of a weight column; adds the weighted count of each pair.
+        """
+        weights = None
+        if weight_col:
+            weights = self._weights(weight_col)
+            if weights is None:
+                return
+
+        # ordered like the melted crosstab: by the second column, then the first
+        melted_crosstab = self._crosstab_long([col_name_2, col_name_1], exclude_equal=exclude_equal,
+                                              weights=weights)
+        melted_crosstab = melted_crosstab[[col_name_1, col_name_2] + list(melted_crosstab.columns[2:])]
+
+        title = f"Two-way Frequency Table for {col_name_1} and {col_name_2}"
+        if exclude_equal:
+            title += " (Unequal Values Only)"
+        if weight_col:
+            title += " (Weighted)"
+
+        # Print results using tabulate for better formatting
+        print("---------", title, "----------")
+        print(
+            tabulate(melted_crosstab,
+                     headers='keys',
+                     tablefmt='grid',
+                     showindex=False))
+        print("")
+
+    def freq_multiway(self, columns, exclude_zeros=True, exclude_equal=False, weight_col=None):
+        """
+        Print the multi-way frequency table of several columns in long format, sorted by the columns,
+        with missing values shown as 'NaN'. The table is counted with one np.bincount over a combined
+        integer key (see _crosstab_long); the data are not changed.
+
+        :param columns: A list of column names to be included in the multi-way frequency table.
+        :param exclude_zeros: Optional. Whether to exclude rows where the count is zero.
+        :param exclude_equal: Optional. Whether to exclude rows where all values in the columns are equal.
+        :param weight_col: Optional. The name of a weight column; adds the weighted count of each combination.
+        """
+        weights = None
+        if weight_col:
+            weights = self._weights(weight_col)
+            if weights is None:
+                return
+
+        melted_crosstab = self._crosstab_long(columns, exclude_zeros=exclude_zeros, exclude_equal=exclude_equal,
+                                              weights=weights)
+
+        # Print results using tabulate for better formatting
+        title = f"Multi-way Frequency Table for {' ,'.join(columns)}"
+        if exclude_equal:
+            title += " (Non-equal Values Only)"
+        if weight_col:
+            title += " (Weighted)"
+        print("---------", title, "----------")
+        print(
+            tabulate(melted_crosstab,
+                     headers='keys',
+                     tablefmt='grid',
+                     showindex=False))
+        print("")
+
+    # condition strings compiled by _compile_condition, shared by all DataToolBox instances
+    _compiled_conditions = {}
+
+    @staticmethod
+    def _compile_condition(condition):
+        """
+        Compile a condition string in pandas query/eval syntax into Python code that evaluates it on
+        NumPy arrays. As in pandas, & | ~ act as and/or/not with the lowest precedence, so
+        'CIT == 1 | CIT == 2' means '(CIT == 1) | (CIT == 2)'.
+
+        :param condition: The condition string.
+        :return: A tuple of the code object, the set of names it reads, if the condition only compares
+                 columns with numbers (combined with & | ~), the list of those numbers (otherwise None),
+                 and whether it can be evaluated on NumPy arrays (False if it uses attributes, subscripts
+                 or function calls, e.g. AGEP.isna() or SERIALNO.str[4:6], which need pandas Series).
+        """
+        if condition in DataToolBox._compiled_conditions:
+            return DataToolBox._compiled_conditions[condition]
+
+        # rewrite the pandas boolean operators as Python keywords so the parser gets precedence right
+        replacements = {'&': 'and', '|': 'or', '~': 'not'}
+        tokens = []
+        for token in tokenize.generate_tokens(io.StringIO(condition).readline):
+            if token.type == tokenize.OP and token.string in replacements:
+                tokens.append((tokenize.NAME, replacements[token.string]))
+            else:
+                tokens.append((token.type, token.string))
+        tree = ast.parse(tokenize.untokenize(tokens).strip(), mode='eval')
+
+        class ToArrayOperators(ast.NodeTransformer):
+            # and/or/not/chained comparisons/in do not work element-wise on arrays; use & | ~ and np.isin
+            def visit_BoolOp(self, node):
+                self.generic_visit(node)
+                op = ast.BitAnd() if isinstance(node.op, ast.And) else ast.BitOr()
+                result = node.values[0]
+                for value in node.values[1:]:
+                    result = ast.BinOp(left=result, op=op, right=value)
+                return result
+
+            def visit_UnaryOp(self, node):
+                self.generic_visit(node)
+                if isinstance(node.op, ast.Not):
+                    return ast.UnaryOp(op=ast.Invert(), operand=node.operand)
+                return node
+
+            def visit_Compare(self, node):
+                self.generic_visit(node)
+                parts = []
+                left = node.left
+                for op, right in zip(node.ops, node.comparators):
+                    if isinstance(op, (ast.In, ast.NotIn)):
+                        part = ast.Call(func=ast.Name(id='_isin', ctx=ast.Load()), args=[left, right], keywords=[])
+                        if isinstance(op, ast.NotIn):
+                            part = ast.UnaryOp(op=ast.Invert(), operand=part)
+                    else:
+                        part = ast.Compare(left=left, ops=[op], comparators=[right])
+                    parts.append(part)
+                    left = right
+                result = parts[0]
+                for part in parts[1:]:
+                    result = ast.BinOp(left=result, op=ast.BitAnd(), right=part)
+                return result
+
+        def comparison_constants(node):
+            # numbers compared with a column, or None if the condition does anything else
+            if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.BitAnd, ast.BitOr)):
+                left, right = comparison_constants(node.left), comparison_constants(node.right)
+                return None if left is None or right is None else left + right
+            if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Invert):
+                return comparison_constants(node.operand)
+            if isinstance(node, ast.Compare):
+                sides = [node.left, node.comparators[0]]
+            elif isinstance(node, ast.Call):
+                sides = node.args
+            else:
+                return None
+            others = [side for side in sides if not isinstance(side, ast.Name)]
+            if len(others) != 1:
+                return None
+            try:
+                value = ast.literal_eval(others[0])
+            except ValueError:
+                return None
+            values = list(value) if isinstance(value, (list, tuple, set)) else [value]
+            if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values):
+                return None
+            return values
+
+        tree = ast.fix_missing_locations(ToArrayOperators().visit(tree))
+        # Series methods and accessors (AGEP.isna(), AGEP.between(18, 64), SERIALNO.str[4:6]) and function
+        # calls do not work on NumPy arrays; those conditions are evaluated on the columns as Series
+        on_arrays = not any(
+            isinstance(node, (ast.Attribute, ast.Subscript)) or (
+                isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id == '_isin'))
+            for node in ast.walk(tree))
+        names = {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)} - {'_isin'}
+        compiled = (compile(tree, '<condition>', 'eval'), names,
+                    comparison_constants(tree.body) if on_arrays else None, on_arrays)
+        DataToolBox._compiled_conditions[condition] = compiled
+        return compiled
+
+    def _column_values(self, col_name):
+        """
+        Return a column as a NumPy array, with missing values of nullable integer columns as NaN.
+        """
+        series = self.data[col_name]
+        if pd.api.types.is_extension_array_dtype(series) and series.hasnans:
+            return series.to_numpy(dtype='float64', na_value=np.nan)
+        return series.to_numpy()
+
+    def _eval_conditions(self, conditions_str, arrays=None):
+        """
+        Evaluate a list of condition strings into boolean NumPy arrays. Every referenced column is
+        converted to an array once, however many conditions use it. Conditions using Series methods or
+        accessors (e.g. AGEP.isna(), SERIALNO.str[4:6] == 'GQ') are evaluated on the columns as Series,
+        and conditions that cannot be compiled (e.g. ones using @variables) fall back to DataFrame.eval.
+
+        :param conditions_str: A list of condition strings.
+        :param arrays: Optional. A dict of column name -> NumPy array shared between calls; columns
+                       are added to it as they are converted.
+        """
+        if arrays is None:
+            arrays = {}
+        results = []
+        for condition in conditions_str:
+            try:
+                code, names, _, on_arrays = self._compile_condition(condition)
+            except SyntaxError:
+                code, names, on_arrays = None, set(), True
+
+            if code is not None and on_arrays and all(name in arrays or name in self.data.columns
+                                                      for name in names):
+                for name in names - set(arrays):
+                    arrays[name] = self._column_values(name)
+                result = eval(code, {'__builtins__': {}, '_isin': np.isin}, arrays)
+            elif code is not None and all(name in arrays or name in self.data.columns for name in names):
+                # the same arrays as Series, so missing values compare as NaN on both paths
+                for name in names - set(arrays):
+                    arrays[name] = self._column_values(name)
+                result = eval(code, {'__builtins__': {}, '_isin': np.isin},
+                              {name: pd.Series(arrays[name], index=self.data.index, copy=False) for name in names})
+            else:
+                result = self.data.eval(condition)
+
+            if isinstance(result, pd.Series):
+                result = result.to_numpy(dtype=bool, na_value=False)
+            # masked values (see mark_missing) are missing in the data, so they are evaluated as NaN:
+            # 'POVPIP <= 99' fails on them, 'POVPIP.isna()' and 'SRH != 1' hold
+            results.append(np.broadcast_to(np.asarray(result, dtype=bool), (len(self.data),)))
+        return results
+
+    # largest code range of an integer column that is recoded through a lookup array
+    LOOKUP_MAX_RANGE = 2 ** 16
+
+    def _lookup_values(self, conditions_str, choices, default, arrays):
+        """
+        Recode a single column through a precomputed table instead of evaluating the conditions on
+        every row. The conditions are evaluated once on the possible values and the rows are then
+        looked up in one pass:
+        - integer codes with a small range (e.g. SCHL 1-24, RAC1P 1-9) index a lookup array directly;
+        - otherwise, if the conditions only compare the column with numbers (e.g. POVPIP bands),
+          np.searchsorted buckets the values between those numbers.
+
+        :return: A NumPy array of the new values, or None if the conditions read more than one column,
+                 a choice refers to another column, or the conditions are not plain comparisons.
+        """
+        try:
+            compiled = [self._compile_condition(condition) for condition in conditions_str]
+        except SyntaxError:
+            return None
+        if not all(on_arrays for _, _, _, on_arrays in compiled):
+            return None
+        names = set().union(*(names for _, names, _, _ in compiled))
+        if len(names) != 1:
+            return None
+        source = names.pop()
+        if source not in arrays and source not in self.data.columns:
+            return None
+        for choice in list(choices) + [default]:
+            if isinstance(choice, str) and choice != source and (choice in arrays or choice in self.data.columns):
+                return None
+        if source not in arrays:
+            arrays[source] = self._column_values(source)
+        values = arrays[source]
+
+        def select_on(domain):
+            # data_construct on an array of possible values of the source column
+            condlist = [np.broadcast_to(np.asarray(eval(code, {'__builtins__': {}, '_isin': np.isin}, {source: domain}),
+                                                   dtype=bool), domain.shape)
+                        for code, _, _, _ in compiled]
+            choicelist = [domain if isinstance(choice, str) and choice == source else choice
+                          for choice in choices]
+            return np.select(condlist, choicelist,
+                             default=domain if isinstance(default, str) and default == source else default)
+
+        if values.dtype.kind in 'iu' and values.size:
+            low, high = int(values.min()), int(values.max())
+            if high - low <= self.LOOKUP_MAX_RANGE:
+                table = select_on(np.arange(low, high + 1, dtype='int64'))
+                index = values.astype(np.intp)
+                index -= low
+                return table[index]
+
+        constants = [compiled_constants for _, _, compiled_constants, _ in compiled]
+        if values.dtype.kind not in 'iuf' or any(c is None for c in constants) or \
+                source in choices or source == default:
+            return None
+
+        # the conditions are constant between (and at) the compared numbers: evaluate them once per cell,
+        # where cell 2i+1 is breakpoint i and cells 2i are the open intervals around it
+        breakpoints = np.unique(np.array([c for cs in constants for c in cs], dtype='float64'))
+        if breakpoints.size:
+            interiors = np.concatenate([[breakpoints[0] - 1],
+                                        (breakpoints[:-1] + breakpoints[1:]) / 2,
+                                        [breakpoints[-1] + 1]])
+        else:
+            interiors = np.array([0.0])
+        representatives = np.empty(2 * breakpoints.size + 1)
+        representatives[0::2] = interiors
+        representatives[1::2] = breakpoints
+        table = select_on(representatives)
+
+        position = np.searchsorted(breakpoints, values, side='left')
+        exact = np.zeros(len(values), dtype=bool)
+        inside = position < breakpoints.size
+        exact[inside] = breakpoints[position[inside]] == values[inside]
+        result = table[2 * position + exact]
+
+        missing = np.isnan(values) if values.dtype.kind == 'f' else None
+        if missing is not None and missing.any():
+            result = np.where(missing, select_on(np.array([np.nan]))[0], result)
+        return result
+
+    def _construct_values(self, conditions_str, choices, default=-1, arrays=None):
+        """
+        Compute the values of a data_construct column as a Series with a compact integer dtype,
+        without adding it to the data.
+        """
+        if arrays is None:
+            arrays = {}
+
+        values = self._lookup_values(conditions_str, choices, default, arrays)
+        if values is not None:
+            return compact_series(pd.Series(values, index=self.data.index))
+
+        condlist = self._eval_conditions(conditions_str, arrays)
+
+        def resolve(choice):
+            # column references are taken as arrays, so no index alignment is needed
+            if isinstance(choice, str) and (choice in arrays or choice in self.data.columns):
+                if choice not in arrays:
+                    arrays[choice] = self._column_values(choice)
+                return arrays[choice]
+            return choice
+
+        values = np.select(condlist,
+                           [resolve(choice) for choice in choices],
+                           default=resolve(default))
+        return compact_series(pd.Series(values, index=self.data.index))
+
+    def data_construct(self, col_name, conditions_str, choices, default=-1):
+        """
+        Construct a new column in the data based on multiple conditions,
+        where choices can be either fixed values or column references.
+        Stop checking further conditions once a true condition is met for a row.
+
+        The conditions are compiled once and evaluated together in a single np.select pass,
+        and the new column is stored with the smallest integer dtype that holds its values.
+
+        :param col_name: Name of the new column to be added.
+        :param conditions_str: A list of conditions (as strings) that determine the value to be assigned.
+        :param choices: A list of values or column names to be assigned based on the conditions.
+        :param default: The default value or column name to be assigned if none of the conditions are met. Default is -1.
+        :raises ValueError: If there is not exactly one choice per condition.
+        """
+        self._check_choices(col_name, conditions_str, choices)
+        if self.lazy:
+            self._plan.append(('construct', col_name, list(conditions_str), list(choices), default))
+            return
+        values = self._construct_values(conditions_str, choices, default)
+        self._writable()[col_name] = values
+        self._missing.pop(col_name, None)
+
+    @staticmethod
+    def _check_choices(col_name, conditions_str, choices):
+        """
+        Raise a ValueError naming the variable unless a recode has exactly one choice per condition.
+        """
+        if len(conditions_str) != len(choices):
+            raise ValueError(f"'{col_name}' has {len(conditions_str)} conditions but {len(choices)} choices; "
+                             f"every condition needs exactly one choice.")
+
+    def _map_values(self, source_col, mapping, default=-1, arrays=None):
+        """
+        Compute the values of a data_map column without adding it to the data.
+        """
+        if arrays is None:
+            arrays = {}
+        if source_col not in arrays:
+            arrays[source_col] = self._column_values(source_col)
+        values = arrays[source_col]
+
+        keys = np.array(sorted(mapping))
+        mapped = np.array([mapping[key] for key in keys])
+        if values.dtype.kind in 'iu' and keys.dtype.kind in 'iu' and values.size:
+            low = min(int(values.min()), int(keys.min()))
+            high = max(int(values.max()), int(keys.max()))
+            if high - low <= self.LOOKUP_MAX_RANGE:
+                table = np.full(high - low + 1, default, dtype=np.result_type(mapped, np.asarray(default)))
+                table[keys - low] = mapped
+                index = values.astype(np.intp)
+                index -= low
+                return compact_series(pd.Series(table[index], index=self.data.index))
+
+        position = np.minimum(np.searchsorted(keys, values), max(len(keys) - 1, 0))
+        found = keys[position] == values if len(keys) else np.zeros(len(values), dtype=bool)
+        result = np.where(found, mapped[position] if len(keys) else default, default)
+        return compact_series(pd.Series(result, index=self.data.index))
+
+    def data_map(self, col_name, source_col, mapping, default=-1):
+        """
+        Construct a new column by mapping the codes of a source column, e.g. {1: 1, 2: 1, 3: 2, 4: 2}.
+        Small integer codes are looked up in a precomputed array in one pass; other codes are matched
+        with a binary search.
+
+        :param col_name: Name of the new column to be added.
+        :param source_col: The name of the column holding the codes.
+        :param mapping: A dict of source code -> new value.
+        :param default: The value assigned to codes that are not in the mapping. Default is -1.
+        """
+        if self.lazy:
+            self._plan.append(('map', col_name, source_col, dict(mapping), default))
+            return
+        values = self._map_values(source_col, mapping, default)
+        self._writable()[col_name] = values
+        self._missing.pop(col_name, None)
+
+    def apply_recodes(self, recodes, dataset):
+        """
+        Build all variables of a recode specification (see constructed_variables.RECODES) for one dataset.
+        Each source column is converted to an array once and shared by every recode that reads it,
+        so the whole specification costs about one pass over the source columns.
+
+        :param recodes: A dict of new column name -> {dataset name: rule}, where a rule is
+                        {'copy': source column},
+                        {'source': source column, 'mapping': {code: value}, 'default': -1} as in data_map, or
+                        {'conditions': [...], 'choices': [...], 'default': -1} as in data_construct.
+        :param dataset: The dataset name used in the specification, e.g. 'acs' or 'chis'.
+        :raises ValueError: If a rule does not have exactly one choice per condition; nothing is built then.
+        """
+        for col_name, spec in recodes.items():
+            if dataset in spec and 'conditions' in spec[dataset]:
+                self._check_choices(col_name, spec[dataset]['conditions'], spec[dataset]['choices'])
+        if self.lazy:
+            names = []
+            for col_name, spec in recodes.items():
+                if dataset not in spec:
+                    continue
+                rule = spec[dataset]
+                if 'copy' in rule:
+                    self._plan.append(('copy', col_name, rule['copy']))
+                elif 'mapping' in rule:
+                    self._plan.append(('map', col_name, rule['source'], dict(rule['mapping']),
+                                       rule.get('default', -1)))
+                else:
+                    self._plan.append(('construct', col_name, list(rule['conditions']), list(rule['choices']),
+                                       rule.get('default', -1)))
+                names.append(col_name)
+            self._plan.append(('recodes', dataset, names))
+            return
+
+        arrays = {}
+        built = []
+        data = self._writable()
+        for col_name, spec in recodes.items():
+            if dataset not in spec:
+                continue
+            rule = spec[dataset]
+
+            if 'copy' in rule:
+                if rule['copy'] not in data.columns:
+                    print(f"Error: The column '{rule['copy']}' does not exist in the DataFrame.")
+                    continue
+                data[col_name] = data[rule['copy']]
+                self._copy_missing(rule['copy'], col_name)
+            elif 'mapping' in rule:
+                data[col_name] = self._map_values(rule['source'], rule['mapping'],
+                                                  rule.get('default', -1), arrays)
+            else:
+                data[col_name] = self._construct_values(rule['conditions'], rule['choices'],
+                                                        rule.get('default', -1), arrays)
+            if 'copy' not in rule:
+                self._missing.pop(col_name, None)
+            # later recodes may refer to this column, possibly replacing a cached source array
+            arrays.pop(col_name, None)
+            built.append(col_name)
+
+        print("---------Recodes--------------------")
+        print(f"{len(built)} variables constructed for {dataset}: {built}")
+        print("")
+
+    def copy_column(self, source_col, target_col):
+        """
+        Copies the values from one column to another, preserving the original column.
+
+        :param source_col: The name of the source column whose values are to be copied.
+        :param target_col: The name of the target column to which the values will be copied.
+        """
+        if self.lazy:
+            self._plan.append(('copy', target_col, source_col))
+            return
+        if source_col in self.data.columns:
+            # the Series is shared, not copied; replacing either column later does not affect the other
+            self._writable()[target_col] = self._data[source_col]
+            self._copy_missing(source_col, target_col)
+            print(
+                f"Values from '{source_col}' were successfully copied to '{target_col}'.")
+        else:
+            print(
+                f"Error: The column '{source_col}' does not exist in the DataFrame.")
+    def fill_all_nans(self, fill_value):
+        """
+        Replace NaN values across all columns of the DataFrame with a specified value.
+
+        :param fill_value: The value to use for replacing NaNs across all columns.
+        """
+        if self.lazy:
+            self._plan.append(('fill', fill_value))
+            return
+        self._fill_nans(fill_value)
+        print(f"All NaN values have been replaced with {fill_value}.")
+
+    def _fill_nans(self, fill_value):
+        """
+        Replace NaN values with fill_value in the columns that have any. Only those columns are
+        replaced (by filled copies); the others, and the caller's frame, are left as they are.
+        """
+        data = self._writable()
+        for col in [col for col in data.columns if data[col].hasnans]:
+            series = data[col]
+            if isinstance(series.dtype, pd.CategoricalDtype) and fill_value not in series.cat.categories:
+                series = series.cat.add_categories([fill_value])
+            data[col] = series.fillna(fill_value)
+            self._missing.pop(col, None)
+        
+    # special-missing codes of the CHIS files (and their labels in ADULT_PROC_FORMAT.SAS)
+    MISSING_CODES = {
+        -1: 'INAPPLICABLE',
+        -7: 'REFUSED',
+        -8: "DON'T KNOW",
+        -9: 'NOT ASCERTAINED',
+    }
+
+    def mark_missing(self, columns=None, codes=None, nan_reason=-9):
+        """
+        Mask the special-missing codes and NaN values of numeric columns instead of filling them. Masked
+        values become missing (the columns become nullable integers), and the reason of each one (its
+        code, or nan_reason for a NaN) is kept next to the data. Nothing else is touched:
+        - conditions see a masked value as missing: a comparison with a code fails, so the value gets
+          the recode's default (-1) instead of e.g. a -9 passing 'POVPIP <= 99', while 'POVPIP.isna()'
+          and 'SRH != 1' hold;
+        - copies of a masked column (copy_column, 'copy' recodes) keep its mask;
+        - frequency tables count masked values as missing;
+        - fill_missing writes values back only where it is asked to.
+
+        :param columns: Optional. The columns to mark. Default is every numeric column.
+        :param codes: Optional. The special-missing codes. Default is MISSING_CODES (-1, -7, -8, -9);
+                      an empty list masks NaN values only.
+        :param nan_reason: Optional. The reason code of NaN values. Default is -9.
+        """
+        codes = list(self.MISSING_CODES) if codes is None else list(codes)
+        if self.lazy:
+            self._plan.append(('mark', None if columns is None else list(columns), codes, nan_reason))
+            return
+        self._mark_missing(columns, codes, nan_reason)
+
+    def _mark_missing(self, columns, codes, nan_reason):
+        data = self._writable()
+        if columns is None:
+            columns = list(data.columns)
+        marked = []
+        for col in columns:
+            if col not in data.columns or not (pd.api.types.is_integer_dtype(data[col])
+                                               or pd.api.types.is_float_dtype(data[col])):
+                continue
+            values = self._column_values(col)
+            nan = np.isnan(values) if values.dtype.kind == 'f' else np.zeros(len(values), dtype=bool)
+            coded = np.isin(values, codes) if codes else np.zeros(len(values), dtype=bool)
+            masked = nan | coded
+            if not masked.any():
+                continue
+
+            reasons = np.zeros(len(values), dtype='int8')
+            reasons[coded] = values[coded]
+            reasons[nan] = nan_reason
+            if col in self._missing:
+                # values masked before keep their first reason
+                previous = self._missing[col]
+                before = pd.notna(previous)
+                reasons[before] = previous.to_numpy(dtype='int8', na_value=0)[before]
+            self._missing[col] = pd.arrays.IntegerArray(reasons, ~masked)
+            if coded.any():
+                data[col] = compact_series(data[col].mask(coded), nullable=True)
+            marked.append(col)
+
+        print("---------Special Missing------------")
+        print(f"{len(marked)} columns with masked values: {marked}")
+        print("")
+
+    def fill_missing(self, fill_value=None, columns=None):
+        """
+        Fill the values masked by mark_missing, in the requested columns only, and unmask them.
+
+        :param fill_value: Optional. The value for every masked value. Default is each value's reason code,
+                           i.e. the special-missing codes are written back.
+        :param columns: Optional. The columns to fill. Default is every masked column.
+        """
+        if self.lazy:
+            self._plan.append(('fill_missing', fill_value, None if columns is None else list(columns)))
+            return
+        self._fill_missing(fill_value, columns)
+
+    def _fill_missing(self, fill_value, columns):
+        columns = [col for col in (self._missing if columns is None else columns) if col in self._missing]
+        if not columns:
+            return
+        data = self._writable()
+        for col in columns:
+            reasons = self._missing.pop(col)
+            if col not in data.columns:
+                continue
+            masked = pd.notna(reasons)
+            fill = reasons.to_numpy(dtype='float64', na_value=np.nan) if fill_value is None else fill_value
+            values = self._column_values(col).astype('float64')
+            data[col] = compact_series(pd.Series(np.where(masked, fill, values), index=data.index))
+        print(f"Masked values of {columns} have been replaced with "
+              f"{'their reason codes' if fill_value is None else fill_value}.")
+
+    def missing_summary(self, columns=None):
+        """
+        Return the number of values masked by mark_missing per column and reason code.
+
+        :param columns: Optional. The columns to report. Default is every masked column.
+        :return: A DataFrame with Variable, Reason, Label and Count.
+        """
+        if self._plan:
+            self.collect()
+        rows = []
+        for col in (self._missing if columns is None else columns):
+            if col not in self._missing:
+                continue
+            counts = pd.Series(self._missing[col]).value_counts(dropna=True).sort_index()
+            rows.extend((col, int(reason), self.MISSING_CODES.get(int(reason), ''), int(count))
+                        for reason, count in counts.items())
+        return pd.DataFrame(rows, columns=['Variable', 'Reason', 'Label', 'Count'])
+
+    def _copy_missing(self, source_col, target_col):
+        """
+        Give a copied column the mask of its source (see mark_missing).
+        """
+        if source_col in self._missing:
+            self._missing[target_col] = self._missing[source_col]
+        else:
+            self._missing.pop(target_col, None)
+
+    def _take_missing(self, positions):
+        """
+        Keep the masks aligned with the data after the rows at positions were kept.
+        """
+        self._missing = {col: reasons.take(positions) for col, reasons in self._missing.items()}
+
+    def select_columns(self, col_list=None, prefixes=None):
+        """
+        Selects columns based on a list or common prefixes and updates the dataset.
+
+        :param col_list: A list of column names to be retained in the dataset.
+        :param prefixes: A list of common prefixes for column names to be retained. If both col_list and prefixes are provided,
+                         columns that either match the list or any of the prefixes are retained.
+        """
+        if self.lazy:
+            self._plan.append(('select', list(col_list or []), list(prefixes or [])))
+            return
+        cols_to_keep = set()
+
+        if col_list:
+            # Add columns from col_list to the set of columns to keep
+            cols_to_keep.update(col_list)
+
+        if prefixes:
+            # Add columns that start with any of the provided prefixes
+            for prefix in prefixes:
+                cols_to_keep.update(col for col in self.data.columns if col.startswith(prefix))
+
+        if not cols_to_keep:
+            # If neither col_list nor prefixes are provided, or no columns match, raise an error
+            raise ValueError("Either col_list or prefixes must be provided, and they must match existing columns.")
+
+        # Filter the dataframe to only keep the selected columns
+        self._data = self.data[list(cols_to_keep)]
+        self._owned = True
+        self._missing = {col: reasons for col, reasons in self._missing.items() if col in cols_to_keep}
+        print(f"Data now contains only the selected columns: {list(cols_to_keep)}")
+        
+    def optimize_dtypes(self, columns=None, max_category_share=0.5, display=True):
+        """
+        Downcast the columns to compact dtypes, so the frequency methods and exports read less memory:
+        - whole-number columns (codes such as AGEP or SCHL, the sc_ recodes, integer weights) get the
+          smallest integer dtype, nullable if they have missing values;
+        - other float columns (e.g. RAKEDW0-RAKEDW80) become float32 if every value is exactly a float32;
+        - text columns with fewer distinct values than max_category_share of the rows become categoricals.
+        Identifier columns (data_loader.KEY_COLUMNS, e.g. SERIALNO) and columns whose dtype does not
+        change are left as they are.
+
+        :param columns: Optional. The columns to downcast. Default is every column.
+        :param max_category_share: Optional. The share of rows below which text columns become categoricals.
+        :param display: Optional. Whether to print the memory saved.
+        :return: A DataFrame with the Variable, its dtype Before and After, and its Bytes Before and After,
+                 one row per changed column.
+        """
+        data = self.data
+        columns = [col for col in (data.columns if columns is None else columns) if col in data.columns]
+
+        changed = {}
+        for col in columns:
+            series = data[col]
+            if pd.api.types.is_bool_dtype(series) or col in KEY_COLUMNS:
+                continue
+            if pd.api.types.is_integer_dtype(series) or pd.api.types.is_float_dtype(series):
+                new = compact_series(series)
+                if pd.api.types.is_float_dtype(new) and new.dtype != 'float32':
+                    values = new.to_numpy(dtype='float64', na_value=np.nan)
+                    narrow = values.astype('float32')
+                    if np.array_equal(narrow.astype('float64'), values, equal_nan=True):
+                        new = pd.Series(narrow, index=series.index, name=series.name)
+            elif series.dtype == object and series.nunique(dropna=True) < max_category_share * max(len(series), 1):
+                new = series.astype('category')
+            else:
+                continue
+            if new.dtype != series.dtype:
+                changed[col] = new
+
+        rows = []
+        if changed:
+            data = self._writable()
+            for col, new in changed.items():
+                rows.append((col, str(data[col].dtype), str(new.dtype),
+                             int(data[col].memory_usage(index=False, deep=True)),
+                             int(new.memory_usage(index=False, deep=True))))
+                data[col] = new
+        report = pd.DataFrame(rows, columns=['Variable', 'Before', 'After', 'Bytes Before', 'Bytes After'])
+
+        if display:
+            saved = int((report['Bytes Before'] - report['Bytes After']).sum())
+            total = int(self._data.memory_usage(index=False, deep=True).sum())
+            print("---------Dtype Optimization---------")
+            print(f"{len(report)} columns downcast: {list(report['Variable'])}")
+            print(f"{saved / 2 ** 20:.1f} MB saved; the data now take {total / 2 ** 20:.1f} MB")
+            print("")
+        return report
+
+    def _optimize_plan(self, plan, columns):
+        """
+        Optimize a lazy plan before it runs:
+        - select_columns steps are resolved against the columns that exist at that point;
+        - recodes whose column is neither read by a later step nor kept by select_columns are dropped;
+        - filters move ahead of the recodes they do not read (and of the select_columns steps that keep
+          every column they read), so recodes only run on the kept rows
+          and consecutive filters become one row selection;
+        - the source columns the plan reads or keeps are worked out, so that every other column is
+          dropped before the first step (projection pushdown).
+
+        :param plan: The recorded steps.
+        :param columns: The columns of the data the plan starts from.
+        :return: A tuple of the optimized steps and the set of source columns needed (None for all).
+        """
+        # forward: the columns each step reads and writes (reads is None if unknown)
+        schema = list(columns)
+        seen = set(columns)
+        steps = []
+        for step in plan:
+            kind = step[0]
+            reads, writes = set(), set()
+            if kind == 'filter':
+                try:
+                    names = expression_columns([step[1]])
+                    reads = names & set(schema)
+                    if names & (seen - set(schema)):
+                        # the filter reads a column an earlier select_columns dropped; it stays where it
+                        # is, so it fails as it would in eager mode
+                        reads = None
+                except SyntaxError:
+                    reads = None
+            elif kind == 'construct':
+                _, col_name, conditions_str, choices, default = step
+                try:
+                    reads = expression_columns(conditions_str)
+                except SyntaxError:
+                    reads = set(schema)
+                reads = (reads | {choice for choice in choices + [default] if isinstance(choice, str)}) & set(schema)
+                writes = {col_name}
+            elif kind in ('map', 'copy'):
+                reads, writes = {step[2]}, {step[1]}
+            elif kind == 'select':
+                _, col_list, prefixes = step
+                cols_to_keep = set(col_list)
+                cols_to_keep.update(col for col in schema if any(col.startswith(prefix) for prefix in prefixes))
+                if not cols_to_keep:
+                    raise ValueError("Either col_list or prefixes must be provided, and they must match existing columns.")
+                step = ('select', cols_to_keep)
+                reads = cols_to_keep
+                schema = [col for col in schema if col in cols_to_keep]
+            schema.extend(col for col in writes if col not in schema)
+            seen.update(writes)
+            steps.append((step, reads, writes))
+
+        # backward: drop dead recodes and collect the columns that are live before each step
+        live = None
+        kept = []
+        for step, reads, writes in reversed(steps):
+            kind = step[0]
+            if kind == 'select':
+                live = set(step[1]) if live is None else live & step[1]
+            elif writes:
+                if live is not None and not writes & live:
+                    continue
+                if live is not None:
+                    live = (live - writes) | reads
+            elif kind == 'filter' and live is not None:
+                live = None if reads is None else live | reads
+            kept.append((step, reads, writes))
+        kept.reverse()
+
+        # move every filter ahead of the steps that do not write a column it reads
+        optimized = []
+        for step, reads, writes in kept:
+            position = len(optimized)
+            if step[0] == 'filter' and reads is not None:
+                while position and optimized[position - 1][0][0] in ('construct', 'map', 'copy', 'recodes', 'select') \
+                        and not optimized[position - 1][2] & reads:
+                    position -= 1
+            optimized.insert(position, (step, reads, writes))
+
+        needed = None if live is None else live & set(columns)
+        return [step for step, _, _ in optimized], needed
+
+    def collect(self):
+        """
+        Run the plan recorded by a lazy DataToolBox and return the data. The plan is optimized first
+        (see _optimize_plan): only the columns the plan needs are carried, dead recodes are skipped, and
+        consecutive filters are evaluated together and applied with one row selection. Recodes share
+        their source arrays as in apply_recodes. Reading data (return_data, export_data, the frequency
+        methods) calls collect automatically.
+
+        :return: The resulting pandas DataFrame.
+        """
+        plan, self._plan = self._plan, []
+        if not plan:
+            return self._data
+        plan, needed = self._optimize_plan(plan, list(self._data.columns))
+        if needed is not None and len(needed) < self._data.shape[1]:
+            self._data = self._data[[col for col in self._data.columns if col in needed]]
+            self._owned = True
+
+        arrays = {}
+        built = set()
+        i = 0
+        while i < len(plan):
+            step = plan[i]
+            kind = step[0]
+            if kind == 'filter':
+                keep = np.ones(len(self._data), dtype=bool)
+                while i < len(plan) and plan[i][0] == 'filter':
+                    condition = plan[i][1]
+                    total = int(keep.sum())
+                    keep &= self._eval_conditions([condition], arrays)[0]
+                    print_filter(condition, total - int(keep.sum()), total)
+                    self.filter_log.append((condition, total - int(keep.sum()), total))
+                    i += 1
+                if not keep.all():
+                    positions = np.flatnonzero(keep)
+                    self._data = self._data.take(positions)
+                    self._owned = True
+                    self._take_missing(positions)
+                    arrays = {}
+                continue
+
+            if kind == 'construct':
+                _, col_name, conditions_str, choices, default = step
+                values = self._construct_values(conditions_str, choices, default, arrays)
+                self._writable()[col_name] = values
+                self._missing.pop(col_name, None)
+            elif kind == 'map':
+                _, col_name, source_col, mapping, default = step
+                values = self._map_values(source_col, mapping, default, arrays)
+                self._writable()[col_name] = values
+                self._missing.pop(col_name, None)
+            elif kind == 'copy':
+                _, col_name, source_col = step
+                if source_col in self._data.columns:
+                    self._writable()[col_name] = self._data[source_col]
+                    self._copy_missing(source_col, col_name)
+                    if not any(col_name in later[2] for later in plan if later[0] == 'recodes'):
+                        print(f"Values from '{source_col}' were successfully copied to '{col_name}'.")
+                else:
+                    print(f"Error: The column '{source_col}' does not exist in the DataFrame.")
+            elif kind == 'recodes':
+                _, dataset, names = step
+                constructed = [name for name in names if name in built]
+                print("---------Recodes--------------------")
+                print(f"{len(constructed)} variables constructed for {dataset}: {constructed}")
+                print("")
+            elif kind == 'fill':
+                self._fill_nans(step[1])
+                arrays = {}
+                print(f"All NaN values have been replaced with {step[1]}.")
+            elif kind == 'mark':
+                self._mark_missing(*step[1:])
+                arrays = {}
+            elif kind == 'fill_missing':
+                self._fill_missing(*step[1:])
+                arrays = {}
+            elif kind == 'select':
+                cols_to_keep = step[1]
+                self._data = self._data[list(cols_to_keep)]
+                self._owned = True
+                self._missing = {col: reasons for col, reasons in self._missing.items() if col in cols_to_keep}
+                arrays = {col: values for col, values in arrays.items() if col in cols_to_keep}
+                print(f"Data now contains only the selected columns: {list(cols_to_keep)}")
+
+            if kind in ('construct', 'map', 'copy') and step[1] in self._data.columns:
+                # later steps may refer to this column, possibly replacing a cached source array
+                arrays.pop(step[1], None)
+                built.add(step[1])
+            i += 1
+        return self._data
+
+    # compressors of the compressed CSV targets; each compresses one block of rows into a stream of its
+    # own, and concatenated streams are still one valid file for gzip, bz2 and xz readers (and pandas)
+    CSV_COMPRESSORS = {
+        'gzip': ('.gz', lambda raw: gzip.compress(raw, compresslevel=6)),
+        'bz2': ('.bz2', bz2.compress),
+        'xz': ('.xz', lzma.compress),
+    }
+
+    @staticmethod
+    def _ordered_map(func, items, n_jobs=None):
+        """
+        Apply func to the items in a thread pool and yield the results in order. At most 2 * n_jobs items
+        are in flight, so memory stays bounded however many items there are.
+        """
+        n_jobs = n_jobs or os.cpu_count() or 1
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            pending = collections.deque()
+            for item in items:
+                pending.append(pool.submit(func, item))
+                if len(pending) >= 2 * n_jobs:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def _export_frame(self, text_floats=False):
+        """
+        Return the data to export with whole-number columns in their smallest integer dtype (nullable if
+        they have missing values), so codes are written as 1 rather than 1.0 and stored as int8/int16.
+
+        :param text_floats: Optional. For the CSV and SQL targets: float32 columns are upcast to float64.
+                            optimize_dtypes only makes a column float32 when every value is exactly a float32,
+                            so the float64 values, their CSV text and the SQLite/DuckDB doubles are exactly
+                            the values before optimize_dtypes, and read back as the same float32. (The
+                            shortest float32 text, e.g. 0.309069 for 0.30906900763511658, would read back as
+                            a different value.) Parquet keeps float32.
+        """
+        data = self.data
+        narrow = {col: compact_series(data[col]) for col in data.columns}
+        if text_floats:
+            for col, series in narrow.items():
+                if series.dtype == 'float32':
+                    narrow[col] = series.astype('float64')
+        changed = [col for col in data.columns if narrow[col].dtype != data[col].dtype]
+        if not changed:
+            return data
+        data = data.copy(deep=False)
+        for col in changed:
+            data[col] = narrow[col]
+        return data
+
+    def _write_csv(self, data, file_path, compression=None, chunksize=100_000, append=False):
+        """
+        Write data to CSV in blocks of rows that are formatted, optionally compressed, and written one
+        after the other, so only one block of text is held at a time. With append, the rows are added to
+        the end of an existing file, without a header. (DataFrame.to_csv holds the GIL while formatting,
+        so a thread pool does not speed this up.)
+        """
+        compress = self.CSV_COMPRESSORS[compression][1] if compression else None
+
+        def encode(start):
+            block = data.iloc[start:start + chunksize]
+            raw = block.to_csv(index=False, header=start == 0 and not append).encode('utf-8')
+            return compress(raw) if compress else raw
+
+        starts = range(0, len(data), chunksize) if len(data) or append else [0]
+        with open(file_path, 'ab' if append else 'wb') as handle:
+            for start in starts:
+                handle.write(encode(start))
+
+    def _write_parquet(self, data, file_path, compression=None, chunksize=100_000, n_jobs=None, writer=None):
+        """
+        Write data to Parquet, one row group per block of rows. Blocks are converted to Arrow in parallel
+        by a thread pool and written in order; integer columns keep their narrow types. An open
+        pyarrow ParquetWriter can be given to add the rows to it (in its schema) instead of a new file.
+        """
+        # pyarrow is only needed for Parquet
+        import pyarrow as pa
+        import pyarrow.parquet as parquet
+
+        if writer is None:
+            schema = pa.Schema.from_pandas(data, preserve_index=False)
+            with parquet.ParquetWriter(file_path, schema, compression=compression or 'zstd') as writer:
+                self._write_parquet(data, file_path, compression, chunksize, n_jobs, writer)
+            return
+
+        def convert(start):
+            return pa.Table.from_pandas(data.iloc[start:start + chunksize], schema=writer.schema,
+                                        preserve_index=False, nthreads=1)
+
+        for table in self._ordered_map(convert, range(0, len(data), chunksize), n_jobs):
+            writer.write_table(table, row_group_size=chunksize)
+
+    @staticmethod
+    def _plain_frame(data):
+        """
+        Return data with only NumPy dtypes, for writers that do not know the pandas extension dtypes
+        (pyreadstat, pyreadr): nullable numbers become float64 with NaN (or stay integers without
+        missing values) and categoricals become their values.
+        """
+        plain = {}
+        for col in data.columns:
+            series = data[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                series = series.astype(series.cat.categories.dtype)
+            elif pd.api.types.is_extension_array_dtype(series) and pd.api.types.is_numeric_dtype(series):
+                if series.hasnans:
+                    series = series.astype('float64')
+                else:
+                    series = series.astype(series.dtype.numpy_dtype)
+            plain[col] = series
+        return pd.DataFrame(plain, index=data.index)
+
+    # columns indexed in the SQL export, so the harmonized data can be queried by area and category
+    SQL_INDEX_PREFIXES = ('PUMA', 'sc_')
+
+    def _write_sql(self, data, file_path, table_name, engine='sqlite', chunksize=100_000, append=False,
+                   create_indexes=True):
+        """
+        Load data into a table of a local database file and index its PUMA and sc_ columns.
+        - SQLite: the rows are inserted with executemany in batches of chunksize rows, in one transaction
+          with journaling and syncing off; the indexes are built after the load.
+        - DuckDB: the DataFrame is appended natively, column by column, without converting rows.
+        With append, the rows are added to an existing table; without create_indexes, no index is built
+        (e.g. until the last of several appends).
+        """
+        index_cols = [col for col in data.columns if col.startswith(self.SQL_INDEX_PREFIXES)]
+
+        def quote(name):
+            return '"' + str(name).replace('"', '""') + '"'
+
+        table = quote(table_name)
+        index_statements = [f"CREATE INDEX {quote(f'idx_{table_name}_{col}')} ON {table} ({quote(col)})"
+                            for col in index_cols] if create_indexes else []
+
+        if engine == 'duckdb':
+            # duckdb is only needed for DuckDB exports
+            import duckdb
+            con = duckdb.connect(file_path)
+            try:
+                con.register('export_frame', data)
+                if append:
+                    con.execute(f"INSERT INTO {table} SELECT * FROM export_frame")
+                else:
+                    con.execute(f"CREATE TABLE {table} AS SELECT * FROM export_frame")
+                con.unregister('export_frame')
+                for statement in index_statements:
+                    con.execute(statement)
+            finally:
+                con.close()
+            return
+
+        def sql_type(series):
+            if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+                return 'INTEGER'
+            if pd.api.types.is_float_dtype(series):
+                return 'REAL'
+            return 'TEXT'
+
+        con = sqlite3.connect(file_path)
+        try:
+            con.execute("PRAGMA journal_mode = OFF")
+            con.execute("PRAGMA synchronous = OFF")
+            if not append:
+                columns = ', '.join(f"{quote(col)} {sql_type(data[col])}" for col in data.columns)
+                con.execute(f"CREATE TABLE {table} ({columns})")
+            insert = f"INSERT INTO {table} VALUES ({', '.join('?' * data.shape[1])})"
+            with con:
+                for start in range(0, len(data), chunksize):
+                    block = data.iloc[start:start + chunksize]
+                    # Python objects with None for missing values, which sqlite3 stores as NULL
+                    values = [block[col].astype(object).where(block[col].notna(), None).tolist()
+                              for col in data.columns]
+                    con.executemany(insert, zip(*values))
+            with con:
+                for statement in index_statements:
+                    con.execute(statement)
+        finally:
+            con.close()
+
+    def export_data(self, file_name, format, include_freq_report=False, max_categories=None, folder_path=None,
+                    compression=None, chunksize=100_000, n_jobs=None, sql_engine='sqlite', freq_report_format='excel',
+                    value_labels=False):
+        """
+        Export the data to a specified format and optionally create a frequency report for each variable.
+        CSV and Parquet are written in blocks of rows (Parquet blocks are converted by a thread pool; see
+        _write_csv, _write_parquet), with whole-number columns in their smallest integer dtype. float32
+        columns (see optimize_dtypes) stay float32 in Parquet and are upcast to float64 for CSV and SQL, so
+        the exported values are exactly the values before optimize_dtypes (see _export_frame).
+
+        :param file_name: Name of the file without the extension.
+        :param format: Format of the file to save ('excel', 'csv', 'parquet', 'stata', 'r', 'spss', 'sql').
+        :param include_freq_report: Whether to include a frequency report as a separate file.
+        :param max_categories: Maximum number of categories to include in the frequency reports for each variable.
+        :param folder_path: The directory to save the file. If None, uses the current working directory.
+        :param compression: Optional. For 'csv': 'gzip', 'bz2' or 'xz' (default uncompressed). For 'parquet':
+                            a Parquet codec such as 'zstd' (default), 'snappy' or 'gzip'.
+        :param chunksize: Optional. The number of rows per block (per row group for Parquet). Default is 100,000.
+        :param n_jobs: Optional. The number of threads converting Parquet blocks. Default is the number of CPUs.
+        :param sql_engine: Optional. For 'sql': 'sqlite' (default, a .sqlite file) or 'duckdb' (a .duckdb file).
+                           The data go to a table named file_name, with indexes on the PUMA and sc_ columns.
+        :param freq_report_format: Optional. The format of the frequency report: 'excel' (default, one sheet
+                                   per variable), or 'csv' / 'parquet' (one long table of all variables).
+        :param value_labels: Optional. If True, the columns that have a SAS format in the toolbox's format
+                             catalog are written as their labels (categoricals, labeled once per distinct
+                             value). Stata and SPSS files keep the codes and store the labels as value labels.
+        """
+        if value_labels and self.formats is None:
+            raise ValueError("value_labels needs a format catalog (the formats argument of DataToolBox).")
+
+        # Define the file extension based on the format
+        extensions = {
+            'excel': '.xlsx',
+            'csv': '.csv',
+            'parquet': '.parquet',
+            'stata': '.dta',
+            'r': '.rds',
+            'spss': '.sav',
+            'sql': '.sqlite'  # a local database file; '.duckdb' with sql_engine='duckdb'
+        }
+
+        if format not in extensions:
+            raise ValueError("Unsupported file format specified.")
+        extension = extensions[format]
+        if format == 'sql':
+            if sql_engine not in ('sqlite', 'duckdb'):
+                raise ValueError(f"Unsupported SQL engine '{sql_engine}'.")
+            extension = '.' + sql_engine
+        if format == 'csv' and compression:
+            if compression not in self.CSV_COMPRESSORS:
+                raise ValueError(f"Unsupported CSV compression '{compression}'.")
+            extension += self.CSV_COMPRESSORS[compression][0]
+
+        full_file_path = self._export_path(file_name, extension, folder_path)
+
+        data = self._export_frame(text_floats=format != 'parquet') if format in ('csv', 'parquet', 'sql') else self.data
+        if value_labels and format != 'spss':
+            data = self._labeled_frame(data)
+
+        # Export data to the chosen format
+        if format == 'excel':
+            data.to_excel(full_file_path, index=False)
+        elif format == 'csv':
+            self._write_csv(data, full_file_path, compression, chunksize)
+        elif format == 'parquet':
+            self._write_parquet(data, full_file_path, compression, chunksize, n_jobs)
+        elif format == 'stata':
+            # categoricals are written as codes with value labels
+            data.to_stata(full_file_path, variable_labels=self._variable_labels(data, 80))
+        elif format == 'spss':
+            # pyreadstat is only needed for SPSS exports
+            import pyreadstat
+            pyreadstat.write_sav(self._plain_frame(data), full_file_path,
+                                 column_labels=self._variable_labels(data),
+                                 variable_value_labels=self.formats.spss_value_labels(data.columns)
+                                 if value_labels else None)
+        elif format == 'r':
+            # pyreadr is only needed for R exports
+            import pyreadr
+            pyreadr.write_rds(full_file_path, self._plain_frame(data), compress='gzip')
+        elif format == 'sql':
+            self._write_sql(data, full_file_path, file_name, sql_engine, chunksize)
+
+
+        # Optionally generate a frequency report
+        if include_freq_report:
+            freq_extensions = {'excel': '.xlsx', 'csv': '.csv', 'parquet': '.parquet'}
+            if freq_report_format not in freq_extensions:
+                raise ValueError("Unsupported frequency report format specified.")
+            freq_full_path = full_file_path[:-len(extension)] + '_freq_report' + freq_extensions[freq_report_format]
+            self._write_freq_report(freq_full_path, max_categories, freq_report_format)
+
+            print(f"Frequency report has been saved to {freq_full_path}")
+
+    def _labeled_frame(self, data):
+        """
+        Return data with the columns that have a SAS format replaced by Categoricals of their labels.
+        """
+        labeled = {}
+        for col in data.columns:
+            categorical = self.formats.label_column(col, data[col])
+            if categorical is not None:
+                labeled[col] = pd.Series(categorical, index=data.index)
+        if not labeled:
+            return data
+        data = data.copy(deep=False)
+        for col, series in labeled.items():
+            data[col] = series
+        return data
+
+    def _variable_labels(self, data, max_length=None):
+        """
+        Return the SAS variable labels of the columns of data as a dict, or None without a format catalog.
+        """
+        if self.formats is None:
+            return None
+        labels = {col: self.formats.variable_label(col) for col in data.columns}
+        return {col: label[:max_length] for col, label in labels.items() if label} or None
+
+    @staticmethod
+    def _export_path(file_name, extension, folder_path=None):
+        """
+        Return the path of a new export: file_name with a date suffix, and a random number if that file exists.
+        """
+        if folder_path is None:
+            folder_path = os.getcwd()  # Use the current working directory if no folder path is provided
+
+        # Add a date suffix to the filename
+        date_suffix = datetime.datetime.now().strftime("%Y%m%d")
+        base_file_path = os.path.join(folder_path, f"{file_name}_{date_suffix}")
+
+        # Check if the file already exists and add a random number if it does
+        full_file_path = base_file_path + extension
+        while os.path.exists(full_file_path):
+            random_suffix = random.randint(1000, 9999)  # Generate a random four-digit number
+            full_file_path = f"{base_file_path}_{random_suffix}" + extension
+        return full_file_path
+
+    def _write_freq_report(self, file_path, max_categories=None, format='excel', tables=None):
+        """
+        Build the frequency table of every column (see export_freq_1way; all columns are counted together
+        by _freq_counts_batch) and write them:
+        - 'excel': one sheet per column, streamed with openpyxl's write-only mode, so rows go straight to
+          the file instead of being held as cell objects;
+        - 'csv' or 'parquet': one long table with Variable, Category, Counts and Percentage.
+        tables, a list of (column, export_freq_1way table), can be given when they are already built.
+        Sheet titles are cut to Excel's 31 characters and numbered where two cut titles would collide.
+        """
+        if tables is None:
+            counts = self._freq_counts_batch(list(self.data.columns))
+            tables = [(col, self._export_freq_table(col, counts[col], max_categories)) for col in self.data.columns]
+
+        if format == 'excel':
+            from openpyxl import Workbook
+
+            def cell(value):
+                # missing values are written as empty cells, as DataFrame.to_excel does
+                return None if pd.isna(value) else value
+
+            workbook = Workbook(write_only=True)
+            for (col, table), title in zip(tables, self._sheet_titles([col for col, _ in tables])):
+                sheet = workbook.create_sheet(title=title)
+                sheet.append(list(table.columns))
+                for row in table.itertuples(index=False, name=None):
+                    sheet.append([cell(value) for value in row])
+            workbook.save(file_path)
+            return
+
+        report = pd.concat(
+            [pd.DataFrame({'Variable': col,
+                           'Category': [str(value) if not pd.isna(value) else 'NaN' for value in table.iloc[:, 0]],
+                           **({'Label': table['Label'].to_numpy() if 'Label' in table else None}
+                              if self.formats is not None else {}),
+                           'Counts': table['Counts'].to_numpy(),
+                           'Percentage': table['Percentage'].to_numpy()})
+             for col, table in tables], ignore_index=True)
+        if format == 'parquet':
+            report.to_parquet(file_path, index=False)
+        else:
+            report.to_csv(file_path, index=False)
+
+    @staticmethod
+    def _sheet_titles(columns, max_length=31):
+        """
+        Return unique Excel sheet titles for the columns: cut to max_length characters (Excel's limit),
+        with a '~n' suffix replacing the end of titles that would otherwise repeat one used before.
+        Excel compares sheet titles case-insensitively.
+        """
+        titles = []
+        used = set()
+        for col in columns:
+            title = str(col)[:max_length]
+            number = 1
+            while title.lower() in used:
+                suffix = f"~{number}"
+                title = str(col)[:max_length - len(suffix)] + suffix
+                number += 1
+            used.add(title.lower())
+            titles.append(title)
+        return titles
+
+    def export_freq_1way(self, col_name, max_categories=None):
+        """
+        Generate a DataFrame of frequency counts and percentages for a column, with an optional limit on categories.
+        Specifically designed for exporting data. The values are counted with one np.bincount pass, and
+        the top categories are picked with a partial sort (np.argpartition) before only those are ordered.
+
+        :param col_name: Column name for frequency calculation.
+        :param max_categories: Maximum number of categories to include. If more categories are present, only the top categories by count are shown.
+        :return: DataFrame with frequency counts and percentages, ordered by count (largest first), and the
+                 SAS format labels of the values if the column has a format.
+        """
+        counts, _ = self._freq_counts(col_name)
+        return self._export_freq_table(col_name, counts, max_categories)
+
+    def _export_freq_table(self, col_name, counts, max_categories=None):
+        """
+        Build the export_freq_1way table from the counts of _freq_counts (or counts added up over partitions).
+        """
+        values = counts.to_numpy()
+        if max_categories is not None and len(values) > max_categories:
+            top = np.argpartition(-values, max_categories - 1)[:max_categories]
+        else:
+            top = np.arange(len(values))
+        # largest counts first, ties in value order
+        counts = counts.iloc[top[np.lexsort((top, -values[top]))]]
+
+        percentages = (counts / counts.sum()) * 100
+        frequency_df = pd.DataFrame({
+            'Counts': counts,
+            'Percentage': percentages
+        }).reset_index().rename(columns={'index': 'Category'})
+        labels = self._value_labels(col_name, frequency_df.iloc[:, 0])
+        if labels is not None:
+            frequency_df.insert(1, 'Label', labels)
+        return frequency_df
@@ -0,0 +1,416 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PartitionedToolBox: the DataToolBox operations on data too large for one in-memory frame.
+
+The national ACS PUMS files (psam_pusa.csv - psam_pusd.csv) are tens of GB. A PartitionedToolBox
+holds no data: it is given the partitions (chunks of rows read one at a time, e.g. by
+data_loader.iter_pums_csv, or Parquet/Feather/CSV files) and records data_exclude, data_construct,
+apply_recodes, select_columns etc. like a lazy DataToolBox. Every report or export then makes one
+pass over the partitions, runs the recorded steps on each (as an optimized lazy DataToolBox plan),
+and adds up the partial results: frequency counts and filter counts are merged, exports are
+appended partition by partition. Memory is bounded by the size of one partition.
+"""
+
+import contextlib
+import io
+import os
+import tempfile
+
+import pandas as pd
+
+from data_loader import compact_chunk, print_filter
+from data_toolbox import DataToolBox
+
+
+# =============================================================================
+# ### Class: PartitionedToolBox
+#
+# **Inputs:**
+# - `partitions`: A function without arguments that returns an iterable of pandas DataFrames (e.g. `lambda: iter_pums_csv([...])`), or a list of Parquet, Feather or CSV file paths.
+# - `formats` (Optional): A `sas_formats.FormatCatalog`, as in DataToolBox.
+# - `chunksize` (Optional): The number of rows per partition read from Parquet and CSV files. Default is 1,000,000.
+#
+# **Description:**
+# Records the data steps of DataToolBox and runs them partition by partition whenever a result is needed, adding up partial results, so data of any size can be processed in bounded memory.
+#
+# **Functions:**
+#
+# 1. **data_exclude**, **data_construct**, **data_map**, **apply_recodes**, **copy_column**, **fill_all_nans**, **mark_missing**, **fill_missing**, **select_columns**
+#    - **Inputs:** As in DataToolBox.
+#    - **Description:** Recorded, and run on every partition in the next pass.
+#
+# 2. **data_desc**
+#    - **Inputs:** None
+#    - **Description:** Prints the number of observations and variables after the recorded steps.
+#
+# 3. **freq_1way**, **freq_1way_batch**
+#    - **Inputs:** As in DataToolBox.
+#    - **Description:** Prints the frequency tables, with the counts of all partitions added up.
+#
+# 4. **export_data**
+#    - **Inputs:** As in DataToolBox, for the 'csv', 'parquet' and 'sql' formats.
+#    - **Description:** Appends every partition to one file; the frequency report is built from counts added up over the partitions.
+#
+# 5. **persist**
+#    - **Inputs:**
+#      - `folder_path`: The directory for the partition files.
+#    - **Description:** Writes the partitions after the recorded steps to Parquet files and returns a PartitionedToolBox reading them, so later passes skip the raw files and the steps.
+#
+# 6. **to_toolbox**
+#    - **Inputs:** None
+#    - **Description:** Concatenates the partitions after the recorded steps into an in-memory DataToolBox, for results that fit in memory (e.g. one state).
+# =============================================================================
+
+
+class PartitionedToolBox:
+    def __init__(self, partitions, formats=None, chunksize=1_000_000):
+        """
+        Initialize the PartitionedToolBox with a partitioned dataset.
+
+        :param partitions: A function without arguments returning an iterable of pandas DataFrames, called
+                           once per pass (e.g. lambda: iter_pums_csv(paths, ...)), or a list of Parquet,
+                           Feather or CSV file paths.
+        :param formats: Optional. A sas_formats.FormatCatalog used to label the frequency tables.
+        :param chunksize: Optional. The number of rows per partition read from Parquet and CSV files.
+        """
+        self.partitions = partitions
+        self.formats = formats
+        self.chunksize = chunksize
+        # the recorded DataToolBox calls: (method name, args, kwargs)
+        self._steps = []
+        # builds the tables of the merged counts
+        self._formatter = DataToolBox(pd.DataFrame(), formats=formats)
+
+    def _read_partitions(self):
+        """
+        Yield the raw partitions.
+        """
+        if callable(self.partitions):
+            yield from self.partitions()
+            return
+
+        for path in self.partitions:
+            if path.endswith('.parquet'):
+                # pyarrow is only needed for Parquet partitions
+                import pyarrow.parquet as parquet
+                for batch in parquet.ParquetFile(path).iter_batches(batch_size=self.chunksize):
+                    yield batch.to_pandas()
+            elif path.endswith('.feather'):
+                yield pd.read_feather(path)
+            else:
+                for chunk in pd.read_csv(path, chunksize=self.chunksize, low_memory=False):
+                    yield compact_chunk(chunk)
+
+    def iter_partitions(self):
+        """
+        Run the recorded steps on every partition and yield the resulting DataToolBoxes, one at a time.
+        The messages of the steps are not printed per partition; the filter counts of all partitions
+        are printed, added up, once the pass is over.
+
+        :return: A generator of DataToolBox objects.
+        """
+        filter_log = {}
+        errors = []
+        n_partitions = 0
+        n_obs = 0
+        for part in self._read_partitions():
+            box = DataToolBox(part, lazy=True, formats=self.formats)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                for name, args, kwargs in self._steps:
+                    getattr(box, name)(*args, **kwargs)
+                box.collect()
+            errors.extend(line for line in output.getvalue().splitlines()
+                          if line.startswith('Error') and line not in errors)
+            for position, (condition, removed, total) in enumerate(box.filter_log):
+                _, removed_sum, total_sum = filter_log.get(position, (condition, 0, 0))
+                filter_log[position] = (condition, removed_sum + removed, total_sum + total)
+            n_partitions += 1
+            n_obs += len(box.data)
+            yield box
+
+        print("---------Partitions-----------------")
+        print(n_partitions, "partitions;", n_obs, "obs after the recorded steps")
+        print("")
+        for condition, removed, total in filter_log.values():
+            print_filter(condition, removed, total)
+        for line in errors:
+            print(line)
+
+    def _record(self, name, *args, **kwargs):
+        self._steps.append((name, args, kwargs))
+
+    def data_exclude(self, condition: str):
+        """
+        Record DataToolBox.data_exclude: keep the rows meeting the condition.
+        """
+        self._record('data_exclude', condition)
+
+    def data_construct(self, col_name, conditions_str, choices, default=-1):
+        """
+        Record DataToolBox.data_construct.
+        """
+        DataToolBox._check_choices(col_name, conditions_str, choices)
+        self._record('data_construct', col_name, list(conditions_str), list(choices), default)
+
+    def data_map(self, col_name, source_col, mapping, default=-1):
+        """
+        Record DataToolBox.data_map.
+        """
+        self._record('data_map', col_name, source_col, dict(mapping), default)
+
+    def apply_recodes(self, recodes, dataset):
+        """
+        Record DataToolBox.apply_recodes.
+        """
+        for col_name, spec in recodes.items():
+            if dataset in spec and 'conditions' in spec[dataset]:
+                DataToolBox._check_choices(col_name, spec[dataset]['conditions'], spec[dataset]['choices'])
+        self._record('apply_recodes', recodes, dataset)
+
+    def copy_column(self, source_col, target_col):
+        """
+        Record DataToolBox.copy_column.
+        """
+        self._record('copy_column', source_col, target_col)
+
+    def fill_all_nans(self, fill_value):
+        """
+        Record DataToolBox.fill_all_nans.
+        """
+        self._record('fill_all_nans', fill_value)
+
+    def mark_missing(self, columns=None, codes=None, nan_reason=-9):
+        """
+        Record DataToolBox.mark_missing.
+        """
+        self._record('mark_missing', columns, codes, nan_reason)
+
+    def fill_missing(self, fill_value=None, columns=None):
+        """
+        Record DataToolBox.fill_missing.
+        """
+        self._record('fill_missing', fill_value, columns)
+
+    def select_columns(self, col_list=None, prefixes=None):
+        """
+        Record DataToolBox.select_columns.
+        """
+        self._record('select_columns', col_list, prefixes)
+
+    def data_desc(self):
+        """
+        Print the number of observations (rows) and variables (columns) after the recorded steps.
+        """
+        n_obs = 0
+        n_vars = 0
+        for box in self.iter_partitions():
+            n_obs += len(box.data)
+            n_vars = box.data.shape[1]
+        print("---------Current Data State----------")
+        print(n_obs, "obs;", n_vars, "vars")
+        print("")
+
+    @staticmethod
+    def _merge_counts(total, part):
+        """
+        Add up the counts of two partitions (Series indexed by value, missing values included).
+        """
+        if total is None:
+            return part
+        merged = pd.concat([total, part])
+        return merged.groupby(level=0, dropna=False, sort=True).sum().rename(total.name)
+
+    def freq_1way(self, col_name, weight_col=None, include_unweighted=False):
+        """
+        Print the freq_1way table of a column (see DataToolBox.freq_1way) over all partitions.
+        """
+        self.freq_1way_batch([col_name], weight_col=weight_col, include_unweighted=include_unweighted)
+
+    def freq_1way_batch(self, columns, weight_col=None, include_unweighted=False):
+        """
+        Print the freq_1way table of several columns in one pass. Every partition is counted with the
+        np.bincount kernels of DataToolBox, and the counts of the partitions are added up.
+
+        :param columns: A list of column names.
+        :param weight_col: Optional. The name of the column to be used for weighting the frequency and percentages.
+        :param include_unweighted: Optional. Whether to include unweighted results alongside weighted results.
+        """
+        counts = {col: None for col in columns}
+        weighted = {col: None for col in columns}
+        for box in self.iter_partitions():
+            weights = None
+            if weight_col:
+                weights = box._weights(weight_col)
+                if weights is None:
+                    return
+            for col in columns:
+                part_counts, part_weighted = box._freq_counts(col, weights)
+                counts[col] = self._merge_counts(counts[col], part_counts)
+                if weights is not None:
+                    weighted[col] = self._merge_counts(weighted[col], part_weighted)
+
+        for col in columns:
+            if counts[col] is None:
+                continue
+            frequency_df, title = self._formatter._freq_table(col, counts[col], weighted[col], include_unweighted)
+            self._formatter._print_freq_table(frequency_df, title)
+
+    def export_data(self, file_name, format, include_freq_report=False, max_categories=None, folder_path=None,
+                    compression=None, chunksize=100_000, n_jobs=None, sql_engine='sqlite', freq_report_format='excel'):
+        """
+        Export the data after the recorded steps to one file, appending the partitions one after the other,
+        and optionally create a frequency report from the counts of all partitions.
+        See DataToolBox.export_data for the arguments; only the 'csv', 'parquet' and 'sql' formats, which
+        can be appended to, are supported.
+
+        The partitions may have different types for the same column (e.g. a weight that optimize_dtypes made
+        an integer in one partition and that stays a float in another), so the output schema is fixed from
+        all of them: the partitions are first spooled to a temporary folder (pickles, next to the export),
+        with integer and float columns widened to 64 bits and categoricals as their values, while the
+        common type of every column is worked out (see _common_dtype); then every partition is cast to
+        that schema and written.
+        """
+        extensions = {'csv': '.csv', 'parquet': '.parquet', 'sql': '.sqlite'}
+        if format not in extensions:
+            raise ValueError(f"Unsupported file format '{format}' for partitioned data; use 'csv', 'parquet' or 'sql'.")
+        extension = extensions[format]
+        if format == 'sql':
+            if sql_engine not in ('sqlite', 'duckdb'):
+                raise ValueError(f"Unsupported SQL engine '{sql_engine}'.")
+            extension = '.' + sql_engine
+        if format == 'csv' and compression:
+            if compression not in DataToolBox.CSV_COMPRESSORS:
+                raise ValueError(f"Unsupported CSV compression '{compression}'.")
+            extension += DataToolBox.CSV_COMPRESSORS[compression][0]
+        freq_extensions = {'excel': '.xlsx', 'csv': '.csv', 'parquet': '.parquet'}
+        if include_freq_report and freq_report_format not in freq_extensions:
+            raise ValueError("Unsupported frequency report format specified.")
+
+        full_file_path = DataToolBox._export_path(file_name, extension, folder_path)
+
+        columns = None
+        counts = {}
+        dtypes = {}
+        with tempfile.TemporaryDirectory(dir=folder_path) as spool:
+            spooled = []
+            for number, box in enumerate(self.iter_partitions()):
+                data = box._export_frame(text_floats=format != 'parquet')
+                if columns is None:
+                    columns = list(data.columns)
+                data = self._wide_frame(data[columns])
+                for col in columns:
+                    dtypes[col] = self._common_dtype(dtypes.get(col), data[col].dtype)
+                path = os.path.join(spool, f"part-{number:05d}.pkl")
+                data.to_pickle(path)
+                spooled.append(path)
+
+                if include_freq_report:
+                    part_counts = box._freq_counts_batch(columns)
+                    for col in columns:
+                        counts[col] = self._merge_counts(counts.get(col), part_counts[col])
+
+            if columns is None:
+                print("No partitions to export.")
+                return
+
+            writer = None
+            try:
+                for path in spooled:
+                    data = pd.read_pickle(path).astype(dtypes)
+                    os.remove(path)
+                    if format == 'csv':
+                        self._formatter._write_csv(data, full_file_path, compression, chunksize,
+                                                   append=writer is not None)
+                        writer = True
+                    elif format == 'parquet':
+                        if writer is None:
+                            # pyarrow is only needed for Parquet
+                            import pyarrow as pa
+                            import pyarrow.parquet as parquet
+                            writer = parquet.ParquetWriter(full_file_path,
+                                                           pa.Schema.from_pandas(data, preserve_index=False),
+                                                           compression=compression or 'zstd')
+                        self._formatter._write_parquet(data, full_file_path, compression, chunksize, n_jobs, writer)
+                    elif format == 'sql':
+                        self._formatter._write_sql(data, full_file_path, file_name, sql_engine, chunksize,
+                                                   append=writer is not None, create_indexes=False)
+                        writer = True
+            finally:
+                if format == 'parquet' and writer is not None:
+                    writer.close()
+
+        if format == 'sql':
+            # the indexes are built once, after the last partition
+            self._formatter._write_sql(pd.DataFrame(columns=columns), full_file_path, file_name, sql_engine,
+                                       chunksize, append=True)
+        print(f"Data has been exported to {full_file_path}")
+
+        if include_freq_report:
+            freq_full_path = full_file_path[:-len(extension)] + '_freq_report' + freq_extensions[freq_report_format]
+            tables = [(col, self._formatter._export_freq_table(col, counts[col], max_categories)) for col in columns]
+            self._formatter._write_freq_report(freq_full_path, max_categories, freq_report_format, tables=tables)
+            print(f"Frequency report has been saved to {freq_full_path}")
+
+    @staticmethod
+    def _common_dtype(dtype, other):
+        """
+        Return the type that holds the values of two partitions of a column (see _wide_frame): the type
+        itself if they agree, float64 for integers (or booleans) and floats, Int64 for integers and
+        booleans, and object otherwise.
+        """
+        if dtype is None or dtype == other:
+            return other
+        types = pd.api.types
+        if all(types.is_numeric_dtype(d) for d in (dtype, other)):
+            if types.is_float_dtype(dtype) or types.is_float_dtype(other):
+                return 'float64'
+            return 'Int64'
+        return 'object'
+
+    @staticmethod
+    def _wide_frame(data):
+        """
+        Return data with 64-bit integer and float columns and categoricals as their values, so that the
+        types of a column differ between partitions only in kind (see _common_dtype).
+        """
+        wide = {}
+        for col in data.columns:
+            series = data[col]
+            if isinstance(series.dtype, pd.CategoricalDtype):
+                series = series.astype(series.cat.categories.dtype)
+            elif pd.api.types.is_integer_dtype(series) and not pd.api.types.is_bool_dtype(series):
+                series = series.astype('Int64')
+            elif pd.api.types.is_float_dtype(series):
+                series = series.astype('float64')
+            wide[col] = series
+        return pd.DataFrame(wide, index=data.index)
+
+    def persist(self, folder_path, name='part'):
+        """
+        Run the recorded steps once and write every resulting partition to a Parquet file, e.g. to keep
+        the harmonized national data after one pass over the raw CSVs.
+
+        :param folder_path: The directory for the partition files (name-00000.parquet, ...).
+        :param name: Optional. The prefix of the file names. Default is 'part'.
+        :return: A PartitionedToolBox reading the written files.
+        """
+        os.makedirs(folder_path, exist_ok=True)
+        paths = []
+        for number, box in enumerate(self.iter_partitions()):
+            path = os.path.join(folder_path, f"{name}-{number:05d}.parquet")
+            box._write_parquet(box._export_frame(), path)
+            paths.append(path)
+        print(f"{len(paths)} partitions have been saved to {folder_path}")
+        return PartitionedToolBox(paths, formats=self.formats, chunksize=self.chunksize)
+
+    def to_toolbox(self):
+        """
+        Concatenate the partitions after the recorded steps into one in-memory DataToolBox.
+
+        :return: A DataToolBox.
+        """
+        frames = [box.data for box in self.iter_partitions()]
+        data = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        return DataToolBox(data, formats=self.formats)
@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+SAS format catalogs (PROC FORMAT, FORMAT and LABEL statements) read into Python.
+
+CHIS ships its value labels as SAS code (ADULT_PROC_FORMAT.SAS, ADULT_FORMAT.sas and
+ADULT_LABEL.sas), and the labels of the harmonized sc_* variables are kept the same way in
+"Data/Output Data/FORMAT". The functions below parse these files into a FormatCatalog: each
+VALUE block is compiled once into a lookup table of its single values plus sorted arrays of
+its ranges, so a column is labeled by looking up its distinct values only, vectorized, and
+mapping the result back as a pandas Categorical. Compiled catalogs are cached on disk as a
+pickle (see load_formats), so the 300 KB CHIS catalog is parsed only when it changes.
+"""
+
+import glob
+import os
+import pickle
+import re
+
+import numpy as np
+import pandas as pd
+
+from data_loader import cache_key
+
+
+# bump when the layout of the compiled classes changes, so older pickles are rebuilt
+INDEX_VERSION = 1
+
+# the CHIS files are Windows-1252/Latin-1 text, not UTF-8
+ENCODING = 'latin-1'
+
+_TOKEN = re.compile(r"""
+      (?P<skip>\s+|/\*.*?\*/)
+    | (?P<string>"(?:[^"]|"")*"|'(?:[^']|'')*')
+    | (?P<punct>[=;,<()-])
+    | (?P<word>[^\s=;,<()"'-]+)
+""", re.S | re.X)
+
+# a string greater than every value, for the HIGH end of character ranges
+_CHAR_HIGH = '\U0010ffff'
+
+
+def _tokenize(text):
+    """
+    Split SAS code into (kind, text) tokens; whitespace and /* */ comments are dropped and quoted strings
+    are unquoted. Statement comments (* ... ;) are dropped as well.
+    """
+    tokens = []
+    statement_start = True
+    in_comment = False
+    for match in _TOKEN.finditer(text):
+        kind = match.lastgroup
+        value = match.group()
+        if kind == 'skip':
+            continue
+        if in_comment:
+            in_comment = value != ';'
+            statement_start = not in_comment
+            continue
+        if statement_start and value.startswith('*'):
+            in_comment = True
+            continue
+        if kind == 'string':
+            quote = value[0]
+            value = value[1:-1].replace(quote * 2, quote)
+        tokens.append((kind, value))
+        statement_start = value == ';' and kind == 'punct'
+    return tokens
+
+
+def _statements(tokens):
+    """
+    Group tokens into statements, i.e. the tokens up to each ';'.
+    """
+    statement = []
+    for token in tokens:
+        if token == ('punct', ';'):
+            if statement:
+                yield statement
+            statement = []
+        else:
+            statement.append(token)
+    if statement:
+        yield statement
+
+
+class ValueFormat:
+    """
+    A compiled SAS VALUE format. Single values are kept in a dict, ranges in arrays sorted by their
+    lower bound for np.searchsorted, and OTHER as a fallback label.
+    """
+
+    def __init__(self, name, entries):
+        """
+        :param name: The format name, with a leading '$' for character formats.
+        :param entries: A list of (low, high, low_exclusive, high_exclusive, label) in the order of the
+                        VALUE statement; low and high are 'OTHER' for the OTHER entry.
+        """
+        self.name = name
+        self.character = name.startswith('$')
+        self.values = {}
+        self.other = None
+        ranges = []
+        for low, high, low_excl, high_excl, label in entries:
+            if low == 'OTHER':
+                self.other = label
+                continue
+            low, high = self._bound(low, False), self._bound(high, True)
+            if low == high and not (low_excl or high_excl) or (not self.character and np.isnan(low)):
+                # SAS uses the first label of a value that is listed twice
+                self.values.setdefault(low, label)
+            else:
+                ranges.append((low, high, low_excl, high_excl, label))
+
+        ranges.sort(key=lambda entry: entry[0])
+        key_dtype = object if self.character else 'float64'
+        self.lows = np.array([entry[0] for entry in ranges], dtype=key_dtype)
+        self.highs = np.array([entry[1] for entry in ranges], dtype=key_dtype)
+        self.low_excl = np.array([entry[2] for entry in ranges], dtype=bool)
+        self.high_excl = np.array([entry[3] for entry in ranges], dtype=bool)
+        self.range_labels = np.array([entry[4] for entry in ranges], dtype=object)
+
+    def _bound(self, value, high):
+        """
+        Convert a range bound as written (LOW, HIGH, '.', a number or a string) into a lookup key.
+        """
+        if value in ('LOW', 'HIGH'):
+            if self.character:
+                return '' if value == 'LOW' else _CHAR_HIGH
+            return -np.inf if value == 'LOW' else np.inf
+        if self.character:
+            # SAS compares character values without trailing blanks, so " " is the blank (missing) value
+            return value.rstrip()
+        if value.strip() == '.' or re.fullmatch(r'\.[A-Z_]', value.strip(), re.I):
+            return np.nan
+        return float(value)
+
+    def _keys(self, values):
+        """
+        Convert values to the keys of the format: text for character formats (whole numbers without
+        a decimal point, missing values as blank), float64 for numeric formats.
+        """
+        if not self.character:
+            return pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype='float64')
+
+        def text(value):
+            if value is None or (isinstance(value, float) and np.isnan(value)) or value is pd.NA:
+                return ''
+            if isinstance(value, (float, np.floating)) and float(value).is_integer():
+                return str(int(value))
+            return str(value).rstrip()
+
+        return np.array([text(value) for value in values], dtype=object)
+
+    def lookup(self, values):
+        """
+        Return the labels of values (usually the distinct values of a column).
+
+        :param values: A sequence of values.
+        :return: A NumPy object array of the labels, None where the format has no label.
+        """
+        keys = self._keys(values)
+        labels = pd.Series(self.values, dtype=object).reindex(keys).to_numpy(dtype=object) \
+            if self.values else np.full(len(keys), np.nan, dtype=object)
+        found = pd.notna(labels)
+
+        if len(self.lows) and not found.all():
+            todo = np.flatnonzero(~found)
+            todo_keys = keys[todo]
+            if not self.character:
+                # NaN is never inside a range
+                todo, todo_keys = todo[~np.isnan(todo_keys)], todo_keys[~np.isnan(todo_keys)]
+            position = np.searchsorted(self.lows, todo_keys, side='right') - 1
+            # a key equal to an exclusive lower bound belongs to the range before
+            at_low = (position >= 0) & self.low_excl[np.maximum(position, 0)] \
+                & (self.lows[np.maximum(position, 0)] == todo_keys)
+            position[at_low] -= 1
+            safe = np.maximum(position, 0)
+            highs = self.highs[safe]
+            inside = (position >= 0) & np.where(self.high_excl[safe], todo_keys < highs, todo_keys <= highs)
+            labels[todo[inside]] = self.range_labels[safe[inside]]
+            found[todo[inside]] = True
+
+        if self.other is not None:
+            labels[~found] = self.other
+            found[:] = True
+        labels[~found] = None
+        return labels
+
+
+def parse_proc_format(text):
+    """
+    Parse the VALUE statements of PROC FORMAT code, e.g.
+
+        VALUE $AG23BEG  " " ="OK"  "-9" ="NOT ASCERTAINED"  "1900" - "2022" ="YEAR" ;
+        VALUE SC_SEX  1 = "Male"  2 = "Female";
+
+    Single values, value lists (1, 2 = ...), ranges with LOW/HIGH and the exclusive forms (<- and -<),
+    negative codes and OTHER are supported; INVALUE and PICTURE statements are skipped.
+
+    :param text: The SAS code.
+    :return: A dict of upper-case format name ('$' included for character formats) to ValueFormat.
+    """
+    formats = {}
+    for statement in _statements(_tokenize(text)):
+        if statement[0][1].upper() != 'VALUE' or len(statement) < 2:
+            continue
+        name = statement[1][1].upper()
+        position = 2
+        if position < len(statement) and statement[position] == ('punct', '('):
+            # format options such as (DEFAULT=40) or (MULTILABEL)
+            while position < len(statement) and statement[position] != ('punct', ')'):
+                position += 1
+            position += 1
+
+        def bound(position):
+            kind, value = statement[position]
+            if (kind, value) == ('punct', '-'):
+                # a negative number
+                kind, value = statement[position + 1]
+                return '-' + value, position + 2
+            if kind == 'word' and value.upper() in ('LOW', 'HIGH', 'OTHER'):
+                value = value.upper()
+            return value, position + 1
+
+        entries = []
+        ranges = []
+        while position < len(statement):
+            low, position = bound(position)
+            high, low_excl, high_excl = low, False, False
+            if statement[position] == ('punct', '<'):
+                low_excl = True
+                position += 1
+            if statement[position] == ('punct', '-'):
+                position += 1
+                if statement[position] == ('punct', '<'):
+                    high_excl = True
+                    position += 1
+                high, position = bound(position)
+            ranges.append((low, high, low_excl, high_excl))
+            if statement[position] == ('punct', ','):
+                position += 1
+                continue
+            # '=' then the label
+            label = statement[position + 1][1]
+            position += 2
+            entries.extend(range_ + (label,) for range_ in ranges)
+            ranges = []
+        formats[name] = ValueFormat(name, entries)
+    return formats
+
+
+def parse_format_statement(text):
+    """
+    Parse FORMAT statements, e.g. "FORMAT AA2A AA2A. AA5AOS $ALPHA3X.;". Several variables listed
+    before one format all get that format; widths (e.g. $CHAR10.) are dropped.
+
+    :param text: The SAS code.
+    :return: A dict of upper-case variable name to upper-case format name.
+    """
+    assignments = {}
+    for statement in _statements(_tokenize(text)):
+        if statement[0][1].upper() != 'FORMAT':
+            continue
+        variables = []
+        for kind, value in statement[1:]:
+            if kind == 'word' and '.' in value and not value.startswith('.'):
+                name = re.sub(r'\d*\.\d*$', '', value).upper()
+                assignments.update((variable, name) for variable in variables)
+                variables = []
+            elif kind == 'word':
+                variables.append(value.upper())
+    return assignments
+
+
+def parse_label_statement(text):
+    """
+    Parse LABEL statements, e.g. 'LABEL AA1AMON = "ADULT DATE OF BIRTH MONTH (AA1A)";'.
+
+    :param text: The SAS code.
+    :return: A dict of upper-case variable name to label.
+    """
+    labels = {}
+    for statement in _statements(_tokenize(text)):
+        if statement[0][1].upper() != 'LABEL':
+            continue
+        tokens = statement[1:]
+        for position in range(len(tokens) - 2):
+            if tokens[position][0] == 'word' and tokens[position + 1] == ('punct', '='):
+                labels[tokens[position][1].upper()] = tokens[position + 2][1]
+    return labels
+
+
+class FormatCatalog:
+    """
+    The value formats, format assignments and variable labels of one or more SAS format files.
+    Variable and format names are matched case-insensitively, as in SAS.
+    """
+
+    def __init__(self, formats=None, assignments=None, variable_labels=None):
+        """
+        :param formats: A dict of format name to ValueFormat (see parse_proc_format).
+        :param assignments: A dict of variable name to format name (see parse_format_statement).
+        :param variable_labels: A dict of variable name to label (see parse_label_statement).
+        """
+        self.formats = formats or {}
+        self.assignments = assignments or {}
+        self.variable_labels = variable_labels or {}
+
+    def format_for(self, col_name):
+        """
+        Return the ValueFormat assigned to a variable, or None.
+        """
+        name = self.assignments.get(str(col_name).upper())
+        if name is None:
+            return None
+        return self.formats.get(name)
+
+    def variable_label(self, col_name):
+        """
+        Return the label of a variable, or None.
+        """
+        return self.variable_labels.get(str(col_name).upper())
+
+    def value_labels(self, col_name, values):
+        """
+        Label the values of a variable as SAS prints them: values the format does not cover are shown
+        as they are (whole numbers without a decimal point), missing values stay missing.
+
+        :param col_name: The variable name.
+        :param values: A sequence of values, e.g. the categories of a frequency table.
+        :return: A list of labels, or None if the variable has no format.
+        """
+        value_format = self.format_for(col_name)
+        if value_format is None:
+            return None
+        labels = value_format.lookup(values)
+        result = []
+        for value, label in zip(values, labels):
+            if label is not None:
+                result.append(label)
+            elif pd.isna(value):
+                result.append(np.nan)
+            elif isinstance(value, (float, np.floating)) and float(value).is_integer():
+                result.append(str(int(value)))
+            else:
+                result.append(str(value))
+        return result
+
+    def label_column(self, col_name, series):
+        """
+        Return a column as a Categorical of its labels, categories in the order of the values. Only the
+        distinct values are looked up; the rows are mapped through their integer codes.
+
+        :param col_name: The variable name.
+        :param series: The pandas Series to label.
+        :return: A pandas Categorical, or None if the variable has no format.
+        """
+        if self.format_for(col_name) is None:
+            return None
+        codes, uniques = pd.factorize(series, sort=True, use_na_sentinel=False)
+        labels = self.value_labels(col_name, list(uniques))
+        label_codes, categories = pd.factorize(pd.Series(labels, dtype=object))
+        return pd.Categorical.from_codes(label_codes[codes], categories=categories)
+
+    def spss_value_labels(self, columns):
+        """
+        Return the {value: label} dicts of the single values of the given numeric variables, as taken by
+        pyreadstat.write_sav (variable_value_labels).
+        """
+        result = {}
+        for col_name in columns:
+            value_format = self.format_for(col_name)
+            if value_format is None or value_format.character:
+                continue
+            labels = {(int(value) if float(value).is_integer() else value): label
+                      for value, label in value_format.values.items() if not np.isnan(value)}
+            if labels:
+                result[col_name] = labels
+        return result
+
+    def update(self, other):
+        """
+        Add the formats, assignments and labels of another catalog; those of the other catalog win.
+        """
+        self.formats.update(other.formats)
+        self.assignments.update(other.assignments)
+        self.variable_labels.update(other.variable_labels)
+        return self
+
+
+def _read_text(paths):
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths or []:
+        with open(path, encoding=ENCODING) as handle:
+            yield handle.read()
+
+
+def parse_formats(proc_formats, format_statements=None, label_statements=None):
+    """
+    Parse SAS format files into a FormatCatalog.
+
+    :param proc_formats: A path or a list of paths of PROC FORMAT code.
+    :param format_statements: Optional. A path or a list of paths of FORMAT statements.
+    :param label_statements: Optional. A path or a list of paths of LABEL statements.
+    :return: The FormatCatalog.
+    """
+    catalog = FormatCatalog()
+    for text in _read_text(proc_formats):
+        catalog.formats.update(parse_proc_format(text))
+    for text in _read_text(format_statements):
+        catalog.assignments.update(parse_format_statement(text))
+    for text in _read_text(label_statements):
+        catalog.variable_labels.update(parse_label_statement(text))
+    return catalog
+
+
+def load_formats(name, proc_formats, format_statements=None, label_statements=None, cache_dir='Data/Cache'):
+    """
+    Load a compiled FormatCatalog from the on-disk cache, or parse the SAS files and store it there as
+    a pickle. As in data_loader.load_cached, the cache file is named after the catalog and the
+    cache_key of its files, so it is rebuilt when a file changes; older files of the catalog are removed.
+
+    :param name: Name of the catalog, e.g. 'chis_adult_formats'.
+    :param proc_formats: A path or a list of paths of PROC FORMAT code.
+    :param format_statements: Optional. A path or a list of paths of FORMAT statements.
+    :param label_statements: Optional. A path or a list of paths of LABEL statements.
+    :param cache_dir: The directory holding the cache files.
+    :return: The FormatCatalog.
+    """
+    groups = [[paths] if isinstance(paths, str) else list(paths or [])
+              for paths in (proc_formats, format_statements, label_statements)]
+    sources = [path for group in groups for path in group]
+    key = cache_key(sources, {'version': INDEX_VERSION, 'groups': [len(group) for group in groups]})
+    cache_path = os.path.join(cache_dir, f"{name}_{key}.pkl")
+
+    print("---------Format Cache---------------")
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as handle:
+            catalog = pickle.load(handle)
+        print(f"{name} loaded from {cache_path}")
+        print("")
+        return catalog
+
+    print(f"{name} not cached or sources changed; parsing it")
+    catalog = parse_formats(*groups)
+    print(len(catalog.formats), "formats;", len(catalog.assignments), "format assignments;",
+          len(catalog.variable_labels), "variable labels")
+
+    os.makedirs(cache_dir, exist_ok=True)
+    for old_path in glob.glob(os.path.join(cache_dir, f"{name}_{'[0-9a-f]' * 16}.pkl")):
+        os.remove(old_path)
+    temp_path = cache_path + '.tmp'
+    with open(temp_path, 'wb') as handle:
+        pickle.dump(catalog, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, cache_path)
+    print(f"{name} cached to {cache_path}")
+    print("")
+    return catalog
@@ -0,0 +1,45 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# the modules live at the top of the repository, next to the Step scripts
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def pums_persons():
+    """
+    A small ACS PUMS person file: housing units and group quarters, blanks in AGEP, SCHL, POVPIP, ESR and TEN,
+    and an integer weight with four replicates.
+    """
+    rng = np.random.default_rng(7)
+    n = 40
+    serialno = [f"2019{'GQ' if i % 5 == 0 else 'HU'}{i:07d}" for i in range(n)]
+    data = pd.DataFrame({
+        'SERIALNO': serialno,
+        'SPORDER': 1,
+        'PUMA': rng.choice([3701, 3702, 3703], n),
+        'AGEP': rng.integers(0, 95, n).astype('float64'),
+        'SEX': rng.integers(1, 3, n),
+        'RAC1P': rng.integers(1, 10, n),
+        'SCHL': rng.integers(1, 25, n).astype('float64'),
+        'POVPIP': rng.integers(0, 502, n).astype('float64'),
+        'HISP': rng.choice([1, 1, 2, 3], n),
+        'CIT': rng.integers(1, 6, n),
+        'ESR': rng.integers(1, 7, n).astype('float64'),
+        'TEN': rng.integers(1, 5, n).astype('float64'),
+        'HICOV': rng.integers(1, 3, n),
+        'MAR': rng.integers(1, 6, n),
+        'PWGTP': rng.integers(1, 200, n),
+    })
+    data.loc[[3, 17], 'AGEP'] = np.nan
+    data.loc[[2, 9, 30], 'POVPIP'] = np.nan
+    data.loc[[4, 11], 'SCHL'] = np.nan
+    data.loc[[1, 8, 12], 'ESR'] = np.nan
+    data.loc[[0, 5], 'TEN'] = np.nan
+    for i in range(1, 5):
+        data[f'PWGTP{i}'] = rng.integers(0, 400, n)
+    return data
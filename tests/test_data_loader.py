@@ -0,0 +1,142 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_loader import (build_join_index, group_quarters_flag, join_index, load_cached, read_pums_csv,
+                         read_sas7bdat)
+
+
+def test_read_pums_csv_reads_only_the_needed_columns(tmp_path, pums_persons):
+    path = tmp_path / 'psam_p06.csv'
+    pums_persons.to_csv(path, index=False)
+
+    data = read_pums_csv(str(path), columns=['SEX', 'AGEP'], prefixes=['PWGTP'], expressions=['SCHL <= 15'],
+                         chunksize=7)
+    baseline = pd.read_csv(path)
+
+    # in file order, whatever order they were asked for in
+    assert list(data.columns) == ['AGEP', 'SEX', 'SCHL'] + [f'PWGTP{i}' for i in ['', 1, 2, 3, 4]]
+    for col in data.columns:
+        np.testing.assert_array_equal(data[col].to_numpy(dtype='float64', na_value=np.nan),
+                                      baseline[col].to_numpy(dtype='float64'))
+    # codes are stored in the smallest integer dtype, nullable where the file has blanks
+    assert data['SEX'].dtype == 'int8'
+    assert data['AGEP'].dtype == 'Int8'
+    assert data['PWGTP'].dtype == 'int16'
+
+
+def test_read_pums_csv_keeps_serialno_as_text(tmp_path, pums_persons):
+    path = tmp_path / 'psam_p06.csv'
+    pums_persons.to_csv(path, index=False)
+    data = read_pums_csv(str(path), columns=['SERIALNO', 'SEX'])
+    assert data['SERIALNO'].tolist() == pums_persons['SERIALNO'].tolist()
+
+
+def test_read_pums_csv_filters_match_query_on_the_full_file(tmp_path, pums_persons):
+    path = tmp_path / 'psam_p06.csv'
+    pums_persons.to_csv(path, index=False)
+    filters = ['INGRPQ == 0', 'AGEP >= 18']
+
+    data = read_pums_csv(str(path), columns=['SERIALNO', 'SEX'], derived={'INGRPQ': group_quarters_flag},
+                         filters=filters, chunksize=6)
+
+    baseline = pd.read_csv(path, dtype={'SERIALNO': str})
+    baseline['INGRPQ'] = np.where(baseline['SERIALNO'].str[4:6] == 'GQ', 1, 0)
+    log = []
+    for condition in filters:
+        kept = baseline.query(condition)
+        log.append((condition, len(baseline) - len(kept), len(baseline)))
+        baseline = kept
+
+    assert data['SERIALNO'].tolist() == baseline['SERIALNO'].tolist()
+    assert data['AGEP'].tolist() == baseline['AGEP'].tolist()
+    assert data.attrs['filter_log'] == log
+
+
+def test_join_index_matches_a_left_merge(pums_persons):
+    persons = pums_persons[['SERIALNO', 'AGEP']].copy()
+    # every other household has a record, plus one that has no persons
+    housing = pd.DataFrame({'SERIALNO': pums_persons['SERIALNO'].iloc[::2].tolist() + ['2019HU9999999'],
+                            'TEN': [(i % 4) + 1 for i in range(len(pums_persons) // 2)] + [2]})
+    housing = housing.sample(frac=1, random_state=0)
+
+    joined = join_index(persons.copy(), build_join_index(housing, ['TEN']))
+    baseline = pd.merge(persons, housing, on='SERIALNO', how='left')
+
+    assert joined['SERIALNO'].tolist() == baseline['SERIALNO'].tolist()
+    np.testing.assert_array_equal(joined['TEN'].to_numpy(dtype='float64', na_value=np.nan),
+                                  baseline['TEN'].to_numpy(dtype='float64'))
+    assert joined['TEN'].dtype == 'Int64'
+
+
+def test_build_join_index_rejects_duplicate_keys():
+    housing = pd.DataFrame({'SERIALNO': ['2019HU0000001', '2019HU0000001'], 'TEN': [1, 2]})
+    with pytest.raises(ValueError):
+        build_join_index(housing, ['TEN'])
+
+
+@pytest.mark.parametrize('format', ['feather', 'parquet'])
+def test_load_cached_returns_the_built_data_until_a_source_changes(tmp_path, pums_persons, format):
+    path = tmp_path / 'psam_p06.csv'
+    pums_persons.to_csv(path, index=False)
+    cache_dir = str(tmp_path / 'Cache')
+    builds = []
+
+    def build():
+        builds.append(1)
+        return read_pums_csv(str(path), columns=['SERIALNO', 'SEX', 'AGEP'], filters=['AGEP >= 18'])
+
+    params = {'filters': ['AGEP >= 18']}
+    built = load_cached('acs_raw', [str(path)], build, params=params, cache_dir=cache_dir, format=format)
+    cached = load_cached('acs_raw', [str(path)], build, params=params, cache_dir=cache_dir, format=format)
+
+    assert len(builds) == 1
+    pd.testing.assert_frame_equal(cached, built)
+    assert cached.attrs['filter_log'] == [list(entry) for entry in built.attrs['filter_log']]
+
+    # a new parameter or source file is a new key, and the old file is removed
+    load_cached('acs_raw', [str(path)], build, params={'filters': []}, cache_dir=cache_dir, format=format)
+    pums_persons.iloc[:10].to_csv(path, index=False)
+    rebuilt = load_cached('acs_raw', [str(path)], build, params=params, cache_dir=cache_dir, format=format)
+    assert len(builds) == 3
+    assert len(rebuilt) == (pums_persons['AGEP'].iloc[:10] >= 18).sum()
+    assert len(os.listdir(cache_dir)) == 1
+
+
+def test_read_sas7bdat_matches_the_selected_variables(monkeypatch):
+    pyreadstat = pytest.importorskip('pyreadstat')
+    rng = np.random.default_rng(3)
+    n = 25
+    adult = pd.DataFrame({'SRSEX': rng.integers(1, 3, n).astype('float64'),
+                          'SRAGE_P1': rng.integers(18, 86, n).astype('float64'),
+                          'AHEDUC': rng.integers(1, 11, n).astype('float64'),
+                          'RAKEDW0': rng.uniform(1, 500, n)})
+    for i in range(1, 4):
+        adult[f'RAKEDW{i}'] = rng.uniform(0, 900, n)
+    adult.loc[5, 'AHEDUC'] = np.nan
+
+    # no sas7bdat writer exists; serve the frame through the two pyreadstat calls the reader makes
+    def read_sas7bdat_meta(file_path, metadataonly=False):
+        return adult.iloc[:0], SimpleNamespace(column_names=list(adult.columns))
+
+    def read_file_in_chunks(read_function, file_path, chunksize, usecols):
+        for start in range(0, n, chunksize):
+            yield adult.iloc[start:start + chunksize][usecols].reset_index(drop=True), None
+
+    monkeypatch.setattr(pyreadstat, 'read_sas7bdat', read_sas7bdat_meta)
+    monkeypatch.setattr(pyreadstat, 'read_file_in_chunks', read_file_in_chunks)
+
+    data = read_sas7bdat('dummy_adult.sas7bdat', columns=['SRSEX'], prefixes=['RAKEDW'],
+                         expressions=['AHEDUC <= 4'], chunksize=4)
+    baseline = adult[['SRSEX', 'AHEDUC', 'RAKEDW0', 'RAKEDW1', 'RAKEDW2', 'RAKEDW3']]
+
+    assert list(data.columns) == list(baseline.columns)
+    for col in data.columns:
+        np.testing.assert_array_equal(data[col].to_numpy(dtype='float64', na_value=np.nan),
+                                      baseline[col].to_numpy())
+    assert data['SRSEX'].dtype == 'int8'
+    assert data['AHEDUC'].dtype == 'Int8'
+    assert data['RAKEDW0'].dtype == 'float64'
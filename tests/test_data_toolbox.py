@@ -0,0 +1,549 @@
+import sqlite3
+import warnings
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+from tabulate import tabulate
+
+from constructed_variables import RECODES
+from data_toolbox import DataToolBox
+
+
+@pytest.fixture
+def persons():
+    return pd.DataFrame({
+        'SERIALNO': ['2019GQ0000001', '2019HU0000002', '2019GQ0000003', '2019HU0000004'],
+        'AGEP': [10, 20, np.nan, 70],
+        'CIT': [1, 2, 3, 4],
+    })
+
+
+# conditions using Series methods and accessors, with the rows where they hold
+SERIES_CONDITIONS = [
+    ('AGEP.isna()', [False, False, True, False]),
+    ('AGEP.between(18, 64)', [False, True, False, False]),
+    ('CIT.isin([1, 4])', [True, False, False, True]),
+    ("SERIALNO.str[4:6] == 'GQ'", [True, False, True, False]),
+    ('CIT == 2 | AGEP.isna()', [False, True, True, False]),
+]
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+@pytest.mark.parametrize('condition, expected', SERIES_CONDITIONS)
+def test_data_construct_series_conditions(persons, condition, expected, lazy):
+    toolbox = DataToolBox(persons, lazy=lazy)
+    toolbox.data_construct('flag', [condition], [1], 0)
+    assert toolbox.data['flag'].tolist() == [int(value) for value in expected]
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+@pytest.mark.parametrize('condition, expected', SERIES_CONDITIONS)
+def test_data_exclude_series_conditions(persons, condition, expected, lazy):
+    toolbox = DataToolBox(persons, lazy=lazy)
+    toolbox.data_exclude(condition)
+    assert toolbox.data['CIT'].tolist() == persons.loc[expected, 'CIT'].tolist()
+
+
+def test_replicate_totals_match_freq_counts_with_integer_weights():
+    rng = np.random.default_rng(0)
+    n = 1_000_000
+    data = pd.DataFrame({'sc_sex': rng.integers(1, 3, n), 'PWGTP': rng.integers(1, 100, n)})
+    for i in range(1, 5):
+        data[f'PWGTP{i}'] = rng.integers(0, 200, n)
+    toolbox = DataToolBox(data)
+
+    table = toolbox.freq_1way_replicate('sc_sex', 'PWGTP', display=False)
+    _, weighted_counts = toolbox._freq_counts('sc_sex', toolbox._weights('PWGTP'))
+    assert table['Weighted Counts'].tolist() == weighted_counts.tolist()
+    assert table['Weighted Counts'].sum() == data['PWGTP'].sum()
+
+
+def test_freq_1way_replicate_keeps_category_dtypes():
+    data = pd.DataFrame({'sc_sex': [1, 2, 2, 1], 'sc_ratio': [0.5, 1.5, 0.5, 0.5], 'PWGTP': [10, 20, 30, 40]})
+    for i in range(1, 5):
+        data[f'PWGTP{i}'] = data['PWGTP'] + i
+    table = DataToolBox(data).freq_1way_replicate(['sc_sex', 'sc_ratio'], 'PWGTP', display=False)
+    categories = table.groupby('Variable')['Category'].apply(list)
+    assert [type(value) for value in categories['sc_sex']] == [int, int]
+    assert categories['sc_sex'] == [1, 2]
+    assert categories['sc_ratio'] == [0.5, 1.5]
+
+
+def test_compare_freq_counts_are_integers():
+    acs = pd.DataFrame({'sc_sex': [1, 2, 2, 1, 2], 'PWGTP': [10, 20, 30, 40, 50]})
+    for i in range(1, 5):
+        acs[f'PWGTP{i}'] = acs['PWGTP'] + i
+    chis = pd.DataFrame({'sc_sex': [1, 2, 3], 'RAKEDW0': [5.0, 6.0, 7.0]})
+    for i in range(1, 5):
+        chis[f'RAKEDW{i}'] = chis['RAKEDW0'] * (1 + i / 10)
+    cells, tests = DataToolBox(acs).compare_freq(DataToolBox(chis), 'PWGTP', 'RAKEDW0', other_method='jk2',
+                                                 names=('ACS', 'CHIS'), display=False)
+    for table in (cells, tests):
+        assert table['ACS n'].dtype == 'int64'
+        assert table['CHIS n'].dtype == 'int64'
+    assert tests[['ACS n', 'CHIS n']].values.tolist() == [[5, 3]]
+
+
+@pytest.fixture
+def coded():
+    return pd.DataFrame({'POVPIP': [50.0, np.nan, 300.0, -9.0], 'SRH': [1, -9, 2, 1]})
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_masked_values_are_missing_in_conditions(coded, lazy):
+    toolbox = DataToolBox(coded, lazy=lazy)
+    toolbox.mark_missing()
+    toolbox.data_construct('pov_na', ['POVPIP.isna()'], [1], 0)
+    toolbox.data_construct('pov_self', ['POVPIP != POVPIP'], [1], 0)
+    toolbox.data_construct('pov_low', ['POVPIP <= 99', 'POVPIP > 99'], [1, 2], -1)
+    toolbox.data_construct('srh_in', ['SRH in [1, -9]'], [1], 0)
+    data = toolbox.data
+    assert data['pov_na'].tolist() == [0, 1, 0, 1]
+    assert data['pov_self'].tolist() == [0, 1, 0, 1]
+    # a masked -9 no longer passes 'POVPIP <= 99'
+    assert data['pov_low'].tolist() == [1, -1, 2, -1]
+    assert data['srh_in'].tolist() == [1, 0, 0, 1]
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_masked_values_pass_not_equal_like_the_codes(coded, lazy):
+    masked = DataToolBox(coded, lazy=lazy)
+    masked.mark_missing()
+    masked.data_exclude('SRH != 1')
+    filled = DataToolBox(coded.fillna(-9))
+    filled.data_exclude('SRH != 1')
+    assert masked.data.index.tolist() == filled.data.index.tolist() == [1, 2]
+
+
+def run_pipeline(data, lazy):
+    toolbox = DataToolBox(data, lazy=lazy)
+    toolbox.data_construct('sc_age', ['AGEP < 18', 'AGEP < 65'], [1, 2], 3)
+    toolbox.data_construct('sc_unused', ['CIT == 1'], [1], 0)
+    toolbox.data_exclude('sc_age > 1')
+    toolbox.copy_column('CIT', 'sc_cit')
+    toolbox.select_columns(['SERIALNO', 'sc_age', 'sc_cit'])
+    toolbox.data_exclude('sc_cit != 3')
+    return toolbox.data
+
+
+def test_lazy_plan_matches_eager(persons):
+    lazy = run_pipeline(persons, lazy=True)
+    eager = run_pipeline(persons, lazy=False)
+    pd.testing.assert_frame_equal(lazy, eager)
+    assert lazy['SERIALNO'].tolist() == ['2019HU0000002', '2019HU0000004']
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_filter_on_a_dropped_column_fails_as_in_eager_mode(persons, lazy):
+    toolbox = DataToolBox(persons, lazy=lazy)
+    toolbox.data_construct('sc_adult', ['AGEP >= 18'], [1], 0)
+    toolbox.select_columns(['SERIALNO', 'sc_adult'])
+    with pytest.raises(Exception, match="'AGEP'"):
+        toolbox.data_exclude('AGEP > 18')
+        toolbox.collect()
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_data_construct_needs_one_choice_per_condition(persons, lazy):
+    toolbox = DataToolBox(persons, lazy=lazy)
+    with pytest.raises(ValueError, match="'sc_age' has 2 conditions but 1 choices"):
+        toolbox.data_construct('sc_age', ['AGEP < 18', 'AGEP < 65'], [1])
+    recodes = {'sc_age': {'acs': {'conditions': ['AGEP < 18'], 'choices': [1, 2]}}}
+    with pytest.raises(ValueError, match="'sc_age' has 1 conditions but 2 choices"):
+        toolbox.apply_recodes(recodes, 'acs')
+    assert 'sc_age' not in toolbox.data.columns
+
+
+def test_freq_counts_batch_matches_freq_counts(persons):
+    persons = persons.assign(sc_na=pd.array([1, None, 2, None], dtype='Int8'))
+    toolbox = DataToolBox(persons)
+    columns = list(persons.columns)
+    for max_cells in (2 ** 22, 4):
+        batch = toolbox._freq_counts_batch(columns, max_cells=max_cells)
+        for col in columns:
+            pd.testing.assert_series_equal(batch[col], toolbox._freq_counts(col)[0])
+
+
+def test_freq_report_sheet_titles_are_unique(tmp_path):
+    long_a = 'sc_household_income_relative_to_poverty_a'
+    long_b = 'sc_household_income_relative_to_poverty_b'
+    data = pd.DataFrame({long_a: [1, 2], long_b: [2, 2], 'SC_HOUSEHOLD_INCOME_RELATIVE_TO_POVERTY': [1, 1]})
+    path = tmp_path / 'report.xlsx'
+    DataToolBox(data)._write_freq_report(str(path))
+    sheets = pd.read_excel(path, sheet_name=None)
+    titles = list(sheets)
+    assert len(titles) == 3 and len({title.lower() for title in titles}) == 3
+    assert all(len(title) <= 31 for title in titles)
+    assert sheets[titles[0]]['Counts'].tolist() == [1, 1]
+    assert sheets[titles[1]]['Counts'].tolist() == [2]
+
+
+@pytest.mark.parametrize('format, read', [
+    ('csv', pd.read_csv),
+    ('sql', lambda path: pd.read_sql('select * from weights', sqlite3.connect(path))),
+    ('parquet', pd.read_parquet),
+])
+def test_float32_weights_export_their_exact_values(tmp_path, format, read):
+    weights = np.array([0.309069, 12.5, np.nan, 3.0000001], dtype='float32').astype('float64')
+    toolbox = DataToolBox(pd.DataFrame({'RAKEDW0': weights, 'sc_sex': [1, 2, 1, 2]}))
+    toolbox.optimize_dtypes(display=False)
+    assert toolbox.data['RAKEDW0'].dtype == 'float32'
+
+    toolbox.export_data('weights', format, folder_path=str(tmp_path))
+    exported = read(str(next(tmp_path.iterdir())))
+    np.testing.assert_array_equal(exported['RAKEDW0'].to_numpy(dtype='float64'), weights)
+    # read back as in Step 2, the weights become the same float32 again
+    reread = DataToolBox(exported)
+    reread.optimize_dtypes(display=False)
+    pd.testing.assert_series_equal(reread.data['RAKEDW0'], toolbox.data['RAKEDW0'])
+
+
+def baseline_construct(data, conditions_str, choices, default=-1):
+    """
+    data_construct as Step 1 first wrote it: each condition evaluated with DataFrame.eval and
+    assigned with .loc to the rows no earlier condition has set.
+    """
+    values = pd.Series(np.nan, index=data.index)
+    for condition, choice in zip(conditions_str, choices):
+        mask = data.eval(condition) & values.isna()
+        values[mask] = data.loc[mask, choice] if isinstance(choice, str) and choice in data.columns else choice
+    return values.fillna(default)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_apply_recodes_matches_the_variable_by_variable_recodes(pums_persons, lazy):
+    toolbox = DataToolBox(pums_persons, lazy=lazy)
+    toolbox.apply_recodes(RECODES, 'acs')
+    data = toolbox.data
+
+    for col_name, spec in RECODES.items():
+        rule = spec['acs']
+        if 'copy' in rule:
+            expected = pums_persons[rule['copy']]
+        elif 'mapping' in rule:
+            expected = pums_persons[rule['source']].map(rule['mapping']).fillna(rule.get('default', -1))
+        else:
+            expected = baseline_construct(pums_persons, rule['conditions'], rule['choices'], rule.get('default', -1))
+        np.testing.assert_array_equal(data[col_name].to_numpy(dtype='float64', na_value=np.nan),
+                                      expected.to_numpy(dtype='float64'), err_msg=col_name)
+
+
+LOOKUP_RECODES = [
+    (['RAC1P == 1', 'RAC1P == 2', 'RAC1P >= 3 & RAC1P <= 5', 'RAC1P in [6, 7]'], [1, 2, 3, 4], 5),
+    (['SCHL >= 1 & SCHL <= 15', 'SCHL >= 16 & SCHL <= 17', 'SCHL >= 18'], [1, 2, 3], -1),
+    (['POVPIP <= 99', 'POVPIP >= 100 & POVPIP <= 199', 'POVPIP >= 200 & POVPIP <= 299.5', 'POVPIP > 299.5'],
+     [1, 2, 3, 4], -1),
+    (['ESR != 3', 'ESR == 3'], [1, 2], -1),
+    (['AGEP <= 17', 'AGEP <= 99'], [0, 'AGEP'], 99),
+]
+
+
+@pytest.mark.parametrize('lookup_max_range', [DataToolBox.LOOKUP_MAX_RANGE, 0])
+@pytest.mark.parametrize('conditions, choices, default', LOOKUP_RECODES)
+def test_lookup_recodes_match_evaluating_every_condition(pums_persons, monkeypatch, lookup_max_range,
+                                                         conditions, choices, default):
+    # integer codes through the lookup array, and with a range of 0 through the searchsorted buckets
+    monkeypatch.setattr(DataToolBox, 'LOOKUP_MAX_RANGE', lookup_max_range)
+    data = pums_persons.fillna({'AGEP': 0}).astype({'RAC1P': 'int16', 'AGEP': 'int8'})
+    toolbox = DataToolBox(data)
+    toolbox.data_construct('recode', conditions, choices, default)
+    expected = baseline_construct(data, conditions, choices, default)
+    np.testing.assert_array_equal(toolbox.data['recode'].to_numpy(dtype='float64'), expected.to_numpy())
+
+
+@pytest.mark.parametrize('lookup_max_range', [DataToolBox.LOOKUP_MAX_RANGE, 0])
+def test_data_map_matches_series_map(pums_persons, monkeypatch, lookup_max_range):
+    monkeypatch.setattr(DataToolBox, 'LOOKUP_MAX_RANGE', lookup_max_range)
+    mapping = {1: 1, 2: 1, 3: 2, 4: 2, 9: 3}
+    toolbox = DataToolBox(pums_persons)
+    toolbox.data_map('sc_race', 'RAC1P', mapping, default=-1)
+    expected = pums_persons['RAC1P'].map(mapping).fillna(-1)
+    assert toolbox.data['sc_race'].tolist() == expected.astype('int64').tolist()
+
+
+def baseline_freq_1way(data, col_name, weight_col=None, include_unweighted=False):
+    """
+    The table freq_1way printed in Step 1 before the counts were batched: value_counts and groupby-sum.
+    """
+    counts = data[col_name].value_counts(dropna=False).sort_index()
+    if weight_col:
+        weighted_counts = data.groupby(col_name)[weight_col].sum()
+        frequency_df = pd.DataFrame({'Weighted Counts': weighted_counts,
+                                     'Weighted Percentage': weighted_counts / weighted_counts.sum() * 100})
+        if include_unweighted:
+            frequency_df = pd.concat([pd.DataFrame({'Unweighted Counts': counts,
+                                                    'Unweighted Percentage': counts / counts.sum() * 100}),
+                                      frequency_df], axis=1)
+    else:
+        frequency_df = pd.DataFrame({'Counts': counts, 'Percentage': counts / counts.sum() * 100})
+    return frequency_df[(frequency_df > 0).any(axis=1)].reset_index()
+
+
+@pytest.mark.parametrize('weight_col, include_unweighted', [(None, False), ('PWGTP', False), ('PWGTP', True)])
+@pytest.mark.parametrize('col_name', ['SEX', 'RAC1P', 'SCHL', 'POVPIP'])
+def test_freq_1way_table_matches_value_counts_and_groupby(pums_persons, col_name, weight_col, include_unweighted):
+    toolbox = DataToolBox(pums_persons)
+    weights = toolbox._weights(weight_col) if weight_col else None
+    table, _ = toolbox._freq_1way_table(col_name, weights, include_unweighted)
+    expected = baseline_freq_1way(pums_persons, col_name, weight_col, include_unweighted)
+    pd.testing.assert_frame_equal(table, expected, check_dtype=False, check_index_type=False)
+
+
+def test_survey_freq_matches_a_groupby_per_variable(pums_persons):
+    toolbox = DataToolBox(pums_persons)
+    toolbox.apply_recodes(RECODES, 'acs')
+    toolbox.copy_column('TEN', 'sc_ten_raw')
+    table = toolbox.survey_freq('PWGTP', exclude=['sc_age_cont'], labels={'sc_sex': {1: 'Male', 2: 'Female'}})
+
+    data = toolbox.data
+    expected = []
+    for col_name in sorted(col for col in data.columns if col.startswith('sc_') and col != 'sc_age_cont'):
+        # proc surveyfreq leaves missing values out; groupby drops them too
+        groups = data.groupby(col_name)['PWGTP'].agg(['size', 'sum'])
+        expected.append(pd.DataFrame({
+            'Variable': col_name,
+            'Category': ['Total'] + [{1: 'Male', 2: 'Female'}[value] if col_name == 'sc_sex' else str(int(value))
+                                     for value in groups.index],
+            'Raw Frequency': [groups['size'].sum()] + groups['size'].tolist(),
+            'Population': [groups['sum'].sum()] + groups['sum'].tolist(),
+            'Percent': [100.0] + (groups['sum'] / groups['sum'].sum() * 100).tolist(),
+        }))
+    expected = pd.concat(expected, ignore_index=True)
+    pd.testing.assert_frame_equal(table, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('method, factor', [('jk2', 1.0), ('jk1', 3 / 4), ('fay', 1 / (4 * 0.5 ** 2)), ('sdr', 4 / 4)])
+def test_replicate_standard_errors_match_the_variance_formula(method, factor):
+    rng = np.random.default_rng(12)
+    n = 500
+    adult = pd.DataFrame({'sc_sex': rng.integers(1, 3, n), 'sc_age_cat': rng.integers(1, 7, n),
+                          'RAKEDW0': rng.uniform(1, 500, n)})
+    for i in range(1, 5):
+        adult[f'RAKEDW{i}'] = adult['RAKEDW0'] * rng.uniform(0, 2, n)
+    table = DataToolBox(adult).freq_1way_replicate(['sc_sex', 'sc_age_cat'], 'RAKEDW0', method=method,
+                                                   display=False)
+
+    weights = [f'RAKEDW{i}' for i in range(5)]
+    for col_name in ['sc_sex', 'sc_age_cat']:
+        totals = adult.groupby(col_name)[weights].sum()
+        percents = totals / totals.sum() * 100
+        count_se = np.sqrt(factor * totals[weights[1:]].sub(totals['RAKEDW0'], axis=0).pow(2).sum(axis=1))
+        percent_se = np.sqrt(factor * percents[weights[1:]].sub(percents['RAKEDW0'], axis=0).pow(2).sum(axis=1))
+
+        rows = table[table['Variable'] == col_name]
+        assert rows['Category'].tolist() == totals.index.tolist()
+        assert rows['Unweighted Counts'].tolist() == adult[col_name].value_counts().sort_index().tolist()
+        # the replicate matrix is float32
+        np.testing.assert_allclose(rows['Weighted Counts'], totals['RAKEDW0'], rtol=1e-6)
+        np.testing.assert_allclose(rows['SE'], count_se, rtol=1e-4)
+        np.testing.assert_allclose(rows['Percentage SE'], percent_se, rtol=1e-4)
+        np.testing.assert_allclose(rows['MOE'], 1.6448536 * count_se, rtol=1e-4)
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_the_callers_frame_is_never_changed(pums_persons, lazy):
+    original = pums_persons.copy(deep=True)
+    with warnings.catch_warnings():
+        # no SettingWithCopyWarning or chained assignment along the way
+        warnings.simplefilter('error')
+        toolbox = DataToolBox(pums_persons, lazy=lazy)
+        toolbox.data_exclude('AGEP >= 18')
+        toolbox.apply_recodes(RECODES, 'acs')
+        toolbox.data_construct('AGEP', ['AGEP >= 65'], [65], 'AGEP')
+        toolbox.data_map('SEX', 'SEX', {1: 2, 2: 1})
+        toolbox.copy_column('POVPIP', 'sc_pov_raw')
+        toolbox.mark_missing(['SCHL'], codes=[1])
+        toolbox.fill_all_nans(-9)
+        toolbox.optimize_dtypes(display=False)
+        toolbox.freq_2way('sc_sex', 'sc_age_cat')
+        toolbox.freq_multiway(['sc_sex', 'sc_age_cat', 'sc_cit'], exclude_equal=True)
+        data = toolbox.data
+
+    pd.testing.assert_frame_equal(pums_persons, original)
+    assert (data['AGEP'] >= 18).all()
+    assert not data.isna().any().any()
+
+
+def baseline_freq_2way(data, col_name_1, col_name_2, exclude_equal=False):
+    """
+    The table freq_2way printed in Step 1: 'NaN' filled in, pd.crosstab, melted, zero counts left out.
+    """
+    data = data[[col_name_1, col_name_2]].fillna('NaN')
+    melted = pd.crosstab(data[col_name_1], data[col_name_2]).reset_index().melt(id_vars=[col_name_1],
+                                                                                  value_name='COUNT')
+    keep = melted['COUNT'] > 0
+    if exclude_equal:
+        keep &= melted[col_name_1] != melted[col_name_2]
+    return melted[keep]
+
+
+@pytest.mark.parametrize('exclude_equal', [False, True])
+@pytest.mark.parametrize('col_name_1, col_name_2', [('ESR', 'TEN'), ('SCHL', 'SEX'), ('TEN', 'ESR')])
+def test_freq_2way_prints_the_crosstab_table(pums_persons, capsys, col_name_1, col_name_2, exclude_equal):
+    expected = tabulate(baseline_freq_2way(pums_persons, col_name_1, col_name_2, exclude_equal),
+                        headers='keys', tablefmt='grid', showindex=False)
+    DataToolBox(pums_persons).freq_2way(col_name_1, col_name_2, exclude_equal=exclude_equal)
+    printed = capsys.readouterr().out
+    assert printed.split('\n', 1)[1] == expected + '\n\n'
+
+
+@pytest.mark.parametrize('dtype', ['Int8', 'category'])
+def test_crosstab_of_compact_columns_matches_the_float_columns(pums_persons, dtype):
+    columns = ['ESR', 'TEN', 'SEX']
+    compact = pums_persons.astype({col: dtype for col in ['ESR', 'TEN']})
+    table = DataToolBox(compact).crosstab(columns, weight_col='PWGTP')
+    expected = DataToolBox(pums_persons).crosstab(columns, weight_col='PWGTP')
+    for col in columns:
+        # 'NaN' stays a label; the other values compare as numbers
+        assert table[col].astype(str).str.replace('.0', '', regex=False).tolist() == \
+            expected[col].astype(str).str.replace('.0', '', regex=False).tolist()
+    assert table[['COUNT', 'WEIGHTED COUNT']].values.tolist() == expected[['COUNT', 'WEIGHTED COUNT']].values.tolist()
+
+
+def baseline_freq_multiway(data, columns, exclude_zeros=True, exclude_equal=False):
+    """
+    The table freq_multiway printed in Step 1, with exclude_equal checked row by row with DataFrame.apply.
+    """
+    data = data[columns].fillna('NaN')
+    melted = pd.crosstab(index=[data[col] for col in columns[:-1]], columns=data[columns[-1]]).reset_index()
+    melted = pd.melt(melted, id_vars=columns[:-1], value_name='COUNT')
+    if exclude_zeros:
+        melted = melted[melted['COUNT'] > 0]
+    if exclude_equal and len(columns) > 1:
+        equal_filter = melted.apply(lambda row: len(set(row[columns[:-1]].tolist() + [row[columns[-1]]])) == 1,
+                                    axis=1)
+        melted = melted[~equal_filter]
+    return melted
+
+
+@pytest.mark.parametrize('exclude_zeros', [True, False])
+@pytest.mark.parametrize('columns', [['sc_sex', 'sc_cit'], ['sc_sex', 'sc_cit', 'sc_housing'], ['ESR', 'TEN', 'SEX']])
+def test_freq_multiway_exclude_equal_matches_the_row_wise_check(pums_persons, columns, exclude_zeros):
+    toolbox = DataToolBox(pums_persons)
+    toolbox.apply_recodes(RECODES, 'acs')
+    table = toolbox.crosstab(columns, exclude_zeros=exclude_zeros, exclude_equal=True)
+    expected = baseline_freq_multiway(toolbox.data, columns, exclude_zeros=exclude_zeros, exclude_equal=True)
+    # the baseline cannot sort 'NaN' among numbers; compare the rows as sets
+    assert sorted(map(str, table.values.tolist())) == sorted(map(str, expected.values.tolist()))
+    assert len(table) == len(expected)
+
+
+@pytest.mark.parametrize('dense_max_cells, key_max', [(1, DataToolBox.KEY_MAX), (1, 64)])
+def test_sparse_crosstab_matches_the_dense_table_and_groupby(pums_persons, monkeypatch, dense_max_cells, key_max):
+    columns = ['PUMA', 'AGEP', 'RAC1P', 'SEX', 'POVPIP']
+    dense = DataToolBox(pums_persons).crosstab(columns, weight_col='PWGTP', exclude_equal=True)
+
+    # observed cells only, and with a small key_max the packed columns are re-ranked on the way
+    monkeypatch.setattr(DataToolBox, 'DENSE_MAX_CELLS', dense_max_cells)
+    monkeypatch.setattr(DataToolBox, 'KEY_MAX', key_max)
+    sparse = DataToolBox(pums_persons).crosstab(columns, weight_col='PWGTP', exclude_equal=True)
+    pd.testing.assert_frame_equal(sparse, dense)
+
+    # missing values sort last, like an infinite value
+    expected = pums_persons.fillna({col: np.inf for col in columns}).groupby(columns)['PWGTP'].agg(['size', 'sum'])
+    table = DataToolBox(pums_persons).crosstab(columns, weight_col='PWGTP')
+    assert table['COUNT'].tolist() == expected['size'].tolist()
+    assert table['WEIGHTED COUNT'].tolist() == expected['sum'].tolist()
+    values = table[columns].apply(pd.to_numeric, errors='coerce').fillna(np.inf)
+    assert values.values.tolist() == np.array(expected.index.tolist(), dtype='float64').tolist()
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'bz2', 'xz'])
+def test_chunked_csv_export_reads_back_like_to_csv(tmp_path, pums_persons, compression):
+    DataToolBox(pums_persons).export_data('acs', 'csv', folder_path=str(tmp_path), compression=compression,
+                                          chunksize=7)
+    exported = next(tmp_path.iterdir())
+    baseline = tmp_path / 'baseline.csv'
+    pums_persons.to_csv(baseline, index=False)
+    pd.testing.assert_frame_equal(pd.read_csv(exported), pd.read_csv(baseline))
+
+
+@pytest.mark.parametrize('compression', [None, 'snappy', 'gzip'])
+def test_chunked_parquet_export_reads_back_the_data(tmp_path, pums_persons, compression):
+    DataToolBox(pums_persons).export_data('acs', 'parquet', folder_path=str(tmp_path), compression=compression,
+                                          chunksize=7, n_jobs=2)
+    path = next(tmp_path.iterdir())
+    assert pq.ParquetFile(path).num_row_groups == 6
+    exported = pd.read_parquet(path)
+    # whole-number columns are written in their smallest integer dtype
+    pd.testing.assert_frame_equal(exported, pums_persons, check_dtype=False)
+
+
+def read_sqlite(path):
+    with sqlite3.connect(path) as con:
+        return pd.read_sql('select * from acs', con)
+
+
+def read_duckdb(path):
+    import duckdb
+    con = duckdb.connect(path)
+    try:
+        return con.execute('select * from acs').df()
+    finally:
+        con.close()
+
+
+def read_rds(path):
+    import pyreadr
+    return pyreadr.read_r(path)[None]
+
+
+def read_sav(path):
+    import pyreadstat
+    return pyreadstat.read_sav(path)[0]
+
+
+@pytest.mark.parametrize('format, options, read', [
+    ('sql', {'sql_engine': 'sqlite', 'chunksize': 7}, read_sqlite),
+    ('sql', {'sql_engine': 'duckdb'}, read_duckdb),
+    ('spss', {}, read_sav),
+    ('r', {}, read_rds),
+])
+def test_sql_spss_and_r_exports_read_back_the_data(tmp_path, pums_persons, format, options, read):
+    toolbox = DataToolBox(pums_persons)
+    toolbox.apply_recodes(RECODES, 'acs')
+    # nullable integers and categoricals, which the writers get as plain NumPy columns
+    toolbox.optimize_dtypes(display=False)
+    data = toolbox.data
+    toolbox.export_data('acs', format, folder_path=str(tmp_path), **options)
+
+    exported = read(str(next(tmp_path.iterdir())))
+    assert list(exported.columns) == list(data.columns)
+    numeric = [col for col in data.columns if col != 'SERIALNO']
+    np.testing.assert_array_equal(exported[numeric].to_numpy(dtype='float64'),
+                                  data[numeric].astype('float64').to_numpy())
+    assert exported['SERIALNO'].tolist() == data['SERIALNO'].astype(str).tolist()
+
+
+@pytest.mark.parametrize('lazy', [False, True])
+def test_mark_then_fill_missing_gives_back_fill_all_nans(pums_persons, lazy):
+    data = pums_persons.copy()
+    data.loc[[6, 7], 'SCHL'] = -8
+    data.loc[[20], 'SCHL'] = -1
+    data.loc[[21, 22], 'POVPIP'] = -9
+
+    masked = DataToolBox(data, lazy=lazy)
+    masked.mark_missing(['AGEP', 'SCHL', 'POVPIP'])
+    masked.data_exclude('SEX == 2')
+    # the recodes see the codes as missing
+    masked.data_construct('sc_edu', ['SCHL <= 15', 'SCHL >= 16'], [1, 2], -1)
+    summary = masked.missing_summary()
+    masked.fill_missing()
+
+    # the baseline fills NaN with -9 and leaves the codes in the data
+    filled = DataToolBox(data)
+    filled.fill_all_nans(-9)
+    filled.data_exclude('SEX == 2')
+    expected = filled.data
+    for col in ['AGEP', 'SCHL', 'POVPIP']:
+        assert masked.data[col].tolist() == expected[col].tolist()
+    coded = expected['SCHL'].isin([-1, -8, -9])
+    assert masked.data['sc_edu'].tolist() == np.where(coded, -1, np.where(expected['SCHL'] <= 15, 1, 2)).tolist()
+
+    counts = expected[['AGEP', 'SCHL', 'POVPIP']].melt().query('value in [-1, -8, -9]')
+    counts = counts.groupby(['variable', 'value']).size()
+    assert summary.set_index(['Variable', 'Reason'])['Count'].to_dict() == counts.to_dict()
+    assert summary['Reason'].tolist() == [-9, -9, -8, -1, -9]
+    assert not masked.missing_summary().shape[0]
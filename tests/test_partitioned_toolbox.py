@@ -0,0 +1,75 @@
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from constructed_variables import RECODES
+from data_toolbox import DataToolBox
+from partitioned_toolbox import PartitionedToolBox
+
+
+@pytest.fixture
+def parts():
+    # the weight is whole in the first partition (so it is exported as an integer) and not in the second
+    return [
+        pd.DataFrame({'SERIALNO': ['a', 'b'], 'sc_sex': [1, 2], 'PWGTP': [10.0, 20.0]}),
+        pd.DataFrame({'SERIALNO': ['c', 'd', 'e'], 'sc_sex': [2, 2, 1], 'PWGTP': [1.5, np.nan, 30.0]}),
+    ]
+
+
+def read_export(folder):
+    path = str(next(path for path in folder.iterdir() if 'freq_report' not in path.name))
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith('.sqlite'):
+        return pd.read_sql('select * from persons', sqlite3.connect(path))
+    return pd.read_csv(path)
+
+
+@pytest.mark.parametrize('format', ['csv', 'parquet', 'sql'])
+def test_partitions_are_exported_with_one_schema(tmp_path, parts, format):
+    PartitionedToolBox(lambda: iter(parts)).export_data('persons', format, folder_path=str(tmp_path))
+    exported = read_export(tmp_path)
+    expected = pd.concat(parts, ignore_index=True)
+    assert exported['PWGTP'].dtype == 'float64'
+    np.testing.assert_array_equal(exported['PWGTP'].to_numpy(), expected['PWGTP'].to_numpy())
+    assert exported['SERIALNO'].tolist() == expected['SERIALNO'].tolist()
+    if format == 'parquet':
+        import pyarrow.parquet as parquet
+        metadata = parquet.ParquetFile(str(next(tmp_path.iterdir()))).metadata
+        assert metadata.num_row_groups == 2
+        assert str(metadata.schema.to_arrow_schema().field('PWGTP').type) == 'double'
+
+
+def run_steps(toolbox):
+    toolbox.data_exclude('AGEP >= 18')
+    toolbox.apply_recodes(RECODES, 'acs')
+    toolbox.mark_missing(['POVPIP'])
+    toolbox.data_exclude('sc_cit != 3')
+    toolbox.select_columns(['SERIALNO', 'PWGTP'], prefixes=['sc_'])
+
+
+def test_partitioned_steps_match_the_in_memory_toolbox(pums_persons, monkeypatch, capsys):
+    tables = []
+    monkeypatch.setattr(DataToolBox, '_print_freq_table', staticmethod(lambda df, title: tables.append((title, df))))
+    columns = ['sc_sex', 'sc_age_cat', 'sc_poverty', 'sc_edu']
+
+    eager = DataToolBox(pums_persons)
+    run_steps(eager)
+    eager.freq_1way_batch(columns, weight_col='PWGTP', include_unweighted=True)
+    eager_filters = [line for line in capsys.readouterr().out.splitlines() if 'cases were removed' in line]
+    eager_tables, tables[:] = list(tables), []
+
+    partitioned = PartitionedToolBox(lambda: (pums_persons.iloc[start:start + 15] for start in range(0, 40, 15)))
+    run_steps(partitioned)
+    partitioned.freq_1way_batch(columns, weight_col='PWGTP', include_unweighted=True)
+    filters = [line for line in capsys.readouterr().out.splitlines() if 'cases were removed' in line]
+
+    assert len(filters) == 2 and filters == eager_filters
+    assert [title for title, _ in tables] == [title for title, _ in eager_tables]
+    for (_, table), (_, expected) in zip(tables, eager_tables):
+        pd.testing.assert_frame_equal(table, expected, check_dtype=False)
+
+    combined = partitioned.to_toolbox().data
+    pd.testing.assert_frame_equal(combined, eager.data.reset_index(drop=True), check_dtype=False)
@@ -0,0 +1,109 @@
+import os
+import re
+
+import numpy as np
+import pytest
+
+from sas_formats import load_formats, parse_format_statement, parse_label_statement, parse_proc_format
+
+
+PROC_FORMAT = """
+PROC FORMAT ;
+/* numeric codes, lists, ranges and OTHER */
+VALUE POVF
+-9                      ="NOT ASCERTAINED"
+-8, -7                  ="DK/REFUSED"
+LOW -< 0                ="NEGATIVE"
+0 - 99                  ="0-99% FPL"
+99 <- 199.5             ="100-199% FPL"
+200 -< 300              ="200-299% FPL"
+300 - HIGH              ="300% FPL AND ABOVE"
+;
+VALUE  $AG23BEG
+" "                     ="OK"
+"-9"                    ="NOT ASCERTAINED"
+"1900" - "2022"         ="YEAR"
+OTHER                   ="OUT OF RANGE"
+;
+VALUE SC_SEX  1 = "Male"  2 = "Female";
+INVALUE SKIPPED 1 = 1;
+"""
+
+
+def sas_povf(value):
+    """
+    POVF as SAS applies it, one value at a time: single values first, then the first range holding the value.
+    """
+    if np.isnan(value):
+        return None
+    if value == -9:
+        return "NOT ASCERTAINED"
+    if value in (-8, -7):
+        return "DK/REFUSED"
+    if value < 0:
+        return "NEGATIVE"
+    if 0 <= value <= 99:
+        return "0-99% FPL"
+    if 99 < value <= 199.5:
+        return "100-199% FPL"
+    if 200 <= value < 300:
+        return "200-299% FPL"
+    if value >= 300:
+        return "300% FPL AND ABOVE"
+    return None
+
+
+def test_parse_proc_format_matches_the_value_statement():
+    formats = parse_proc_format(PROC_FORMAT)
+    assert sorted(formats) == ['$AG23BEG', 'POVF', 'SC_SEX']
+
+    values = np.concatenate([np.arange(-10, 320, 0.5), [99.25, 199.5, 199.75, np.nan]])
+    assert formats['POVF'].lookup(values).tolist() == [sas_povf(value) for value in values]
+
+    assert formats['$AG23BEG'].lookup([np.nan, '-9', 1950.0, '2022', '2023', 'ABC']).tolist() == \
+        ['OK', 'NOT ASCERTAINED', 'YEAR', 'YEAR', 'OUT OF RANGE', 'OUT OF RANGE']
+    assert formats['SC_SEX'].lookup([1, 2, 3]).tolist() == ['Male', 'Female', None]
+
+
+def test_parse_format_and_label_statements():
+    assert parse_format_statement("FORMAT AA2A AA2A. AA5AOS SRAGE $ALPHA3X. POVLL POVF8.;") == \
+        {'AA2A': 'AA2A', 'AA5AOS': '$ALPHA3X', 'SRAGE': '$ALPHA3X', 'POVLL': 'POVF'}
+    labels = parse_label_statement('LABEL AA1AMON = "ADULT DATE OF BIRTH MONTH (AA1A)" SRSEX = "SELF-REPORTED GENDER";')
+    assert labels == {'AA1AMON': 'ADULT DATE OF BIRTH MONTH (AA1A)', 'SRSEX': 'SELF-REPORTED GENDER'}
+
+
+def test_load_formats_parses_once_until_a_file_changes(tmp_path, capsys):
+    proc_format = tmp_path / 'PROC_FORMAT.SAS'
+    proc_format.write_text(PROC_FORMAT)
+    format_statement = tmp_path / 'FORMAT.sas'
+    format_statement.write_text("FORMAT SC_SEX SC_SEX. POVLL POVF.;")
+    cache_dir = str(tmp_path / 'Cache')
+
+    parsed = load_formats('formats', str(proc_format), str(format_statement), cache_dir=cache_dir)
+    cached = load_formats('formats', str(proc_format), str(format_statement), cache_dir=cache_dir)
+    assert 'loaded from' in capsys.readouterr().out
+    for catalog in (parsed, cached):
+        assert catalog.value_labels('povll', [-8, 50.0, 250, np.nan]) == \
+            ['DK/REFUSED', '0-99% FPL', '200-299% FPL', np.nan]
+        assert catalog.value_labels('sc_sex', [1, 3]) == ['Male', '3']
+
+    format_statement.write_text("FORMAT SC_SEX SC_SEX.;")
+    changed = load_formats('formats', str(proc_format), str(format_statement), cache_dir=cache_dir)
+    assert 'parsing it' in capsys.readouterr().out
+    assert changed.format_for('POVLL') is None
+    assert len(os.listdir(cache_dir)) == 1
+
+
+CHIS_FORMATS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'Data', 'CHIS Dummy', 'Adult 2022')
+
+
+@pytest.mark.skipif(not os.path.isdir(CHIS_FORMATS), reason="the CHIS format files are not available")
+def test_the_chis_catalog_has_every_value_statement():
+    with open(os.path.join(CHIS_FORMATS, 'ADULT_PROC_FORMAT.SAS'), encoding='latin-1') as handle:
+        text = handle.read()
+    formats = parse_proc_format(text)
+    names = {name.upper() for name in re.findall(r'^\s*VALUE\s+(\$?\w+)', text, re.M | re.I)}
+    assert set(formats) == names
+    assert formats['AA2A'].lookup([-9, 1, 6, 7]).tolist() == \
+        ['NOT ASCERTAINED', 'BETWEEN 18 AND 29', '65 OR OLDER', None]